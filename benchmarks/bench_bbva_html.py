@@ -0,0 +1,87 @@
+"""Benchmark: lectura directa del HTML de BBVA vs. conversión completa con html2text.
+
+Arma cuerpos HTML con la estructura de los avisos de compra de BBVA (estilos en el
+<head>, tablas de maquetación anidadas, la tabla de datos y un pie legal largo), los
+procesa con los dos caminos de BBVAParser y verifica que ambos extraigan lo mismo.
+
+Uso:
+    python benchmarks/bench_bbva_html.py [--messages 500] [--repeat 3]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import procesar_consumos as pc # noqa: E402
+from fixtures import COMERCIOS, build_bbva_html # noqa: E402
+
+def build_messages(count, seed=1234):
+    """Genera (html, subject, esperado) para `count` avisos de compra."""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        fecha = f'{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(2021, 2025)}'
+        comercio = rng.choice(COMERCIOS)
+        moneda = rng.choice(['ARS', 'ARS', 'ARS', 'USD'])
+        entero = rng.randint(1, 250000)
+        importe = f'{entero:,}'.replace(',', '.') + f',{rng.randint(0, 99):02d}'
+        subject = rng.choice(['Compra con tu tarjeta Visa', 'Compra con tu tarjeta Mastercard'])
+        messages.append((build_bbva_html(rng, fecha, comercio, moneda, importe), subject))
+    return messages
+
+def _new_data():
+    return {'fecha': None, 'banco': 'BBVA', 'comercio': None, 'tarjeta': None, 'importe': None, 'moneda': None}
+
+def run_html2text(parser, messages):
+    results = []
+    for html_text, subject in messages:
+        data = _new_data()
+        parser.parse(data, pc.html_to_text(html_text), subject, '2025', 'bench')
+        results.append(data)
+    return results
+
+def run_fast(parser, messages):
+    results = []
+    for html_text, subject in messages:
+        data = _new_data()
+        if not parser.parse_html(data, html_text, subject, '2025', 'bench'):
+            raise AssertionError('La lectura directa no encontró todos los campos')
+        results.append(data)
+    return results
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--messages', type=int, default=500)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+    logging.disable(logging.WARNING) # Los logs por correo distorsionan la medición
+
+    messages = build_messages(args.messages)
+    parser = pc.BBVAParser()
+    avg_size = sum(len(html_text) for html_text, _ in messages) / len(messages)
+
+    slow_time, slow_results = best_time(lambda: run_html2text(parser, messages), args.repeat)
+    fast_time, fast_results = best_time(lambda: run_fast(parser, messages), args.repeat)
+
+    mismatches = sum(1 for slow, fast in zip(slow_results, fast_results) if slow != fast)
+    print(f'Correos BBVA: {len(messages)} (HTML promedio {avg_size / 1024:.1f} KB), mejor de {args.repeat}')
+    print(f'  html2text + regex : {slow_time * 1000:8.1f} ms  ({len(messages) / slow_time:8.0f} correos/s)')
+    print(f'  lectura directa   : {fast_time * 1000:8.1f} ms  ({len(messages) / fast_time:8.0f} correos/s)')
+    print(f'  aceleración       : {slow_time / fast_time:.1f}x')
+    print(f'  resultados distintos: {mismatches}')
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""Benchmark de extract_data_from_email sobre correos sintéticos (ver fixtures.py).
+
+Para cada tamaño procesa esa cantidad de correos de la mezcla de fixtures.py y reporta
+correos/s, el tiempo por etapa (las métricas de procesar_consumos: parse_email_body,
+html_to_text, regex, extract_data_from_email) y la memoria medida con tracemalloc: el
+pico de toda la corrida y lo que reserva cada correo (promedio y máximo del pico por
+correo, por encima de lo que ya estaba reservado). Cada resultado se compara con el esperado (golden) que arma el
+generador: si alguno difiere, el benchmark termina con código 1.
+
+Los correos se generan de a uno a medida que se procesan (100k correos de BBVA no
+entran en memoria), y el tiempo de generación no se cuenta.
+
+Uso:
+    python benchmarks/bench_extract.py [--sizes 1000,10000,100000] [--seed 1234] [--no-memory]
+"""
+import argparse
+import collections
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import procesar_consumos as pc # noqa: E402
+from fixtures import iter_messages # noqa: E402
+
+STAGES = ('parse_email_body', 'html_to_text', 'regex', 'extract_data_from_email')
+
+def run(count, seed):
+    """Procesa `count` correos; devuelve (segundos de extracción, diferencias con el golden, correos por resultado)."""
+    elapsed = 0.0
+    mismatches = []
+    outcomes = collections.Counter()
+    for message, expected in iter_messages(count, seed):
+        start = time.perf_counter()
+        data = pc.extract_data_from_email(message)
+        elapsed += time.perf_counter() - start
+        outcomes['ok' if data else 'sin datos'] += 1
+        if data != expected:
+            mismatches.append((message.get('id'), expected, data))
+    return elapsed, mismatches, outcomes
+
+def measure_memory(count, seed):
+    """Memoria reservada durante la corrida, según tracemalloc.
+
+    Devuelve (pico total, promedio del pico por correo, máximo del pico por correo), en
+    bytes. El pico total incluye el correo que se está generando (uno por vez), no toda
+    la mezcla; el de cada correo mide solo lo que reserva extract_data_from_email."""
+    peak = 0
+    per_message = []
+    tracemalloc.start()
+    try:
+        for message, _ in iter_messages(count, seed):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            pc.extract_data_from_email(message)
+            message_peak = tracemalloc.get_traced_memory()[1]
+            peak = max(peak, message_peak)
+            per_message.append(message_peak - before)
+        return peak, sum(per_message) / max(len(per_message), 1), max(per_message, default=0)
+    finally:
+        tracemalloc.stop()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='Cantidades de correos a procesar, separadas por coma.')
+    arg_parser.add_argument('--seed', type=int, default=1234)
+    arg_parser.add_argument('--no-memory', action='store_true', help='No medir el pico de memoria (es una pasada más).')
+    args = arg_parser.parse_args()
+    logging.disable(logging.CRITICAL) # Los logs por correo distorsionan la medición
+
+    failed = False
+    for count in (int(size) for size in args.sizes.split(',')):
+        pc.METRICS.drain() # Métricas solo de este tamaño
+        elapsed, mismatches, outcomes = run(count, args.seed)
+        stages = pc.METRICS.summary()['etapas']
+        print(f'{count} correos: {elapsed:.2f} s de extracción, {count / elapsed:,.0f} correos/s '
+              f'({outcomes["ok"]} con datos, {outcomes["sin datos"]} sin datos)')
+        for stage in STAGES:
+            timing = stages.get(stage)
+            if timing:
+                print(f'  {stage:<24} {timing["segundos"]:8.2f} s  {timing["llamadas"]:>8} llamadas  '
+                      f'{timing["promedio_s"] * 1e6:8.1f} µs/llamada')
+        if not args.no_memory:
+            peak, mean, maximum = measure_memory(count, args.seed)
+            print(f'  pico de memoria: {peak / 1024:.0f} KiB; por correo: {mean / 1024:.1f} KiB promedio, '
+                  f'{maximum / 1024:.0f} KiB máximo')
+        print(f'  diferencias con el golden: {len(mismatches)}')
+        for msg_id, expected, data in mismatches[:5]:
+            print(f'    {msg_id}: esperado {expected}, obtenido {data}')
+        failed = failed or bool(mismatches)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Benchmark de --export y de los totales con rollup() sobre varios años de movimientos.
+
+Llena un registro local temporal con movimientos sintéticos (comercios de fixtures.py,
+categorizados con el mapeo del servidor falso), lo exporta con export_ledger() y mide
+cuánto tardan los totales por mes y categoría, por tarjeta y por moneda de tres formas:
+
+    python      recorriendo las filas una por una, como se hace hoy con la hoja bajada de Sheets
+    rollup      load_export() de toda la exportación (solo las columnas necesarias) + rollup()
+    rollup-mes  load_export() de un solo mes (solo se abre esa carpeta) + rollup()
+
+Los totales de rollup se comparan con los de la versión en Python: si difieren, el
+benchmark termina con código 1. Necesita pyarrow y numpy.
+
+Uso:
+    python benchmarks/bench_rollup.py [--rows 1000000] [--years 5] [--format parquet] [--seed 1234]
+"""
+import argparse
+import collections
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import procesar_consumos as pc # noqa: E402
+from fake_google_server import MAPEO_COMERCIOS # noqa: E402
+from fixtures import COMERCIOS, COMERCIOS_LATIN1 # noqa: E402
+
+ROLLUPS = (('mes', 'categoria', 'moneda'), ('tarjeta', 'moneda'), ('moneda',))
+
+def fill_ledger(ledger, rows, years, seed):
+    """Registra `rows` movimientos con fechas repartidas en los últimos `years` años."""
+    rng = random.Random(seed)
+    merchants = pc.MerchantIndex(MAPEO_COMERCIOS)
+    categories = {comercio: merchants.categorize(comercio) for comercio in COMERCIOS + COMERCIOS_LATIN1}
+    first_day = datetime.date.today() - datetime.timedelta(days=365 * years)
+    entries = []
+    for index in range(rows):
+        comercio = rng.choice(COMERCIOS + COMERCIOS_LATIN1)
+        day = first_day + datetime.timedelta(days=rng.randrange(365 * years))
+        moneda = 'USD' if rng.random() < 0.1 else 'ARS'
+        importe = round(rng.uniform(1, 300), 2) if moneda == 'USD' else round(rng.uniform(100, 250000), 2)
+        entries.append((f'bench-{index}', [f'{day:%d/%m/%Y}', rng.choice(['BBVA', 'Naranja X']), comercio,
+                                           rng.choice(['VISA', 'MASTERCARD', 'NARANJA']), importe,
+                                           categories[comercio], moneda], f'<bench-{index}@mail>'))
+        if len(entries) == pc.IMPORT_BULK_ROWS:
+            ledger.record(entries)
+            entries = []
+    ledger.record(entries)
+
+def python_rollup(ledger, by):
+    """Los mismos totales que rollup(), recorriendo las filas en Python."""
+    totals = collections.defaultdict(lambda: [0.0, 0])
+    for chunk in ledger.iter_movements(pc.EXPORT_BATCH_ROWS):
+        for _, fecha, banco, comercio, tarjeta, importe, categoria, moneda in chunk:
+            row = {'mes': f'{fecha[6:10]}-{fecha[3:5]}', 'categoria': categoria, 'tarjeta': tarjeta,
+                   'moneda': moneda, 'banco': banco, 'comercio': comercio}
+            total = totals[tuple(row[column] for column in by)]
+            total[0] += importe
+            total[1] += 1
+    return sorted((*key, total, count) for key, (total, count) in totals.items())
+
+def same_totals(expected, got):
+    return len(expected) == len(got) and all(
+        a[:-2] == b[:-2] and a[-1] == b[-1] and abs(a[-2] - b[-2]) <= 1e-6 * max(1.0, abs(a[-2]))
+        for a, b in zip(expected, got))
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--rows', type=int, default=1000000)
+    arg_parser.add_argument('--years', type=int, default=5)
+    arg_parser.add_argument('--format', choices=sorted(pc.EXPORT_FORMATS), default='parquet')
+    arg_parser.add_argument('--seed', type=int, default=1234)
+    args = arg_parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = pc.TransactionLedger(os.path.join(tmp, 'bench.db'))
+        start = time.perf_counter()
+        fill_ledger(ledger, args.rows, args.years, args.seed)
+        print(f'{args.rows} movimientos registrados en {time.perf_counter() - start:.1f} s')
+
+        out_dir = os.path.join(tmp, 'export')
+        start = time.perf_counter()
+        pc.export_ledger(ledger, out_dir, args.format)
+        size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(out_dir) for name in names)
+        print(f'exportación ({args.format}): {time.perf_counter() - start:.2f} s, {size / 2**20:.1f} MiB')
+        last_month = f'{datetime.date.today():%Y-%m}'
+
+        for by in ROLLUPS:
+            start = time.perf_counter()
+            expected = python_rollup(ledger, by)
+            python_s = time.perf_counter() - start
+            start = time.perf_counter()
+            columns = sorted({*by, 'importe'})
+            got = pc.rollup(pc.load_export(out_dir, args.format, columns=columns), by)
+            rollup_s = time.perf_counter() - start
+            start = time.perf_counter()
+            pc.rollup(pc.load_export(out_dir, args.format, months=[last_month], columns=columns), by)
+            month_s = time.perf_counter() - start
+            ok = same_totals(expected, got)
+            failed = failed or not ok
+            print(f"  {', '.join(by):<24} python {python_s * 1000:8.1f} ms   rollup {rollup_s * 1000:7.1f} ms   "
+                  f"rollup-mes {month_s * 1000:6.1f} ms   {len(got)} grupos{'' if ok else '  DIFERENCIAS'}")
+        ledger.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
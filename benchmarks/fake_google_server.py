@@ -0,0 +1,610 @@
+"""Servidor HTTP local que imita la parte de Gmail y Sheets que usa procesar_consumos.py.
+
+Sirve para probar de punta a punta (y medir) una ejecución completa sin tocar las
+APIs reales: el script se apunta acá con --api-base-url. Implementa:
+
+    Gmail   labels.list/create, messages.list/get/modify/batchModify/send, history.list,
+            getProfile y el endpoint de batch (multipart/mixed, hasta 100 requests)
+    Sheets  spreadsheets.values.append, values.batchUpdate/batchClear (hoja de resumen)
+            y values.get (solo las hojas MapeoComercios y Presupuesto)
+
+El buzón tiene --messages correos sintéticos generados con fixtures.py (la misma mezcla
+que bench_extract.py), todos no leídos y con la etiqueta de consumos. Los correos se
+arman recién cuando se piden, así que el servidor aguanta cientos de miles sin
+ocupar memoria: solo se guardan las etiquetas de los correos modificados.
+Con --arrival-rate llegan correos nuevos mientras corre (para probar --daemon e
+--incremental).
+
+Para imitar el comportamiento de producción se puede agregar latencia por request,
+errores 429/5xx inyectados al azar y las cuotas por usuario de cada API (un 429 con
+Retry-After cuando se pasan). GET /_fake/stats devuelve los contadores del servidor.
+
+Uso:
+    python benchmarks/fake_google_server.py --messages 200000 --port 8765 \\
+        [--latency-ms 40 --jitter-ms 20] [--error-rate 0.01] [--rate-limit-rate 0.01] \\
+        [--gmail-quota 15000 --sheets-quota 60] [--sheets-csv filas.csv]
+    python procesar_consumos.py --api-base-url http://127.0.0.1:8765/ --local-db /tmp/carga.db
+"""
+import argparse
+import array
+import collections
+import csv
+import datetime
+import email.parser
+import functools
+import gzip
+import http
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fixtures import message_at, message_date, message_id, message_index
+
+# Etiquetas del buzón falso. Label_1 es la que busca el script (GMAIL_LABEL_TO_SEARCH)
+INITIAL_LABELS = {'INBOX': 'INBOX', 'UNREAD': 'UNREAD', 'CATEGORY_UPDATES': 'CATEGORY_UPDATES',
+                  'Label_1': 'Tarjetas/Consumos Tarjeta'}
+DEFAULT_MESSAGE_LABELS = frozenset({'UNREAD', 'Label_1', 'CATEGORY_UPDATES'})
+# historyId del correo número i: HISTORY_BASE + i + 1. Un startHistoryId menor a
+# HISTORY_BASE se responde con 404, como Gmail cuando el historyId es demasiado viejo
+HISTORY_BASE = 900000
+HISTORY_PAGE_SIZE = 100
+LIST_PAGE_SIZE = 100
+LIST_PAGE_MAX = 500
+BATCH_MAX = 100
+BATCH_MODIFY_MAX = 1000
+# Contenido de la hoja MapeoComercios (Comercio, CategoriaAsignada) para los comercios de fixtures.py
+MAPEO_COMERCIOS = [['MERCADOLIBRE', 'Compras'], ['COTO', 'Supermercado'], ['YPF', 'Combustible'],
+                   ['MERPAGO', 'Varios'], ['FARMACITY', 'Salud'], ['NETFLIX', 'Suscripciones'],
+                   ['DIA TIENDA', 'Supermercado'], ['RAPPI', 'Delivery'], ['EASY', 'Hogar'],
+                   ['STARBUCKS', 'Salidas'], ['SPOTIFY', 'Suscripciones'], ['CARREFOUR', 'Supermercado'],
+                   ['UBER', 'Transporte'], ['PEDIDOSYA', 'Delivery'], ['PANADERIA SAN JOSE', 'Supermercado'],
+                   ['CAFE DEL ANGEL', 'Salidas'], ['LIBRERIA', 'Varios']]
+# Contenido de la hoja Presupuesto (Categoria, monto mensual en ARS)
+PRESUPUESTO = [['Supermercado', 150000], ['Delivery', 60000], ['Salidas', 40000], ['Combustible', 80000],
+               ['Compras', 200000], ['Suscripciones', 20000]]
+# Unidades de cuota de cada método, como en https://developers.google.com/gmail/api/reference/quota
+# (Sheets cobra 1 por request)
+QUOTA_COSTS = {
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.getProfile': 1,
+    'gmail.users.messages.send': 100,
+}
+# Respuestas de más de GZIP_MIN_BYTES se comprimen si el cliente acepta gzip. Nivel bajo
+# para que el servidor no sea el cuello de botella de la prueba de carga
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 1
+
+# (método HTTP, ruta, API, ID del método de discovery)
+ROUTES = [
+    ('GET', r'gmail/v1/users/(?P<user>[^/]+)/labels', 'gmail', 'gmail.users.labels.list'),
+    ('POST', r'gmail/v1/users/(?P<user>[^/]+)/labels', 'gmail', 'gmail.users.labels.create'),
+    ('GET', r'gmail/v1/users/(?P<user>[^/]+)/messages', 'gmail', 'gmail.users.messages.list'),
+    ('POST', r'gmail/v1/users/(?P<user>[^/]+)/messages/batchModify', 'gmail', 'gmail.users.messages.batchModify'),
+    ('GET', r'gmail/v1/users/(?P<user>[^/]+)/messages/(?P<id>[^/]+)', 'gmail', 'gmail.users.messages.get'),
+    ('POST', r'gmail/v1/users/(?P<user>[^/]+)/messages/(?P<id>[^/]+)/modify', 'gmail', 'gmail.users.messages.modify'),
+    ('GET', r'gmail/v1/users/(?P<user>[^/]+)/history', 'gmail', 'gmail.users.history.list'),
+    ('GET', r'gmail/v1/users/(?P<user>[^/]+)/profile', 'gmail', 'gmail.users.getProfile'),
+    ('POST', r'gmail/v1/users/(?P<user>[^/]+)/messages/send', 'gmail', 'gmail.users.messages.send'),
+    ('POST', r'v4/spreadsheets/(?P<spreadsheet>[^/]+)/values/(?P<range>[^/]+):append', 'sheets',
+     'sheets.spreadsheets.values.append'),
+    ('GET', r'v4/spreadsheets/(?P<spreadsheet>[^/]+)/values/(?P<range>[^/]+)', 'sheets', 'sheets.spreadsheets.values.get'),
+    ('POST', r'v4/spreadsheets/(?P<spreadsheet>[^/]+)/values:batchUpdate', 'sheets',
+     'sheets.spreadsheets.values.batchUpdate'),
+    ('POST', r'v4/spreadsheets/(?P<spreadsheet>[^/]+)/values:batchClear', 'sheets',
+     'sheets.spreadsheets.values.batchClear'),
+]
+ROUTES = [(method, re.compile(f'/{path}'), api, method_id) for method, path, api, method_id in ROUTES]
+
+class ApiError(Exception):
+    """Error con el formato de respuesta de las APIs de Google."""
+
+    def __init__(self, status, message, reason, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+    def body(self):
+        return {'error': {'code': self.status, 'message': str(self),
+                          'errors': [{'message': str(self), 'domain': 'global', 'reason': self.reason}],
+                          'status': http.HTTPStatus(self.status).name}}
+
+# --- RESPUESTA PARCIAL (parámetro fields) ---
+
+_FIELD_NAME = re.compile(r'[^,/()]+')
+
+@functools.lru_cache(maxsize=64)
+def parse_fields(spec):
+    """'id,payload(headers,body/data)' -> {'id': {}, 'payload': {'headers': {}, 'body': {'data': {}}}}.
+
+    Un dict vacío significa "el campo completo"."""
+    mask, _ = _parse_field_list(spec, 0)
+    return mask
+
+def _parse_field_list(spec, pos):
+    mask = {}
+    while pos < len(spec):
+        path = []
+        while True:
+            match = _FIELD_NAME.match(spec, pos)
+            if not match:
+                raise ApiError(400, f'Invalid field selection {spec}', 'invalidParameter')
+            path.append(match.group().strip())
+            pos = match.end()
+            if pos < len(spec) and spec[pos] == '/':
+                pos += 1
+                continue
+            break
+        node = mask
+        for name in path[:-1]:
+            node = node.setdefault(name, {})
+        node = node.setdefault(path[-1], {})
+        if pos < len(spec) and spec[pos] == '(':
+            sub_mask, pos = _parse_field_list(spec, pos + 1)
+            node.update(sub_mask)
+            pos += 1 # El ')'
+        if pos < len(spec) and spec[pos] == ')':
+            return mask, pos
+        pos += 1 # La ','
+    return mask, pos
+
+def apply_fields(value, mask):
+    """Deja de `value` solo los campos de la máscara (las listas se filtran elemento por elemento)."""
+    if not mask:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, mask) for item in value]
+    if isinstance(value, dict):
+        return {name: apply_fields(value[name], sub_mask) for name, sub_mask in mask.items() if name in value}
+    return value
+
+# --- CUOTAS ---
+
+class QuotaWindow:
+    """Token bucket sin espera: si no alcanza la cuota, dice cuántos segundos faltan."""
+
+    def __init__(self, units_per_minute, burst_seconds):
+        self.rate = units_per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_consume(self, units):
+        """Descuenta `units`; devuelve 0 si alcanzó o los segundos a esperar si no."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= units:
+                self._tokens -= units
+                return 0
+            return (units - self._tokens) / self.rate
+
+# --- BUZÓN ---
+
+class FakeMailbox:
+    """Estado del buzón falso: etiquetas, correos visibles y filas agregadas a Sheets."""
+
+    def __init__(self, count, seed, arrival_rate=0, sheets_csv=None):
+        self.seed = seed
+        self.initial_count = count
+        self.arrival_rate = arrival_rate
+        self.started = time.monotonic()
+        self.labels = dict(INITIAL_LABELS)
+        self._message_labels = {} # índice -> etiquetas, solo de los correos modificados
+        self._lock = threading.Lock()
+        # Día de cada correo (ordinal), para after:/before: sin armar el correo entero
+        self._days = array.array('l')
+        self._sheets_csv = open(sheets_csv, 'a', newline='', encoding='utf-8') if sheets_csv else None
+        self.rows_appended = 0
+        self.messages_modified = 0
+        self.visible_count()
+
+    def close(self):
+        if self._sheets_csv:
+            self._sheets_csv.close()
+
+    def visible_count(self):
+        """Correos que ya "llegaron" al buzón (con --arrival-rate crece con el tiempo)."""
+        count = self.initial_count + int((time.monotonic() - self.started) * self.arrival_rate)
+        with self._lock:
+            for index in range(len(self._days), count):
+                self._days.append(message_date(index, self.seed).date().toordinal())
+        return count
+
+    def labels_of(self, index):
+        return self._message_labels.get(index, DEFAULT_MESSAGE_LABELS)
+
+    def resolve_index(self, msg_id):
+        index = message_index(msg_id)
+        if index is None or index >= self.visible_count():
+            raise ApiError(404, 'Requested entity was not found.', 'notFound')
+        return index
+
+    def resolve_label(self, name):
+        """ID de la etiqueta, buscada por ID, nombre o nombre en formato de búsqueda."""
+        def _normalize(label_name):
+            return re.sub(r'[/\s]+', '-', label_name.strip().lower())
+        for label_id, label_name in self.labels.items():
+            if name in (label_id, label_name) or _normalize(name) == _normalize(label_name):
+                return label_id
+        return None
+
+    def create_label(self, name):
+        with self._lock:
+            if name in self.labels.values():
+                raise ApiError(409, 'Label name exists or conflicts', 'duplicate')
+            label_id = f'Label_{len(self.labels)}'
+            self.labels[label_id] = name
+        return label_id
+
+    def modify(self, indexes, add_label_ids, remove_label_ids):
+        for label_id in list(add_label_ids) + list(remove_label_ids):
+            if label_id not in self.labels:
+                raise ApiError(400, f'Invalid label: {label_id}', 'invalidArgument')
+        with self._lock:
+            for index in indexes:
+                labels = (self.labels_of(index) | set(add_label_ids)) - set(remove_label_ids)
+                self._message_labels[index] = frozenset(labels)
+            self.messages_modified += len(indexes)
+
+    def search(self, query, start, limit):
+        """Índices que cumplen la búsqueda a partir de `start`; devuelve (índices, próximo índice o None)."""
+        required, excluded, after, before = self._parse_query(query)
+        if None in required:
+            return [], None # Etiqueta inexistente: Gmail no devuelve nada
+        count = self.visible_count()
+        found = []
+        index = start
+        while index < count and len(found) < limit:
+            labels = self.labels_of(index)
+            if (required <= labels and not excluded & labels
+                    and (after is None or self._days[index] >= after)
+                    and (before is None or self._days[index] < before)):
+                found.append(index)
+            index += 1
+        return found, index if index < count else None
+
+    def _parse_query(self, query):
+        """Entiende label:, -label:, is:unread, after: y before:; ignora el resto."""
+        required, excluded, after, before = set(), set(), None, None
+        for negated, operator, value in re.findall(r'(-?)(\w+):("[^"]*"|\S+)', query or ''):
+            value = value.strip('"')
+            if operator == 'label':
+                (excluded if negated else required).add(self.resolve_label(value))
+            elif operator == 'is' and value == 'unread':
+                (excluded if negated else required).add('UNREAD')
+            elif operator in ('after', 'before'):
+                day = datetime.datetime.strptime(value, '%Y/%m/%d').date().toordinal()
+                if operator == 'after':
+                    after = day
+                else:
+                    before = day
+        excluded.discard(None)
+        return required, excluded, after, before
+
+    def append_rows(self, rows):
+        with self._lock:
+            self.rows_appended += len(rows)
+            if self._sheets_csv:
+                csv.writer(self._sheets_csv).writerows(rows)
+                self._sheets_csv.flush()
+
+# --- API ---
+
+class FakeGoogleApi:
+    """Atiende los requests (sueltos o dentro de un batch): cuotas, errores inyectados y cada método."""
+
+    def __init__(self, mailbox, args):
+        self.mailbox = mailbox
+        self.args = args
+        self.quotas = {}
+        if args.gmail_quota:
+            self.quotas['gmail'] = QuotaWindow(args.gmail_quota, args.quota_burst)
+        if args.sheets_quota:
+            self.quotas['sheets'] = QuotaWindow(args.sheets_quota, args.quota_burst)
+        self._rng = random.Random(args.seed)
+        self.stats = collections.Counter()
+
+    def simulate_latency(self):
+        if self.args.latency_ms or self.args.jitter_ms:
+            delay = self.args.latency_ms + self._rng.uniform(-self.args.jitter_ms, self.args.jitter_ms)
+            time.sleep(max(delay, 0) / 1000)
+
+    def dispatch(self, method, target, body):
+        """Atiende un request; devuelve (status, headers, cuerpo JSON como dict o None)."""
+        url = urllib.parse.urlsplit(target)
+        params = urllib.parse.parse_qs(url.query)
+        for route_method, pattern, api, method_id in ROUTES:
+            match = pattern.fullmatch(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {}, ApiError(404, f'Unknown method {method} {url.path}', 'notFound').body()
+
+        self.stats[method_id] += 1
+        try:
+            self._inject_errors(api)
+            self._consume_quota(api, method_id)
+            handler = getattr(self, '_' + method_id.replace('.', '_'))
+            result = handler(match.groupdict(), params, json.loads(body) if body else {})
+        except ApiError as error:
+            self.stats[f'error {error.status}'] += 1
+            return error.status, error.headers, error.body()
+        if result is None:
+            return 204, {}, None
+        if 'fields' in params:
+            result = apply_fields(result, parse_fields(params['fields'][0]))
+        return 200, {}, result
+
+    def _inject_errors(self, api):
+        draw = self._rng.random()
+        if draw < self.args.rate_limit_rate:
+            self.stats['429 inyectados'] += 1
+            raise ApiError(429, 'Too many concurrent requests for user.', 'rateLimitExceeded',
+                           {'Retry-After': str(self.args.retry_after)})
+        if draw < self.args.rate_limit_rate + self.args.error_rate:
+            self.stats['5xx inyectados'] += 1
+            status = self._rng.choice((500, 503))
+            raise ApiError(status, 'Backend Error', 'backendError')
+
+    def _consume_quota(self, api, method_id):
+        window = self.quotas.get(api)
+        wait = window.try_consume(QUOTA_COSTS.get(method_id, 1)) if window else 0
+        if wait:
+            self.stats[f'cuota excedida ({api})'] += 1
+            raise ApiError(429, 'User-rate limit exceeded.', 'rateLimitExceeded',
+                           {'Retry-After': str(math.ceil(wait))})
+
+    # Gmail
+
+    def _gmail_users_labels_list(self, route, params, body):
+        return {'labels': [{'id': label_id, 'name': name, 'type': 'system' if label_id == name else 'user'}
+                           for label_id, name in self.mailbox.labels.items()]}
+
+    def _gmail_users_labels_create(self, route, params, body):
+        if not body.get('name'):
+            raise ApiError(400, 'Invalid label name', 'invalidArgument')
+        label_id = self.mailbox.create_label(body['name'])
+        return {'id': label_id, 'name': body['name'], 'type': 'user',
+                'labelListVisibility': body.get('labelListVisibility', 'labelShow'),
+                'messageListVisibility': body.get('messageListVisibility', 'show')}
+
+    def _gmail_users_messages_list(self, route, params, body):
+        limit = min(int(params.get('maxResults', [LIST_PAGE_SIZE])[0]), LIST_PAGE_MAX)
+        start = int(params.get('pageToken', ['0'])[0])
+        indexes, next_index = self.mailbox.search(params.get('q', [''])[0], start, limit)
+        result = {'messages': [{'id': message_id(index), 'threadId': message_id(index)} for index in indexes],
+                  'resultSizeEstimate': len(indexes)}
+        if not indexes:
+            del result['messages'] # Gmail omite la lista cuando está vacía
+        if next_index is not None:
+            result['nextPageToken'] = str(next_index)
+        return result
+
+    def _gmail_users_messages_get(self, route, params, body):
+        index = self.mailbox.resolve_index(route['id'])
+        message, _ = message_at(index, self.mailbox.seed)
+        message['labelIds'] = sorted(self.mailbox.labels_of(index))
+        message['historyId'] = str(HISTORY_BASE + index + 1)
+        message_format = params.get('format', ['full'])[0]
+        if message_format in ('metadata', 'minimal') and 'payload' in message:
+            payload = message.pop('payload')
+            if message_format == 'metadata':
+                wanted = {name.lower() for name in params.get('metadataHeaders', [])}
+                message['payload'] = {
+                    'partId': '', 'mimeType': payload['mimeType'], 'filename': '',
+                    'headers': [header for header in payload['headers'] if not wanted or header['name'].lower() in wanted],
+                    'body': {'size': 0}}
+        return message
+
+    def _gmail_users_messages_modify(self, route, params, body):
+        index = self.mailbox.resolve_index(route['id'])
+        self.mailbox.modify([index], body.get('addLabelIds', []), body.get('removeLabelIds', []))
+        return {'id': route['id'], 'threadId': route['id'], 'labelIds': sorted(self.mailbox.labels_of(index))}
+
+    def _gmail_users_messages_batchModify(self, route, params, body):
+        ids = body.get('ids', [])
+        if len(ids) > BATCH_MODIFY_MAX:
+            raise ApiError(400, f'Too many ids: {len(ids)} (max {BATCH_MODIFY_MAX})', 'invalidArgument')
+        indexes = [self.mailbox.resolve_index(msg_id) for msg_id in ids]
+        self.mailbox.modify(indexes, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+        return None
+
+    def _gmail_users_history_list(self, route, params, body):
+        start_history_id = int(params['startHistoryId'][0])
+        if start_history_id < HISTORY_BASE:
+            raise ApiError(404, 'Requested entity was not found.', 'notFound')
+        label_id = params.get('labelId', [None])[0]
+        limit = min(int(params.get('maxResults', [HISTORY_PAGE_SIZE])[0]), LIST_PAGE_MAX)
+        count = self.mailbox.visible_count()
+        index = int(params.get('pageToken', [start_history_id - HISTORY_BASE])[0])
+        history = []
+        while index < count and len(history) < limit:
+            labels = self.mailbox.labels_of(index)
+            if not label_id or label_id in labels:
+                message = {'id': message_id(index), 'threadId': message_id(index), 'labelIds': sorted(labels)}
+                history.append({'id': str(HISTORY_BASE + index + 1), 'messages': [message],
+                                'messagesAdded': [{'message': message}]})
+            index += 1
+        result = {'historyId': str(HISTORY_BASE + count)}
+        if history:
+            result['history'] = history
+        if index < count:
+            result['nextPageToken'] = str(index)
+        return result
+
+    def _gmail_users_getProfile(self, route, params, body):
+        count = self.mailbox.visible_count()
+        return {'emailAddress': 'usuario@gmail.com', 'messagesTotal': count, 'threadsTotal': count,
+                'historyId': str(HISTORY_BASE + count)}
+
+    def _gmail_users_messages_send(self, route, params, body):
+        if not body.get('raw'):
+            raise ApiError(400, "'raw' RFC822 payload message string or uploading message via /upload/* URL required",
+                           'invalidArgument')
+        sent_id = f'{uuid.uuid4().int >> 64:x}'
+        return {'id': sent_id, 'threadId': sent_id, 'labelIds': ['SENT']}
+
+    # Sheets
+
+    def _sheets_spreadsheets_values_append(self, route, params, body):
+        rows = body.get('values', [])
+        self.mailbox.append_rows(rows)
+        sheet_range = urllib.parse.unquote(route['range'])
+        updates = {'spreadsheetId': route['spreadsheet'], 'updatedRange': sheet_range,
+                   'updatedRows': len(rows), 'updatedColumns': max((len(row) for row in rows), default=0),
+                   'updatedCells': sum(len(row) for row in rows)}
+        return {'spreadsheetId': route['spreadsheet'], 'tableRange': sheet_range, 'updates': updates}
+
+    def _sheets_spreadsheets_values_get(self, route, params, body):
+        sheet_range = urllib.parse.unquote(route['range'])
+        if sheet_range.startswith('MapeoComercios'):
+            return {'range': sheet_range, 'majorDimension': 'ROWS', 'values': MAPEO_COMERCIOS}
+        if sheet_range.startswith('Presupuesto'):
+            return {'range': sheet_range, 'majorDimension': 'ROWS', 'values': PRESUPUESTO}
+        raise ApiError(400, f'Unable to parse range: {sheet_range}', 'badRequest')
+
+    def _sheets_spreadsheets_values_batchUpdate(self, route, params, body):
+        # La hoja de resumen no se guarda: solo se cuentan las celdas escritas
+        data = body.get('data', [])
+        cells = sum(len(row) for block in data for row in block.get('values', []))
+        self.stats['celdas de resumen'] += cells
+        return {'spreadsheetId': route['spreadsheet'], 'totalUpdatedCells': cells,
+                'responses': [{'updatedRange': block.get('range')} for block in data]}
+
+    def _sheets_spreadsheets_values_batchClear(self, route, params, body):
+        return {'spreadsheetId': route['spreadsheet'], 'clearedRanges': body.get('ranges', [])}
+
+    # Batch
+
+    def dispatch_batch(self, content_type, body):
+        """Atiende un batch multipart/mixed; devuelve (content-type, cuerpo) de la respuesta multipart."""
+        container = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        parts = container.get_payload() if container.is_multipart() else []
+        if not parts or len(parts) > BATCH_MAX:
+            raise ApiError(400, f'A batch must have between 1 and {BATCH_MAX} requests', 'invalidArgument')
+        self.stats['batch'] += 1
+        boundary = f'batch_{uuid.uuid4().hex}'
+        chunks = []
+        for part in parts:
+            request_head, _, request_body = (re.split(r'(\r?\n\r?\n)', part.get_payload(), 1) + ['', ''])[:3]
+            method, target = request_head.split(None, 2)[:2]
+            status, headers, result = self.dispatch(method, target, request_body.strip().encode())
+            response_lines = [f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}',
+                              'Content-Type: application/json; charset=UTF-8']
+            response_lines += [f'{name}: {value}' for name, value in headers.items()]
+            content_id = part.get('Content-ID', '').strip('<>')
+            chunks.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                          f'Content-ID: <response-{content_id}>\r\n\r\n'
+                          + '\r\n'.join(response_lines) + '\r\n\r\n'
+                          + (json.dumps(result) if result is not None else '') + '\r\n')
+        chunks.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(chunks).encode()
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Conexiones persistentes, como las de httplib2
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        api = self.server.api
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        api.simulate_latency()
+        headers = {}
+        try:
+            if urllib.parse.urlsplit(self.path).path == '/_fake/stats':
+                status, result = 200, self.server.stats()
+            elif urllib.parse.urlsplit(self.path).path == '/batch':
+                status = 200
+                content_type, payload = api.dispatch_batch(self.headers.get('Content-Type', ''), body)
+                return self._send(status, {'Content-Type': content_type}, payload)
+            else:
+                status, headers, result = api.dispatch(method, self.path, body)
+        except ApiError as error:
+            status, headers, result = error.status, error.headers, error.body()
+        payload = json.dumps(result).encode() if result is not None else b''
+        self._send(status, dict(headers, **{'Content-Type': 'application/json; charset=UTF-8'}), payload)
+
+    def _send(self, status, headers, payload):
+        if len(payload) >= GZIP_MIN_BYTES and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload, compresslevel=GZIP_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.api.stats['bytes enviados'] += len(payload)
+
+    def log_message(self, format, *args):
+        pass # Un log por request tapa todo en una prueba de carga
+
+class FakeGoogleServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api):
+        super().__init__(address, FakeGoogleHandler)
+        self.api = api
+
+    def stats(self):
+        mailbox = self.api.mailbox
+        return {'correos': mailbox.visible_count(), 'correos_modificados': mailbox.messages_modified,
+                'filas_agregadas': mailbox.rows_appended, 'requests': dict(self.api.stats)}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--messages', type=int, default=10000, help='Correos sintéticos en el buzón al arrancar.')
+    parser.add_argument('--arrival-rate', type=float, default=0, help='Correos nuevos por segundo mientras corre.')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latencia agregada a cada request HTTP.')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Variación aleatoria máxima (+/-) de la latencia.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fracción de requests que fallan con 500/503.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0, help='Fracción de requests que fallan con 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After (segundos) de los 429 inyectados.')
+    parser.add_argument('--gmail-quota', type=float, default=0,
+                        help='Unidades de cuota de Gmail por minuto (por ejemplo 15000; por defecto sin límite).')
+    parser.add_argument('--sheets-quota', type=float, default=0,
+                        help='Requests de Sheets por minuto (por ejemplo 60; por defecto sin límite).')
+    parser.add_argument('--quota-burst', type=float, default=1, help='Segundos de cuota que se pueden gastar de golpe.')
+    parser.add_argument('--sheets-csv', help='Archivo CSV donde agregar las filas que llegan a Sheets.')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    mailbox = FakeMailbox(args.messages, args.seed, args.arrival_rate, args.sheets_csv)
+    server = FakeGoogleServer((args.host, args.port), FakeGoogleApi(mailbox, args))
+    print(f'Gmail/Sheets falso con {args.messages} correos en http://{args.host}:{server.server_port}/', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        mailbox.close()
+        print(json.dumps(server.stats(), indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""Generador de correos sintéticos con el formato de la API de Gmail (messages.get, format='full').
+
+Cada correo sale junto con el resultado que debe devolver extract_data_from_email
+(el "golden"): los datos del consumo, o None para los casos que no se pueden parsear.
+Cubre los formatos reales que recibe el script:
+
+    bbva_html       multipart/alternative con text/plain genérico y el HTML con la tabla
+    bbva_nested     el mismo HTML dentro de multipart/mixed > multipart/related, con adjunto
+    bbva_single     un solo text/html, sin partes (payload.body directo)
+    nx_plain        aviso de Naranja X en text/plain (más su versión HTML)
+    nx_usd          aviso de Naranja X de un consumo en dólares
+    nx_latin1       text/plain codificado en latin-1 (con acentos)
+    promo_banco     publicidad de BBVA (remitente conocido, sin tabla de consumo)
+    promo_otro      publicidad de un remitente desconocido
+    malformed_b64   cuerpo con base64 inválido
+    malformed_tabla aviso de BBVA al que le falta la fila del importe
+    sin_payload     mensaje sin payload
+
+Uso como módulo: iter_messages(cantidad, seed) genera tuplas (message, esperado), y
+message_at(índice, seed) arma un correo suelto (siempre el mismo para el mismo índice),
+como lo necesita el servidor falso de Gmail (fake_google_server.py).
+Uso desde la línea de comandos (escribe JSONL con {"message": ..., "expected": ...}):
+    python benchmarks/fixtures.py --count 1000 --output fixtures.jsonl
+o un mbox como el de Google Takeout (para probar --import; sin_payload no se incluye):
+    python benchmarks/fixtures.py --count 100000 --mbox takeout.mbox
+"""
+import argparse
+import base64
+import datetime
+import email.header
+import email.utils
+import json
+import random
+import re
+import sys
+
+COMERCIOS = ['MERCADOLIBRE', 'COTO CICSA', 'YPF SERVICENTRO 1234', 'MERPAGO*KIOSCO LA ESQUINA',
+             'FARMACITY SUC 45', 'NETFLIX.COM', 'DIA TIENDA 123', 'RAPPI ARG', 'EASY SAN ISIDRO',
+             'STARBUCKS PALERMO', 'SPOTIFY', 'CARREFOUR EXPRESS', 'UBER *TRIP', 'PEDIDOSYA PROPINAS']
+COMERCIOS_LATIN1 = ['PANADERÍA SAN JOSÉ', 'CAFÉ DEL ÁNGEL', 'LIBRERÍA EL ÑANDÚ', 'HELADERÍA LA BOMBÓN']
+
+# Los IDs de Gmail son 16 dígitos hexadecimales; los generados son consecutivos desde acá
+MESSAGE_ID_BASE = 0x18f0000000000000
+
+MESES = ['ENE', 'FEB', 'MAR', 'ABR', 'MAY', 'JUN', 'JUL', 'AGO', 'SEP', 'OCT', 'NOV', 'DIC']
+
+# Proporción de cada tipo de correo en la mezcla generada
+KIND_WEIGHTS = {
+    'bbva_html': 30, 'bbva_nested': 10, 'bbva_single': 5,
+    'nx_plain': 25, 'nx_usd': 4, 'nx_latin1': 5,
+    'promo_banco': 7, 'promo_otro': 7,
+    'malformed_b64': 3, 'malformed_tabla': 3, 'sin_payload': 1,
+}
+
+STYLE_BLOCK = ''.join(
+    f'.c{i} {{ font-family: Arial, Helvetica, sans-serif; font-size: {10 + i % 8}px; color: #0{i % 10}4{i % 7}9E; '
+    f'padding: {i % 12}px; line-height: 1.{i % 9}; }}\n' for i in range(120))
+
+LEGAL_TEXT = (
+    'Este mensaje fue enviado automáticamente, por favor no lo respondas. BBVA nunca te va a pedir '
+    'por correo electrónico tus claves, números de tarjeta ni códigos de seguridad. Si recibiste un '
+    'mensaje sospechoso, comunicate con nosotros a través de los canales oficiales. ') * 12
+
+def build_bbva_html(rng, fecha, comercio, moneda, importe, with_importe=True):
+    """Arma un aviso de compra de BBVA con la tabla de datos entre tablas de maquetación."""
+    rows = [('Fecha', fecha), ('Hora', f'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}'),
+            ('Comercio', comercio), ('Importe', f'{moneda} {importe}'),
+            ('Tarjeta', f'terminada en {rng.randint(1000, 9999)}'), ('Cuotas', str(rng.choice([1, 3, 6, 12])))]
+    if not with_importe:
+        rows = [row for row in rows if row[0] != 'Importe']
+    data_rows = ''.join(
+        f'<tr><td class="c{i}" style="padding:8px 0;border-bottom:1px solid #e5e5e5;">\n {label} \n</td>'
+        f'<td class="c{i + 1}" align="right" style="padding:8px 0;"><b>{value}</b></td></tr>\n'
+        for i, (label, value) in enumerate(rows))
+    return _bbva_layout(f"""<h1 style="font-size:22px;">Hola,</h1>
+<p>Te informamos que realizaste una compra con tu tarjeta de crédito. Estos son los detalles:</p></td></tr>
+<tr><td style="padding:0 40px;"><table width="100%" cellpadding="0" cellspacing="0" border="0">
+{data_rows}</table>""")
+
+def build_bbva_promo_html():
+    """Publicidad de BBVA: misma maquetación, sin tabla de consumo."""
+    return _bbva_layout("""<h1 style="font-size:22px;">¡Aprovechá 6 cuotas sin interés!</h1>
+<p>Este fin de semana, en supermercados adheridos, pagá con tu tarjeta de crédito y obtené
+hasta 25% de reintegro. Tope de reintegro por cuenta: ARS 5.000.</p>""")
+
+def _bbva_layout(content):
+    banner = ''.join(f'<td><a href="https://www.bbva.com.ar/promo/{i}"><img src="https://www.bbva.com.ar/img/{i}.png" '
+                     f'alt="Promo {i}" width="120"></a></td>' for i in range(6))
+    return f"""<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"><title>BBVA</title>
+<style type="text/css">{STYLE_BLOCK}</style></head>
+<body style="margin:0;padding:0;background-color:#f4f4f4;">
+<div style="display:none;">Realizaste una compra con tu tarjeta</div>
+<table width="100%" cellpadding="0" cellspacing="0" border="0"><tr><td align="center">
+<table width="600" cellpadding="0" cellspacing="0" border="0" style="background:#ffffff;">
+<tr><td style="background:#072146;padding:24px;"><img src="https://www.bbva.com.ar/logo.png" alt="BBVA" width="90"></td></tr>
+<tr><td style="padding:32px 40px 8px 40px;" class="c3">{content}</td></tr>
+<tr><td style="padding:24px 40px;" class="c7"><p>Si no reconocés esta compra, llamanos al 0800-999-2282 las 24 horas.</p></td></tr>
+<tr><td><table><tr>{banner}</tr></table></td></tr>
+<tr><td style="padding:24px 40px;font-size:11px;color:#666666;" class="c9"><p>{LEGAL_TEXT}</p></td></tr>
+</table></td></tr></table></body></html>"""
+
+def build_nx_text(dia, mes, importe, comercio, tarjeta, ultimos, usd=False):
+    """Texto plano de un aviso de consumo de Naranja X."""
+    moneda = 'Consumo en dólares\nUSD ' if usd else 'Consumo en PESOS\n'
+    return (f"¡Hola!\nRegistramos un consumo con tu tarjeta el {dia}/{mes}.\n\n{moneda}${importe}\n"
+            f"{comercio}\nTitular - JUAN PEREZ\nTarjeta {tarjeta} terminada en {ultimos}\n\n"
+            "Si no reconocés este consumo comunicate con nosotros desde la app.\n"
+            "Naranja X - Este es un correo automático, no lo respondas.")
+
+def b64url(text, encoding='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(encoding)).decode('ascii')
+
+def _part(mime_type, text, encoding='utf-8'):
+    data = b64url(text, encoding)
+    return {'partId': '', 'mimeType': mime_type, 'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset={encoding}'},
+                        {'name': 'Content-Transfer-Encoding', 'value': 'base64'}],
+            'body': {'size': len(data) * 3 // 4, 'data': data}}
+
+def _multipart(mime_type, parts):
+    return {'partId': '', 'mimeType': mime_type, 'filename': '', 'headers': [], 'body': {'size': 0}, 'parts': parts}
+
+def _attachment(rng):
+    return {'partId': '', 'mimeType': 'image/png', 'filename': 'logo.png',
+            'headers': [{'name': 'Content-Disposition', 'value': 'inline; filename="logo.png"'}],
+            'body': {'attachmentId': f'ANGjdJ{rng.getrandbits(64):016x}', 'size': rng.randint(2000, 40000)}}
+
+def _number_parts(part, prefix=''):
+    for i, sub_part in enumerate(part.get('parts', [])):
+        sub_part['partId'] = f'{prefix}{i}'
+        _number_parts(sub_part, f'{prefix}{i}.')
+
+def _headers(msg_id, sender, subject, date):
+    return [{'name': 'Delivered-To', 'value': 'usuario@gmail.com'},
+            {'name': 'Received', 'value': f'by 2002:a05:6a10:{date.microsecond:x} with SMTP id; {email.utils.format_datetime(date)}'},
+            {'name': 'From', 'value': sender}, {'name': 'To', 'value': 'usuario@gmail.com'},
+            {'name': 'Subject', 'value': subject}, {'name': 'Date', 'value': email.utils.format_datetime(date)},
+            {'name': 'MIME-Version', 'value': '1.0'}, {'name': 'Message-ID', 'value': f'<{msg_id}.{date.timestamp():.0f}@mail>'}]
+
+def _amount(rng):
+    """Importe en formato argentino y su valor como float."""
+    entero, centavos = rng.randint(1, 250000), rng.randint(0, 99)
+    return f'{entero:,}'.replace(',', '.') + f',{centavos:02d}', float(f'{entero}.{centavos:02d}')
+
+def message_id(index):
+    return f'{MESSAGE_ID_BASE + index:016x}'
+
+def message_index(msg_id):
+    """Índice del correo con ese ID, o None si el ID no es de un correo generado."""
+    try:
+        index = int(msg_id, 16) - MESSAGE_ID_BASE
+    except ValueError:
+        return None
+    return index if index >= 0 else None
+
+def _random_date(rng):
+    return datetime.datetime(rng.randint(2021, 2025), rng.randint(1, 12), rng.randint(1, 28),
+                             rng.randint(0, 23), rng.randint(0, 59), tzinfo=datetime.timezone(datetime.timedelta(hours=-3)))
+
+def build_message(kind, index, rng):
+    """Arma un correo del tipo `kind`; devuelve (message, esperado)."""
+    msg_id = message_id(index)
+    date = _random_date(rng) # Siempre lo primero que se sortea (ver message_date)
+    expected = None
+
+    if kind == 'sin_payload':
+        return {'id': msg_id, 'threadId': msg_id, 'labelIds': ['UNREAD'], 'sizeEstimate': 120}, None
+
+    if kind.startswith('bbva') or kind in ('promo_banco', 'malformed_b64', 'malformed_tabla'):
+        sender = 'BBVA <avisos@bbva.com.ar>'
+        tarjeta = rng.choice(['VISA', 'MASTERCARD'])
+        subject = f'Compra con tu tarjeta {tarjeta.title()}'
+        fecha = f'{date.day:02d}/{date.month:02d}/{date.year}'
+        comercio = rng.choice(COMERCIOS)
+        moneda = rng.choice(['ARS', 'ARS', 'ARS', 'USD'])
+        importe_str, importe = _amount(rng)
+        html_text = build_bbva_html(rng, fecha, comercio, moneda, importe_str, with_importe=kind != 'malformed_tabla')
+        plain = 'Para ver este correo correctamente, abrilo en un cliente que muestre HTML.'
+        if kind == 'promo_banco':
+            sender, subject = 'BBVA <novedades@bbva.com.ar>', 'Este finde, 6 cuotas sin interés'
+            html_text = build_bbva_promo_html()
+        elif kind in ('bbva_html', 'bbva_nested', 'bbva_single'):
+            expected = {'fecha': fecha, 'banco': 'BBVA', 'comercio': comercio, 'tarjeta': tarjeta,
+                        'importe': importe, 'moneda': moneda}
+
+        if kind == 'bbva_single':
+            payload = _part('text/html', html_text)
+        else:
+            payload = _multipart('multipart/alternative', [_part('text/plain', plain), _part('text/html', html_text)])
+            if kind == 'malformed_b64':
+                payload['parts'][1]['body']['data'] = '%%%' + payload['parts'][1]['body']['data'][:201] + '%%%'
+            if kind == 'bbva_nested':
+                payload = _multipart('multipart/mixed', [
+                    _multipart('multipart/related', [payload, _attachment(rng)]), _attachment(rng)])
+    elif kind == 'promo_otro':
+        sender, subject = 'Mercado Libre <ofertas@mercadolibre.com.ar>', '¡Últimas horas de Hot Sale!'
+        payload = _multipart('multipart/alternative', [
+            _part('text/plain', 'Aprovechá descuentos de hasta 50%. ' * 20),
+            _part('text/html', _bbva_layout('<h1>Hot Sale</h1>').replace('BBVA', 'Mercado Libre'))])
+    else: # Naranja X
+        sender = 'Naranja X <avisos@naranjax.com>'
+        subject = 'Registramos un consumo con tu tarjeta'
+        tarjeta = rng.choice(['VISA', 'MASTERCARD'])
+        comercio = rng.choice(COMERCIOS_LATIN1 if kind == 'nx_latin1' else COMERCIOS)
+        importe_str, importe = _amount(rng)
+        text = build_nx_text(f'{date.day}', MESES[date.month - 1].title(), importe_str, comercio, tarjeta,
+                             rng.randint(1000, 9999), usd=kind == 'nx_usd')
+        encoding = 'latin-1' if kind == 'nx_latin1' else 'utf-8'
+        html_text = '<html><body>' + text.replace('\n', '<br>\n') + '</body></html>'
+        payload = _multipart('multipart/alternative', [_part('text/plain', text, encoding),
+                                                       _part('text/html', html_text, encoding)])
+        expected = {'fecha': f'{date.day:02d}/{date.month:02d}/{date.year}', 'banco': 'Naranja X',
+                    'comercio': comercio, 'tarjeta': tarjeta, 'importe': importe,
+                    'moneda': 'USD' if kind == 'nx_usd' else 'ARS'}
+
+    _number_parts(payload)
+    payload['headers'] = _headers(msg_id, sender, subject, date) + payload['headers']
+    message = {'id': msg_id, 'threadId': msg_id, 'labelIds': ['UNREAD', 'Label_1', 'CATEGORY_UPDATES'],
+               'snippet': subject[:100], 'historyId': str(900000 + index),
+               'internalDate': str(int(date.timestamp() * 1000)), 'payload': payload,
+               'sizeEstimate': len(json.dumps(payload))}
+    return message, expected
+
+def _message_rng(index, seed, kinds):
+    """Generador aleatorio propio de cada correo, ya con su tipo sorteado; devuelve (kind, rng)."""
+    rng = random.Random(seed * 1_000_003 + index)
+    weights = {kind: weight for kind, weight in KIND_WEIGHTS.items() if not kinds or kind in kinds}
+    return rng.choices(list(weights), list(weights.values()))[0], rng
+
+def message_at(index, seed=1234, kinds=None):
+    """Arma el correo número `index` de la mezcla; devuelve (message, esperado)."""
+    kind, rng = _message_rng(index, seed, kinds)
+    return build_message(kind, index, rng)
+
+def message_date(index, seed=1234, kinds=None):
+    """Fecha del correo número `index`, sin armar el resto del correo."""
+    return _random_date(_message_rng(index, seed, kinds)[1])
+
+def iter_messages(count, seed=1234, kinds=None):
+    """Genera `count` tuplas (message, esperado), con la mezcla de KIND_WEIGHTS (o solo `kinds`)."""
+    for index in range(count):
+        yield message_at(index, seed, kinds)
+
+def _encode_header(value):
+    return value if value.isascii() else email.header.Header(value, 'utf-8').encode()
+
+def _rfc822_part(part, lines):
+    """Agrega a `lines` los headers y el contenido MIME de una parte con formato de Gmail."""
+    headers = [(header['name'], header['value']) for header in part.get('headers', [])]
+    if part['mimeType'].startswith('multipart/'):
+        boundary = f'==part{id(part):x}=='
+        headers.append(('Content-Type', f'{part["mimeType"]}; boundary="{boundary}"'))
+        lines += [f'{name}: {_encode_header(value)}' for name, value in headers] + ['']
+        for sub_part in part['parts']:
+            lines.append(f'--{boundary}')
+            _rfc822_part(sub_part, lines)
+        lines.append(f'--{boundary}--')
+        return
+    if not any(name.lower() == 'content-type' for name, _ in headers):
+        headers.append(('Content-Type', part['mimeType']))
+    if not any(name.lower() == 'content-transfer-encoding' for name, _ in headers):
+        headers.append(('Content-Transfer-Encoding', 'base64'))
+    lines += [f'{name}: {_encode_header(value)}' for name, value in headers] + ['']
+    data = part['body'].get('data')
+    if data is None: # Adjunto: Gmail solo da el attachmentId
+        content = base64.b64encode(b'\x89PNG\r\n' + bytes(part['body']['size'] % 200)).decode()
+    else:
+        try:
+            content = base64.b64encode(base64.urlsafe_b64decode(data)).decode()
+        except ValueError: # malformed_b64: se copia tal cual, igual de roto
+            content = data
+    lines += [content[i:i + 76] for i in range(0, len(content), 76)]
+
+def to_rfc822(message):
+    """Convierte un correo con formato de Gmail a bytes RFC 822, o None si no tiene payload."""
+    if 'payload' not in message:
+        return None
+    lines = ['X-Gmail-Labels: Tarjetas/Consumos Tarjeta,Unread']
+    _rfc822_part(message['payload'], lines)
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def write_mbox(out, messages):
+    """Escribe los correos en formato mboxrd (escapando las líneas que empiezan con "From ")."""
+    for message, _ in messages:
+        raw = to_rfc822(message)
+        if raw is None:
+            continue
+        out.write(b'From 1234567890123456789@xxx Thu Jan 01 00:00:00 +0000 2024\n')
+        out.write(re.sub(rb'^(>*From )', rb'>\1', raw, flags=re.MULTILINE))
+        out.write(b'\n')
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Genera correos sintéticos (JSONL) con su resultado esperado.')
+    arg_parser.add_argument('--count', type=int, default=1000)
+    arg_parser.add_argument('--seed', type=int, default=1234)
+    arg_parser.add_argument('--output', help='Archivo JSONL de salida (por defecto, la salida estándar).')
+    arg_parser.add_argument('--mbox', help='Escribe un archivo mbox en lugar de JSONL.')
+    args = arg_parser.parse_args()
+    if args.mbox:
+        with open(args.mbox, 'wb') as out:
+            write_mbox(out, iter_messages(args.count, args.seed))
+        return
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for message, expected in iter_messages(args.count, args.seed):
+            out.write(json.dumps({'message': message, 'expected': expected}, ensure_ascii=False) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
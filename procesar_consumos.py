@@ -1,15 +1,50 @@
 import os.path
 import base64
+import binascii # Errores de decodificación base64
 import re # Para expresiones regulares (extraer datos)
 import logging # Para registrar información y errores
 import html2text # Para convertir HTML a texto
+import html.parser # Para leer campos puntuales del HTML sin convertirlo entero
 import datetime # Para obtener el año actual si falla la extracción del header
-
+import argparse # Para las opciones de línea de comandos
+import itertools # Para consumir los IDs de a un batch por vez
+import email.utils # Para separar la dirección del remitente
+import email.errors
+import email.header
+import email.message # Correos de alerta de presupuesto
+import email.parser # Para leer los correos de --import (mbox de Takeout o .eml)
+import email.policy
+import mmap # Para recorrer archivos mbox de varios GB sin cargarlos en memoria
+import hashlib # IDs estables de los correos importados
+import unicodedata # Para normalizar nombres de comercios
+import difflib # Coincidencia aproximada de comercios
+import collections
+import codecs # Decodificación incremental de los cuerpos grandes
+import sqlite3 # Almacenamiento local de correos
+import zlib # Para comprimir los correos guardados localmente
+import json # Para guardar el checkpoint de sincronización incremental
+import random # Para la variación aleatoria del intervalo en modo daemon
+import signal # Para terminar el modo daemon de forma ordenada
+import threading # Para el pipeline de etapas y la espera del daemon
+import queue # Colas acotadas entre las etapas del pipeline
+import contextlib
+import functools
+import concurrent.futures # Pool de procesos de --parse-workers
+import multiprocessing
+import time # Para el token bucket y las esperas entre reintentos
+import bisect # Buckets de los histogramas de métricas
+import math
+import urllib.parse # URL del batch cuando se usa --api-base-url
+import importlib.util # Para avisar si falta pyarrow antes de empezar --export
+
+from google.auth.credentials import AnonymousCredentials
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, HttpRequest
+import httplib2
 
 # --- CONFIGURACIÓN ---
 # Si modificas estos SCOPES, elimina el archivo token.json.
@@ -27,6 +62,110 @@ PROCESSED_LABEL_NAME = 'Procesado' # Etiqueta para marcar correos leídos
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
 
+# Cantidad de correos a pedir por cada llamada batch a Gmail (la API acepta hasta 100,
+# pero Google recomienda no pasar de 50 para no disparar errores de límite de tasa)
+GMAIL_BATCH_SIZE = 50
+GMAIL_BATCH_MAX = 100
+# Cantidad de IDs por página al listar correos (máximo permitido por la API: 500)
+GMAIL_LIST_PAGE_SIZE = 500
+# Obtener los correos en dos pasos: primero solo los headers (format='metadata') y el
+# contenido completo solo de los bancos conocidos. Ahorra bytes cuando la etiqueta
+# también junta publicidad; cada correo de banco cuesta dos messages.get de cuota
+GMAIL_TWO_PHASE_FETCH = True
+GMAIL_METADATA_HEADERS = ['From', 'Subject', 'Date']
+# Campos pedidos a messages.get (respuesta parcial): solo lo que usa extract_data_from_email
+GMAIL_METADATA_FIELDS = 'id,labelIds,sizeEstimate,payload/headers'
+GMAIL_FULL_FIELDS = ('id,labelIds,sizeEstimate,payload(mimeType,headers,body/data,'
+                     'parts(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data,parts))))')
+# Cuota por usuario de cada API. Gmail cobra "unidades" distintas según el método
+# (https://developers.google.com/gmail/api/reference/quota); Sheets cuenta requests
+GMAIL_QUOTA_UNITS_PER_MINUTE = 15000
+GMAIL_QUOTA_COSTS = {
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.getProfile': 1,
+    'gmail.users.messages.send': 100,
+}
+SHEETS_REQUESTS_PER_MINUTE = 60
+# Segundos de cuota que se pueden gastar de golpe (ráfaga máxima del token bucket)
+QUOTA_BURST_SECONDS = 1
+# Reintentos de errores transitorios: intentos totales y backoff exponencial (segundos)
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+RETRYABLE_HTTP_STATUSES = (429, 500, 502, 503, 504)
+# Métodos no idempotentes: después de un 5xx o de un corte de red el pedido pudo haberse
+# aplicado igual, y repetirlo duplica filas, alertas o etiquetas. Solo se reintentan los
+# límites de tasa y las fallas de conexión, en las que el pedido no llegó a salir
+NON_IDEMPOTENT_METHODS = frozenset({
+    'sheets.spreadsheets.values.append',
+    'gmail.users.messages.send',
+    'gmail.users.labels.create',
+})
+# Fallas seguidas que abren el circuit breaker de una API y segundos que queda abierto
+CIRCUIT_BREAKER_FAILURES = 5
+CIRCUIT_BREAKER_COOLDOWN = 60
+# Pipeline: hilos por etapa y bloques que pueden esperar entre etapas. Con un solo hilo
+# de obtención ya se superpone la red con el parseo; más hilos aceleran un backfill pero
+# cada batch de 50 correos consume 250 unidades de cuota de Gmail por segundo.
+PIPELINE_FETCH_WORKERS = 1
+PIPELINE_PARSE_THREADS = 1
+PIPELINE_QUEUE_SIZE = 4
+# Modo --daemon: segundos entre revisiones del correo y variación aleatoria máxima (+/-)
+DAEMON_INTERVAL = 300
+DAEMON_JITTER = 30
+# Segundos antes del vencimiento en que el modo --daemon refresca el token
+TOKEN_REFRESH_MARGIN = 300
+# Máximo de filas por cada escritura en Sheets (la sincronización escribe en bloques de este tamaño)
+SHEETS_FLUSH_ROWS = 500
+# Máximo de IDs por llamada a messages.batchModify (límite de la API)
+GMAIL_BATCH_MODIFY_MAX = 1000
+# Base SQLite local donde se guardan los correos obtenidos, el resultado de su parseo y
+# el registro de movimientos (la fuente de verdad; Sheets se sincroniza desde ahí)
+LOCAL_DB_FILE = 'consumos_local.db'
+# Subir este número cada vez que cambien las reglas de extracción: los correos que
+# fallaron con una versión anterior se vuelven a intentar (con su copia local)
+PARSER_VERSION = 1
+# Modo --import: movimientos a juntar antes de cada escritura en el registro local, y
+# cada cuántos bytes leídos del mbox se le avisa al sistema que ya no se usan
+IMPORT_BULK_ROWS = 1000
+MBOX_RELEASE_BYTES = 64 * 1024 * 1024
+# Hoja con el mapeo Comercio -> Categoría. Se lee al comienzo de cada pasada (si no
+# cambió se sigue usando el mismo índice) y se guarda una copia local, que usa --import
+MAPEO_COMERCIOS_RANGE = 'MapeoComercios!A2:B'
+MAPEO_COMERCIOS_CACHE_FILE = 'mapeo_comercios.json'
+# Similitud mínima (0 a 1, según difflib) para asignar la categoría de un comercio
+# parecido cuando no hay coincidencia exacta ni por prefijo
+CATEGORIA_FUZZY_MIN_RATIO = 0.85
+# Comercios distintos cuya categoría se recuerda (los consumos se repiten mucho)
+CATEGORIA_CACHE_SIZE = 4096
+# Presupuesto mensual por categoría (Categoria, PresupuestoMensual) y hoja donde se
+# escriben los totales por mes y por semana (hay que crearla en la planilla)
+PRESUPUESTO_RANGE = 'Presupuesto!A2:B'
+RESUMEN_SHEET_NAME = 'Resumen'
+# Semanas (las más recientes) que se muestran en la hoja de resumen
+RESUMEN_SEMANAS = 8
+# Porcentajes del presupuesto del mes que disparan una alerta por correo (una sola vez
+# por mes, categoría y porcentaje). El presupuesto se compara con los consumos en BUDGET_CURRENCY
+BUDGET_ALERT_THRESHOLDS = (50, 80)
+BUDGET_CURRENCY = 'ARS'
+BUDGET_ALERT_EMAIL = None # Destinatario de las alertas (None = la misma cuenta de Gmail)
+# Modo --export: formatos de salida (pyarrow los escribe partidos en una carpeta por
+# mes, mes=AAAA-MM) y movimientos que se leen del registro local por cada bloque
+EXPORT_FORMATS = {'parquet': 'parquet', 'arrow': 'ipc'}
+EXPORT_BATCH_ROWS = 50000
+# Columnas por las que se puede agrupar con rollup()
+ROLLUP_COLUMNS = ('mes', 'categoria', 'tarjeta', 'moneda', 'banco', 'comercio')
+# Modo --accounts: cuentas que se procesan a la vez (cada una con sus propios hilos del pipeline)
+ACCOUNT_WORKERS = 2
+# Archivo donde el modo --incremental guarda el último historyId visto de Gmail
+HISTORY_CHECKPOINT_FILE = 'history_checkpoint.json'
+
 # Mapa de meses abreviados a números (para Naranja X)
 MESES_MAP = {'ENE': '01', 'FEB': '02', 'MAR': '03', 'ABR': '04', 'MAY': '05', 'JUN': '06', 'JUL': '07', 'AGO': '08', 'SEP': '09', 'OCT': '10', 'NOV': '11', 'DIC': '12'}
 
@@ -49,20 +188,20 @@ CREDENTIALS_FILE = 'credentials.json'
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify', 'https://www.googleapis.com/auth/spreadsheets']
 # ---
 
-def authenticate_google_apis():
-    """Autentica al usuario y retorna los objetos de servicio para Gmail y Sheets.
-       Usa flujo manual de consola si es necesario."""
+def load_credentials(token_file=TOKEN_FILE):
+    """Carga (o refresca, o pide por consola) las credenciales de Google guardadas en token_file.
+       Retorna las credenciales o None si no se pudieron obtener."""
     creds = None
     # 1. Intenta cargar el token existente
-    if os.path.exists(TOKEN_FILE):
+    if os.path.exists(token_file):
         try:
-            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-            logging.info(f"Token cargado desde {TOKEN_FILE}")
+            creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+            logging.info(f"Token cargado desde {token_file}")
         except Exception as e:
-            logging.warning(f"Error al cargar {TOKEN_FILE}: {e}. Se intentará re-autenticar.")
+            logging.warning(f"Error al cargar {token_file}: {e}. Se intentará re-autenticar.")
             try:
-                os.remove(TOKEN_FILE)
-                logging.info(f"Archivo {TOKEN_FILE} corrupto eliminado.")
+                os.remove(token_file)
+                logging.info(f"Archivo {token_file} corrupto eliminado.")
             except OSError:
                 pass
             creds = None
@@ -74,14 +213,14 @@ def authenticate_google_apis():
             try:
                 creds.refresh(Request())
                 logging.info("¡Token refrescado exitosamente!")
-                with open(TOKEN_FILE, 'w') as token:
+                with open(token_file, 'w') as token:
                     token.write(creds.to_json())
-                logging.info(f"Token refrescado guardado en {TOKEN_FILE}")
+                logging.info(f"Token refrescado guardado en {token_file}")
             except Exception as e:
                 logging.error(f"Error al refrescar el token: {e}. Se requiere re-autenticación.")
                 try:
-                    os.remove(TOKEN_FILE)
-                    logging.info(f"Archivo {TOKEN_FILE} inválido eliminado.")
+                    os.remove(token_file)
+                    logging.info(f"Archivo {token_file} inválido eliminado.")
                 except OSError:
                     pass
                 creds = None
@@ -126,33 +265,577 @@ def authenticate_google_apis():
             logging.info("¡Tokens obtenidos exitosamente!")
 
             # Guardar las nuevas credenciales
-            with open(TOKEN_FILE, 'w') as token:
+            with open(token_file, 'w') as token:
                 token.write(creds.to_json())
-            logging.info(f"Autenticación manual exitosa. Token guardado en {TOKEN_FILE}")
+            logging.info(f"Autenticación manual exitosa. Token guardado en {token_file}")
 
         except FileNotFoundError:
             logging.critical(f"ERROR CRÍTICO: No se encontró el archivo de credenciales '{CREDENTIALS_FILE}'. Descárgalo desde Google Cloud Console y colócalo en la misma carpeta que el script.")
-            return None, None
+            return None
         except Exception as e:
             logging.error(f"Error durante el flujo de autenticación manual por consola: {e}", exc_info=True)
-            return None, None
+            return None
+
+    return creds
+
+def refresh_credentials_if_needed(creds, margin=TOKEN_REFRESH_MARGIN, token_file=TOKEN_FILE):
+    """Refresca el token si vence dentro de `margin` segundos y lo guarda en token_file.
+
+    Pensado para el modo --daemon: así ninguna llamada a la API se encuentra con el
+    token vencido a mitad de una ejecución. Retorna False si el refresco falló."""
+    if not creds.expiry or not creds.refresh_token:
+        return True
+    # google-auth guarda expiry como datetime UTC sin zona horaria
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    remaining = (creds.expiry - now).total_seconds()
+    if remaining > margin:
+        return True
+    logging.info(f"El token vence en {int(remaining)}s, refrescando...")
+    try:
+        creds.refresh(Request())
+        with open(token_file, 'w') as token:
+            token.write(creds.to_json())
+        logging.info(f"Token refrescado guardado en {token_file}")
+        return True
+    except Exception as e:
+        logging.error(f"Error al refrescar el token: {e}")
+        return False
+
+# --- MÉTRICAS ---
+# Métricas livianas de cada ejecución (latencias por etapa y por método de la API, bytes
+# recibidos, parseos por banco). Se pueden exportar en formato de texto de Prometheus,
+# para el textfile collector de node_exporter (--metrics-file), y como resumen JSON
+# (--summary-file). Los valores se acumulan desde que arranca el proceso.
+
+class Metrics:
+    """Registro thread-safe de contadores, gauges e histogramas con etiquetas."""
+
+    # Límites (en segundos) de los buckets de los histogramas de latencia
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    HELP = {
+        'consumos_stage_duration_seconds': 'Duración de cada etapa del procesamiento.',
+        'consumos_api_request_duration_seconds': 'Duración de cada llamada a la API (un batch cuenta como una).',
+        'consumos_api_errors_total': 'Intentos de llamadas a la API que fallaron.',
+        'consumos_api_response_bytes_total': 'Bytes de respuesta recibidos (JSON descomprimido).',
+        'consumos_quota_wait_seconds_total': 'Tiempo esperando cuota en el token bucket.',
+        'consumos_gmail_size_estimate_bytes_total': 'Suma del sizeEstimate de los correos obtenidos.',
+        'consumos_parse_total': 'Correos parseados por banco y resultado.',
+        'consumos_messages_reviewed_total': 'Correos revisados.',
+        'consumos_rows_synced_total': 'Filas escritas en Sheets.',
+        'consumos_pending_messages': 'Correos que quedaron sin procesar en la última pasada.',
+        'consumos_last_pass_timestamp_seconds': 'Hora (epoch) en que terminó la última pasada.',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._reset()
+
+    def _reset(self):
+        self.counters = {} # (nombre, etiquetas) -> valor
+        self.gauges = {}
+        self.histograms = {} # (nombre, etiquetas) -> [conteo por bucket, suma, cantidad, máximo]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0, 0.0])
+            index = bisect.bisect_left(self.BUCKETS, seconds) # Primer bucket con límite >= seconds
+            if index < len(self.BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            histogram[3] = max(histogram[3], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, stage):
+        """Decorador: mide cada llamada a la función como la etapa `stage`."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer('consumos_stage_duration_seconds', stage=stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def drain(self):
+        """Devuelve lo acumulado y vacía el registro (para traer las métricas de --parse-workers)."""
+        with self._lock:
+            snapshot = (self.counters, self.gauges, self.histograms)
+            self._reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        """Suma al registro lo devuelto por drain() en otro proceso."""
+        counters, gauges, histograms = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, (buckets, total, count, maximum) in histograms.items():
+                histogram = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0, 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+                histogram[3] = max(histogram[3], maximum)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = labels + tuple(extra)
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+    def to_prometheus(self):
+        """Devuelve las métricas en el formato de texto de Prometheus."""
+        with self._lock:
+            counters, gauges = dict(self.counters), dict(self.gauges)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, 'counter')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            declare(name, 'gauge')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Resumen de la ejecución como diccionario (para el JSON de --summary-file)."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (h[1], h[2], h[3]) for key, h in self.histograms.items()}
+
+        def counter_by(name, label):
+            return {dict(labels)[label]: value for (n, labels), value in counters.items() if n == name}
+
+        def total_of(name): # Sumando todas las cuentas (--accounts)
+            return sum(value for (n, _), value in counters.items() if n == name)
+
+        def timings(name, label):
+            return {dict(labels)[label]: {'llamadas': count, 'segundos': round(total, 4),
+                                          'promedio_s': round(total / count, 6) if count else 0,
+                                          'maximo_s': round(maximum, 6)}
+                    for (n, labels), (total, count, maximum) in histograms.items()
+                    if n == name and 'cuenta' not in dict(labels)}
+
+        # Con --accounts, las métricas de cada pasada llevan la etiqueta cuenta
+        per_account = {}
+        for (name, labels), value in counters.items():
+            account = dict(labels).get('cuenta')
+            if account and name in ('consumos_messages_reviewed_total', 'consumos_rows_synced_total'):
+                key = 'correos_revisados' if name == 'consumos_messages_reviewed_total' else 'filas_sincronizadas'
+                per_account.setdefault(account, {})[key] = value
+        for (name, labels), (total, count, _) in histograms.items():
+            account = dict(labels).get('cuenta')
+            if account and name == 'consumos_stage_duration_seconds':
+                per_account.setdefault(account, {}).update(pasadas=count, segundos=round(total, 3))
+
+        per_bank = {}
+        for (name, labels), value in counters.items():
+            if name == 'consumos_parse_total':
+                labels = dict(labels)
+                per_bank.setdefault(labels['banco'], {'ok': 0, 'fallo': 0})[labels['resultado']] = value
+        api = timings('consumos_api_request_duration_seconds', 'method')
+        for method, errors in counter_by('consumos_api_errors_total', 'method').items():
+            api.setdefault(method, {})['errores'] = errors
+        for method, received in counter_by('consumos_api_response_bytes_total', 'method').items():
+            api.setdefault(method, {})['bytes'] = received
+        return {
+            'inicio': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'duracion_s': round(time.time() - self.started, 3),
+            'correos_revisados': total_of('consumos_messages_reviewed_total'),
+            'filas_sincronizadas': total_of('consumos_rows_synced_total'),
+            'bytes_recibidos': sum(counter_by('consumos_api_response_bytes_total', 'method').values()),
+            'bytes_size_estimate': counters.get(('consumos_gmail_size_estimate_bytes_total', ()), 0),
+            'espera_cuota_s': {api_name: round(value, 3) for api_name, value
+                               in counter_by('consumos_quota_wait_seconds_total', 'api').items()},
+            'etapas': timings('consumos_stage_duration_seconds', 'stage'),
+            'api': api,
+            'por_banco': per_bank,
+            **({'por_cuenta': per_account} if per_account else {}),
+        }
+
+def _write_atomically(path, text):
+    # node_exporter puede leer el archivo en cualquier momento: se escribe aparte y se renombra
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_file, path)
+
+def export_metrics(metrics_file=None, summary_file=None):
+    """Escribe las métricas en el textfile de Prometheus y/o el resumen JSON."""
+    try:
+        if metrics_file:
+            _write_atomically(metrics_file, METRICS.to_prometheus())
+        if summary_file:
+            _write_atomically(summary_file, json.dumps(METRICS.summary(), indent=2, ensure_ascii=False))
+    except OSError as e:
+        logging.error(f"No se pudieron escribir las métricas: {e}")
+
+METRICS = Metrics()
+
+# --- CUOTAS Y REINTENTOS ---
+# Todas las llamadas a Gmail y Sheets pasan por un ApiQuotaGuard (uno por API, compartido
+# por todos los hilos): descuenta el costo real de cada método de un token bucket con la
+# cuota por minuto de la API, reintenta los errores transitorios (429, 5xx, red) con
+# backoff exponencial respetando Retry-After, y corta las llamadas por un rato si la API
+# falla seguido (circuit breaker).
+
+class CircuitOpenError(Exception):
+    """La API falló varias veces seguidas y no se la llama hasta que pase el enfriamiento."""
+
+class TokenBucket:
+    """Token bucket thread-safe: rate_per_minute unidades por minuto, ráfagas de hasta capacity."""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0 # Unidades por segundo
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, cost):
+        """Espera hasta poder gastar cost unidades y las descuenta.
+
+        Un costo mayor que la capacidad (ej: un batch grande) se acepta con el bucket
+        lleno y deja el saldo negativo: las llamadas siguientes esperan a que se recupere."""
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(cost, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= cost
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, seconds):
+        """Vacía el bucket por `seconds` segundos (ej: la API pidió esperar con Retry-After)."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class GuardedHttpRequest(HttpRequest):
+    """HttpRequest de googleapiclient cuyo execute() pasa por un ApiQuotaGuard."""
+
+    def __init__(self, quota_guard, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.quota_guard = quota_guard
+        postproc = self.postproc
+
+        def _counting_postproc(resp, content):
+            # También lo llama BatchHttpRequest con la respuesta de cada request del batch
+            METRICS.inc('consumos_api_response_bytes_total', len(content or b''), method=self.methodId)
+            return postproc(resp, content)
+        self.postproc = _counting_postproc
+
+    def execute(self, http=None, num_retries=0):
+        # Los reintentos los hace el guard (los de googleapiclient no respetan Retry-After)
+        send = functools.partial(super().execute, http=http, num_retries=0)
+        return self.quota_guard.call(self.methodId, send, idempotent=self.methodId not in NON_IDEMPOTENT_METHODS)
+
+class ApiQuotaGuard:
+    """Limita, reintenta y, si hace falta, corta las llamadas a una API de Google."""
+
+    def __init__(self, name, units_per_minute, costs, default_cost=1):
+        self.name = name
+        self.costs = costs
+        self.default_cost = default_cost
+        self.bucket = None
+        if units_per_minute:
+            self.bucket = TokenBucket(units_per_minute, max(1, units_per_minute * QUOTA_BURST_SECONDS // 60))
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+
+    def request_builder(self, *args, **kwargs):
+        """Para el parámetro requestBuilder de googleapiclient.discovery.build()."""
+        return GuardedHttpRequest(self, *args, **kwargs)
+
+    def cost_of(self, method_id):
+        return self.costs.get(method_id, self.default_cost)
+
+    def call(self, method_id, send, idempotent=True):
+        """Ejecuta send() (una llamada a method_id) con cuota, reintentos y circuit breaker.
+
+        Si la llamada no es idempotente, un error que pudo dejarla aplicada no se reintenta:
+        se propaga y quien llama decide (ej: las filas quedan sin sincronizar)."""
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            self._check_circuit()
+            self._acquire_quota(self.cost_of(method_id))
+            try:
+                with METRICS.timer('consumos_api_request_duration_seconds', method=method_id):
+                    result = send()
+            except Exception as e:
+                METRICS.inc('consumos_api_errors_total', method=method_id)
+                if not self.is_retryable(e):
+                    self._record_success() # La API respondió: el error es de la llamada
+                    raise
+                self._record_failure()
+                if not self.is_retryable(e, idempotent):
+                    logging.warning(f"{self.name}: falló {method_id} ({e}). No se reintenta: "
+                                    f"el pedido pudo haberse aplicado y repetirlo lo duplicaría.")
+                    raise
+                if attempt == RETRY_MAX_ATTEMPTS - 1:
+                    raise
+                self._back_off(e, attempt, method_id)
+                continue
+            self._record_success()
+            return result
+
+    def execute_batch(self, new_batch, requests):
+        """Ejecuta {request_id: HttpRequest} en un batch y devuelve {request_id: (response, error)}.
+
+        Cada request del batch se cobra por separado (así cuenta Google la cuota). Las que
+        fallan con un error transitorio se reintentan en un batch nuevo; el resto no."""
+        results = {}
+        pending = dict(requests)
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            self._check_circuit()
+            self._acquire_quota(sum(self.cost_of(request.methodId) for request in pending.values()))
+            method_id = f"batch:{next(iter(pending.values())).methodId}"
+            responses = {}
+
+            def _callback(request_id, response, exception):
+                responses[request_id] = (response, exception)
+
+            batch = new_batch(callback=_callback)
+            for request_id, request in pending.items():
+                batch.add(request, request_id=request_id)
+            try:
+                with METRICS.timer('consumos_api_request_duration_seconds', method=method_id):
+                    batch.execute()
+            except Exception as e:
+                METRICS.inc('consumos_api_errors_total', method=method_id)
+                if not self.is_retryable(e) or attempt == RETRY_MAX_ATTEMPTS - 1:
+                    raise
+                self._record_failure()
+                self._back_off(e, attempt, 'batch')
+                continue
+
+            retry = {request_id: request for request_id, request in pending.items()
+                     if self.is_retryable(responses.get(request_id, (None, None))[1])}
+            results.update((request_id, responses.get(request_id, (None, None)))
+                           for request_id in pending if request_id not in retry)
+            if not retry:
+                self._record_success()
+                return results
+            METRICS.inc('consumos_api_errors_total', len(retry), method=method_id)
+            self._record_failure()
+            last_error = responses[next(reversed(retry))][1]
+            if attempt == RETRY_MAX_ATTEMPTS - 1:
+                results.update((request_id, responses[request_id]) for request_id in retry)
+                return results
+            self._back_off(last_error, attempt, f'{len(retry)} de {len(pending)} llamadas del batch')
+            pending = retry
+
+    def _acquire_quota(self, cost):
+        if not self.bucket:
+            return
+        start = time.perf_counter()
+        self.bucket.acquire(cost)
+        METRICS.inc('consumos_quota_wait_seconds_total', time.perf_counter() - start, api=self.name)
+
+    @staticmethod
+    def is_retryable(error, idempotent=True):
+        """Indica si vale la pena reintentar: límites de tasa, errores 5xx y fallas de red.
+
+        Con idempotent=False solo los errores en los que el pedido seguro no se aplicó:
+        límites de tasa y fallas al conectar (servidor no encontrado o conexión rechazada)."""
+        if isinstance(error, HttpError):
+            status = error.resp.status
+            # Gmail informa algunos límites de tasa como 403
+            if status == 429 or (status == 403 and b'ratelimitexceeded' in (error.content or b'').lower()):
+                return True
+            return idempotent and status in RETRYABLE_HTTP_STATUSES
+        if not idempotent:
+            return isinstance(error, (ConnectionRefusedError, httplib2.ServerNotFoundError))
+        return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+    @staticmethod
+    def _retry_after(error):
+        """Segundos pedidos por el header Retry-After del error, o None."""
+        if not isinstance(error, HttpError):
+            return None
+        value = error.resp.get('retry-after')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try: # También puede venir como fecha HTTP
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def _back_off(self, error, attempt, method_id):
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            delay = retry_after
+        else: # Backoff exponencial con jitter completo
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        logging.warning(f"{self.name}: falló {method_id} ({error}). Reintento {attempt + 1} de "
+                        f"{RETRY_MAX_ATTEMPTS - 1} en {delay:.1f}s.")
+        status = error.resp.status if isinstance(error, HttpError) else None
+        if self.bucket and status in (403, 429):
+            # Es un límite de tasa: frena a todos los hilos que usan esta API, no solo a este
+            self.bucket.penalize(delay)
+        else:
+            time.sleep(delay)
+
+    def _check_circuit(self):
+        with self._lock:
+            remaining = self._open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"{self.name} falló {CIRCUIT_BREAKER_FAILURES} veces seguidas; "
+                                   f"no se la llama por {remaining:.0f}s más.")
+
+    def _record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+
+    def _record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= CIRCUIT_BREAKER_FAILURES:
+                self._open_until = time.monotonic() + CIRCUIT_BREAKER_COOLDOWN
+                logging.error(f"{self.name}: {self._consecutive_failures} fallas seguidas. "
+                              f"Se dejan de hacer llamadas por {CIRCUIT_BREAKER_COOLDOWN}s.")
+
+# Para servicios construidos sin guard: reintenta igual, pero sin límite de cuota
+UNLIMITED_GUARD = ApiQuotaGuard('API', None, {})
+
+def build_services(creds, gmail_guard=None, sheets_guard=None, api_base_url=None):
+    """Construye los servicios de Gmail y Sheets con las credenciales dadas.
+
+    Los documentos de discovery se leen de la copia estática que trae
+    google-api-python-client (static_discovery=True), así construir los servicios
+    nunca depende de bajarlos de la red. Con un guard, todas las llamadas del servicio
+    pasan por él (cuota, reintentos y circuit breaker). Con api_base_url las llamadas
+    van a ese servidor en lugar de a Google (ver benchmarks/fake_google_server.py)."""
+    client_options = {'api_endpoint': api_base_url} if api_base_url else None
+    service_gmail = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False,
+                          requestBuilder=gmail_guard.request_builder if gmail_guard else HttpRequest,
+                          client_options=client_options)
+    service_sheets = build('sheets', 'v4', credentials=creds, static_discovery=True, cache_discovery=False,
+                           requestBuilder=sheets_guard.request_builder if sheets_guard else HttpRequest,
+                           client_options=client_options)
+    if api_base_url:
+        # googleapiclient arma la URL del batch con el rootUrl del discovery e ignora
+        # api_endpoint, así que el batch iría a Google igual
+        service_gmail.new_batch_http_request = functools.partial(
+            BatchHttpRequest, batch_uri=urllib.parse.urljoin(api_base_url, 'batch'))
+    return service_gmail, service_sheets
+
+class GoogleClients:
+    """Credenciales de Google más un pool de servicios Gmail/Sheets reutilizables.
+
+    httplib2 (la capa HTTP de googleapiclient) no es thread-safe, así que cada hilo
+    del pipeline pide su propio par de servicios con acquire(). Los pares se devuelven
+    al pool al terminar, así sus conexiones HTTP quedan abiertas para la próxima
+    pasada (en modo --daemon). Las cuotas son por usuario, así que todos los servicios
+    comparten los mismos ApiQuotaGuard."""
+
+    def __init__(self, creds, service_gmail=None, service_sheets=None, api_base_url=None,
+                 gmail_quota=GMAIL_QUOTA_UNITS_PER_MINUTE, sheets_quota=SHEETS_REQUESTS_PER_MINUTE):
+        self.creds = creds
+        self.api_base_url = api_base_url
+        self.gmail_guard = ApiQuotaGuard('Gmail', gmail_quota, GMAIL_QUOTA_COSTS)
+        self.sheets_guard = ApiQuotaGuard('Sheets', sheets_quota, {})
+        self._pool = queue.LifoQueue()
+        if service_gmail and service_sheets:
+            self._pool.put((service_gmail, service_sheets))
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Presta un par (service_gmail, service_sheets) de uso exclusivo del hilo actual."""
+        try:
+            services = self._pool.get_nowait()
+        except queue.Empty:
+            services = build_services(self.creds, self.gmail_guard, self.sheets_guard, self.api_base_url)
+        try:
+            yield services
+        finally:
+            self._pool.put(services)
+
+@METRICS.timed('autenticacion')
+def authenticate_google_apis(api_base_url=None, gmail_quota=GMAIL_QUOTA_UNITS_PER_MINUTE,
+                             sheets_quota=SHEETS_REQUESTS_PER_MINUTE, token_file=TOKEN_FILE):
+    """Autentica al usuario y retorna un GoogleClients con los servicios de Gmail y Sheets
+       (o None si falla). Usa flujo manual de consola si es necesario.
+
+    Con api_base_url (un servidor de prueba local) no se autentica: las llamadas van
+    sin credenciales. gmail_quota y sheets_quota son los límites por minuto que respeta
+    el cliente (0 o None = sin límite)."""
+    if api_base_url:
+        logging.warning(f"Usando las APIs de {api_base_url} en lugar de las de Google, sin credenciales.")
+        creds = AnonymousCredentials()
+    else:
+        creds = load_credentials(token_file)
 
     # 4. Construir y devolver los servicios
     try:
         if not creds: # Doble chequeo por si falló la autenticación manual
              logging.error("No se pudieron obtener credenciales válidas.")
-             return None, None
+             return None
 
-        service_gmail = build('gmail', 'v1', credentials=creds)
-        service_sheets = build('sheets', 'v4', credentials=creds)
+        clients = GoogleClients(creds, api_base_url=api_base_url, gmail_quota=gmail_quota, sheets_quota=sheets_quota)
+        with clients.acquire(): # Construye el primer par de servicios (los errores saltan acá)
+            pass
         logging.info("Servicios de Gmail y Sheets construidos exitosamente.")
-        return service_gmail, service_sheets
+        return clients
     except HttpError as error:
         logging.error(f'Ocurrió un error al construir los servicios: {error}')
-        return None, None
+        return None
     except Exception as e:
         logging.error(f'Error inesperado al construir servicios: {e}', exc_info=True)
-        return None, None
+        return None
 
 def get_or_create_label(service, user_id, label_name):
     """Obtiene el ID de una etiqueta o la crea si no existe."""
@@ -180,54 +863,686 @@ def get_or_create_label(service, user_id, label_name):
         logging.error(f'Ocurrió un error al obtener/crear la etiqueta {label_name}: {error}')
         return None
 
+def find_label_id(service, user_id, search_name):
+    """Busca el ID de una etiqueta a partir de su nombre en formato de búsqueda.
+
+    En las búsquedas de Gmail 'Tarjetas/Consumos Tarjeta' se escribe
+    'tarjetas-consumos-tarjeta', así que se comparan ambos nombres normalizados."""
+    def _normalize(name):
+        return re.sub(r'[/\s]+', '-', name.strip().lower())
+
+    results = service.users().labels().list(userId=user_id).execute()
+    for label in results.get('labels', []):
+        if _normalize(label['name']) == _normalize(search_name):
+            return label['id']
+    return None
+
+def load_history_checkpoint(checkpoint_file=HISTORY_CHECKPOINT_FILE):
+    """Lee el checkpoint del modo incremental (o None si no existe o está corrupto)."""
+    if not os.path.exists(checkpoint_file):
+        return None
+    try:
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if not checkpoint.get('historyId'):
+            raise ValueError('falta historyId')
+        return checkpoint
+    except (OSError, ValueError) as e:
+        logging.warning(f"Checkpoint {checkpoint_file} ilegible ({e}). Se hará una búsqueda completa.")
+        return None
+
+def save_history_checkpoint(checkpoint, checkpoint_file=HISTORY_CHECKPOINT_FILE):
+    """Guarda el checkpoint del modo incremental de forma atómica."""
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+    logging.info(f"Checkpoint guardado en {checkpoint_file} (historyId {checkpoint['historyId']}).")
+
+def list_history_message_ids(service, user_id, start_history_id, label_id):
+    """Lista los correos que entraron a la etiqueta desde start_history_id.
+
+    Devuelve (ids, history_id): los IDs nuevos (sin repetir, solo no leídos) y el
+    historyId con el que continuar la próxima vez. Si el historyId es demasiado viejo
+    Gmail responde 404; ese HttpError se propaga para que el llamador haga la búsqueda completa."""
+    msg_ids = {}
+    page_token = None
+    history_id = start_history_id
+    while True:
+        results = service.users().history().list(
+            userId=user_id, startHistoryId=start_history_id, labelId=label_id,
+            historyTypes=['messageAdded', 'labelAdded'], pageToken=page_token
+        ).execute()
+        history_id = results.get('historyId', history_id)
+        for record in results.get('history', []):
+            changes = record.get('messagesAdded', []) + record.get('labelsAdded', [])
+            for change in changes:
+                message = change.get('message', {})
+                # Mismo criterio que la búsqueda normal: solo correos no leídos
+                if 'UNREAD' in message.get('labelIds', []):
+                    msg_ids[message['id']] = True # dict para conservar el orden sin repetidos
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return list(msg_ids), history_id
+
+def list_message_ids(service, user_id, query, page_size=GMAIL_LIST_PAGE_SIZE):
+    """Genera los IDs de los correos que cumplen la búsqueda, página por página.
+
+    Sigue nextPageToken de forma perezosa: la página siguiente recién se pide cuando
+    se terminaron de consumir los IDs de la anterior, así el procesamiento arranca
+    con la primera página y nunca se tienen todos los IDs en memoria."""
+    page_token = None
+    page_num = 0
+    while True:
+        results = service.users().messages().list(
+            userId=user_id, q=query, maxResults=page_size, pageToken=page_token
+        ).execute()
+        page_num += 1
+        messages = results.get('messages', [])
+        logging.info(f"Página {page_num} de resultados: {len(messages)} correos.")
+        for message_info in messages:
+            yield message_info['id']
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def message_header(message, name):
+    """Devuelve el valor del header `name` del correo (sin distinguir mayúsculas), o ''."""
+    name = name.lower()
+    for header in message.get('payload', {}).get('headers', []):
+        if header.get('name', '').lower() == name:
+            return header.get('value', '')
+    return ''
+
+def message_rfc822_id(message):
+    """Header Message-ID del correo (igual en la API de Gmail y en un Takeout), o None."""
+    return message_header(message, 'Message-ID').strip() or None
+
+def has_body(message):
+    """Indica si el correo trae el contenido (format='full') y no solo los headers."""
+    payload = message.get('payload', {})
+    return 'parts' in payload or 'body' in payload
+
+def _batch_get_messages(service, user_id, msg_ids, **get_kwargs):
+    """Pide varios messages.get en un batch; devuelve {msg_id: (message, error)}."""
+    # request_id es el msg_id
+    requests = {msg_id: service.users().messages().get(userId=user_id, id=msg_id, **get_kwargs)
+                for msg_id in msg_ids}
+    # Los servicios de GoogleClients cobran la cuota y reintentan cada request del batch
+    guard = getattr(requests[msg_ids[0]], 'quota_guard', None) or UNLIMITED_GUARD
+    return guard.execute_batch(service.new_batch_http_request, requests)
+
+def fetch_messages_batch(service, user_id, msg_ids, batch_size=GMAIL_BATCH_SIZE, two_phase=GMAIL_TWO_PHASE_FETCH,
+                         banks=None):
+    """Obtiene los correos agrupando las llamadas messages.get en batches.
+
+    Con two_phase primero se piden solo los headers (format='metadata') y después el
+    contenido completo únicamente de los correos de bancos conocidos (y, si se pasa
+    banks, de los bancos con esos nombres); los demás se devuelven solo con headers
+    (igual no se pueden parsear). Las respuestas traen solo los campos que usa
+    extract_data_from_email (parámetro fields).
+
+    msg_ids puede ser cualquier iterable (incluso un generador como list_message_ids);
+    se consume de a un batch por vez. Genera tuplas (msg_id, message, error) en el
+    mismo orden de msg_ids. Si un correo falla dentro del batch solo ese correo trae
+    el error; el resto del batch sigue. Si falla el batch entero (ej: error de red),
+    el error se reporta en cada correo."""
+    batch_size = max(1, min(batch_size, GMAIL_BATCH_MAX))
+    msg_ids = iter(msg_ids)
+    fetched = 0
+
+    while True:
+        chunk = list(itertools.islice(msg_ids, batch_size))
+        if not chunk:
+            return
+
+        logging.info(f"Pidiendo {len(chunk)} correos en un batch ({fetched + 1}-{fetched + len(chunk)}).")
+        fetched += len(chunk)
+        try:
+            if two_phase:
+                responses = _batch_get_messages(service, user_id, chunk, format='metadata',
+                                                metadataHeaders=GMAIL_METADATA_HEADERS, fields=GMAIL_METADATA_FIELDS)
+                known_ids = [msg_id for msg_id in chunk
+                             if responses.get(msg_id, (None, None))[0]
+                             and _is_enabled_bank(find_bank_parser(message_header(responses[msg_id][0], 'From')), banks)]
+                if len(known_ids) < len(chunk):
+                    logging.info(f"{len(chunk) - len(known_ids)} de {len(chunk)} correos no son de bancos conocidos "
+                                 f"o fallaron: no se pide su contenido.")
+                if known_ids:
+                    responses.update(_batch_get_messages(service, user_id, known_ids, format='full',
+                                                         fields=GMAIL_FULL_FIELDS))
+            else:
+                responses = _batch_get_messages(service, user_id, chunk, format='full', fields=GMAIL_FULL_FIELDS)
+        except Exception as e:
+            logging.error(f"Falló el batch completo de {len(chunk)} correos: {e}")
+            for msg_id in chunk:
+                yield msg_id, None, e
+            continue
+
+        for msg_id in chunk:
+            response, exception = responses.get(msg_id, (None, None))
+            if exception is None and response is None:
+                exception = RuntimeError('El batch no devolvió respuesta para este correo')
+            elif response and has_body(response):
+                METRICS.inc('consumos_gmail_size_estimate_bytes_total', response.get('sizeEstimate', 0))
+            yield msg_id, response, exception
+
+def backfill_windows(since, until):
+    """Divide el rango [since, until] (fechas, ambas inclusive) en ventanas mensuales.
+
+    Genera tuplas (after, before) listas para los operadores after:/before: de Gmail
+    (before: es exclusivo, por eso la última ventana termina el día siguiente a until)."""
+    start = since
+    end = until + datetime.timedelta(days=1)
+    while start < end:
+        if start.month == 12:
+            next_month = datetime.date(start.year + 1, 1, 1)
+        else:
+            next_month = datetime.date(start.year, start.month + 1, 1)
+        window_end = min(next_month, end)
+        yield start, window_end
+        start = window_end
+
+def build_search_query(after=None, before=None, only_unread=True, label=GMAIL_LABEL_TO_SEARCH):
+    """Arma la búsqueda de Gmail sobre la etiqueta de consumos, excluyendo los ya procesados."""
+    query = f'label:"{label}"'
+    if only_unread:
+        query += ' is:unread'
+    query += f' -label:"{PROCESSED_LABEL_NAME}"'
+    if after:
+        query += f' after:{after:%Y/%m/%d}'
+    if before:
+        query += f' before:{before:%Y/%m/%d}'
+    return query
+
+def iter_incremental_message_ids(service, user_id, sync_state, label=GMAIL_LABEL_TO_SEARCH,
+                                 checkpoint_file=HISTORY_CHECKPOINT_FILE):
+    """Genera los IDs nuevos usando la API de historial de Gmail.
+
+    Usa el historyId guardado en el checkpoint; si no hay checkpoint o expiró, vuelve
+    a la búsqueda normal. En sync_state deja el checkpoint a guardar al final de la
+    ejecución (el llamador completa la lista de pendientes)."""
+    checkpoint = load_history_checkpoint(checkpoint_file)
+    label_id = checkpoint.get('labelId') if checkpoint else None
+
+    if checkpoint:
+        pending = checkpoint.get('pending', [])
+        if not label_id:
+            label_id = find_label_id(service, user_id, label)
+        if label_id:
+            try:
+                new_ids, history_id = list_history_message_ids(service, user_id, checkpoint['historyId'], label_id)
+                logging.info(f"Incremental: {len(new_ids)} correos nuevos desde historyId {checkpoint['historyId']}, "
+                             f"{len(pending)} pendientes de ejecuciones anteriores.")
+                sync_state['checkpoint'] = {'historyId': history_id, 'labelId': label_id}
+                # Primero los pendientes (más viejos), sin repetir los que vuelvan a aparecer
+                yield from dict.fromkeys(pending + new_ids)
+                return
+            except HttpError as error:
+                if error.resp.status != 404:
+                    raise
+                logging.warning(f"El historyId {checkpoint['historyId']} expiró. Se hará una búsqueda completa.")
+        else:
+            logging.warning(f"No se encontró la etiqueta '{label}'. Se hará una búsqueda completa.")
+
+    # Sin checkpoint válido: se toma el historyId actual ANTES de buscar, así lo que
+    # llegue durante la búsqueda aparece igual en la próxima consulta de historial
+    profile = service.users().getProfile(userId=user_id).execute()
+    if not label_id:
+        label_id = find_label_id(service, user_id, label)
+    sync_state['checkpoint'] = {'historyId': profile['historyId'], 'labelId': label_id}
+    yield from list_message_ids(service, user_id, build_search_query(label=label))
+
+def iter_pending_message_ids(service, user_id, args, sync_state, label=GMAIL_LABEL_TO_SEARCH,
+                             checkpoint_file=HISTORY_CHECKPOINT_FILE):
+    """Genera los IDs a procesar según el modo: búsqueda normal, incremental o backfill histórico."""
+    if args.backfill:
+        # En backfill se incluyen los correos ya leídos: solo se excluyen los ya procesados
+        for after, before in backfill_windows(args.since, args.until):
+            logging.info(f"Backfill: buscando correos entre {after} y {before - datetime.timedelta(days=1)}.")
+            yield from list_message_ids(service, user_id, build_search_query(after, before, only_unread=False, label=label))
+        return
+
+    if args.incremental:
+        yield from iter_incremental_message_ids(service, user_id, sync_state, label, checkpoint_file)
+        return
+
+    # Buscar correos no leídos en la etiqueta específica, que NO tengan la etiqueta 'Procesado'
+    yield from list_message_ids(service, user_id, build_search_query(label=label))
+
+# base64url (el de la API de Gmail) -> base64 estándar, para decodificar con binascii
+_BASE64URL_TO_STD = bytes.maketrans(b'-_', b'+/')
+# Caracteres base64 que se decodifican por paso en los cuerpos grandes (múltiplo de 4)
+_BODY_DECODE_CHUNK = 4096
+
+def _decode_base64url(body_data):
+    """Lo mismo que base64.urlsafe_b64decode, sin copiar el cuerpo si no hace falta.
+
+    urlsafe_b64decode siempre copia el cuerpo dos veces (encode y translate) antes de
+    decodificarlo; binascii puede leer directo el buffer del str (ASCII)."""
+    if '-' in body_data or '_' in body_data:
+        return binascii.a2b_base64(body_data.encode('ascii').translate(_BASE64URL_TO_STD))
+    return binascii.a2b_base64(body_data)
+
+def _decode_base64url_text(body_data, encoding):
+    """Decodifica un cuerpo base64url directo a texto, de a _BODY_DECODE_CHUNK caracteres.
+
+    Los bytes del cuerpo nunca están enteros en memoria: cada tramo se pasa a texto con
+    un decodificador incremental apenas sale de base64, así el pico es el texto y no
+    base64 + bytes + texto. Los errores son los mismos que los de decodificar todo junto
+    (binascii.Error, UnicodeDecodeError): si un tramo no es base64 limpio (caracteres de
+    más, relleno en el medio) se decodifica el cuerpo entero de una vez."""
+    if len(body_data) <= _BODY_DECODE_CHUNK:
+        return str(_decode_base64url(body_data), encoding)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pieces = []
+    for start in range(0, len(body_data), _BODY_DECODE_CHUNK):
+        chunk = body_data[start:start + _BODY_DECODE_CHUNK]
+        last = start + _BODY_DECODE_CHUNK >= len(body_data)
+        try:
+            raw = binascii.a2b_base64(chunk.encode('ascii').translate(_BASE64URL_TO_STD))
+        except binascii.Error:
+            raw = None
+        # Un tramo intermedio limpio da exactamente 3 bytes cada 4 caracteres
+        if raw is None or (not last and len(raw) != len(chunk) * 3 // 4):
+            return str(_decode_base64url(body_data), encoding)
+        pieces.append(decoder.decode(raw, final=last))
+    return ''.join(pieces)
+
+@METRICS.timed('parse_email_body')
 def parse_email_body(body_data):
     """Intenta decodificar el cuerpo del correo (usualmente Base64)."""
     if not body_data:
         logging.warning("parse_email_body recibió datos vacíos.")
         return None
     try:
-        # Primero intenta decodificar como base64 urlsafe
-        decoded_bytes = base64.urlsafe_b64decode(body_data.encode('ASCII'))
-        # Luego intenta decodificar los bytes a texto (UTF-8 es común)
-        decoded_text = decoded_bytes.decode('utf-8')
-        logging.debug(f"Cuerpo decodificado (primeros 100 chars): {decoded_text[:100]}...")
+        # Decodifica base64 urlsafe y pasa los bytes a texto (UTF-8 es común)
+        decoded_text = _decode_base64url_text(body_data, 'utf-8')
+        logging.debug("Cuerpo decodificado (primeros 100 chars): %.100s...", decoded_text)
         return decoded_text
-    except base64.Error as b64_error:
-        logging.warning(f"Error de decodificación Base64: {b64_error}. Intentando usar datos directamente.")
+    except binascii.Error as b64_error: # base64 no define base64.Error: los errores son de binascii
+        logging.warning("Error de decodificación Base64: %s. Intentando usar datos directamente.", b64_error)
         # Si falla base64, podría ser texto plano no codificado (menos común)
         return body_data # Devuelve original, puede ser bytes o str
     except UnicodeDecodeError as unicode_error:
-        logging.warning(f"Error de decodificación a texto (ej: UTF-8): {unicode_error}. Intentando otras codificaciones...")
+        logging.warning("Error de decodificación a texto (ej: UTF-8): %s. Intentando otras codificaciones...", unicode_error)
         # Intentar con latin-1 como fallback común
         try:
-            decoded_text = decoded_bytes.decode('latin-1')
-            logging.debug(f"Cuerpo decodificado como latin-1 (primeros 100 chars): {decoded_text[:100]}...")
+            decoded_text = _decode_base64url_text(body_data, 'latin-1')
+            logging.debug("Cuerpo decodificado como latin-1 (primeros 100 chars): %.100s...", decoded_text)
             return decoded_text
+        except binascii.Error as b64_error: # Base64 inválido más adelante del tramo que no era UTF-8
+            logging.warning("Error de decodificación Base64: %s. Intentando usar datos directamente.", b64_error)
+            return body_data
         except Exception as final_decode_error:
-             logging.error(f"Fallo final de decodificación: {final_decode_error}")
+             logging.error("Fallo final de decodificación: %s", final_decode_error)
              return None
     except Exception as e:
-        logging.error(f"Error inesperado en parse_email_body: {e}")
+        logging.error("Error inesperado en parse_email_body: %s", e)
         return None
 
+# --- PARSERS POR BANCO ---
+# Cada emisor de tarjeta se describe con un objeto BankParser registrado por los
+# dominios de sus remitentes. extract_data_from_email elige el parser con una búsqueda
+# en un dict (por dominio), así sumar bancos no agrega costo al procesar cada correo.
+# Las expresiones regulares se compilan una sola vez, al cargar el módulo.
+
+class BankParser:
+    """Reglas de extracción para los correos de un banco/emisor.
+
+    Las subclases definen name (valor de la columna Banco), domains (dominios del
+    remitente), body_part ('plain' o 'html': la parte del cuerpo que esperan sus
+    regex; si el correo no la tiene se usa la otra) y parse()."""
+    name = None
+    domains = ()
+    body_part = 'plain'
+    tag = None # Prefijo para los logs, ej: [NX]
+
+    def parse(self, data, body_text, subject, email_year, msg_id):
+        """Completa `data` a partir del cuerpo y el asunto del correo."""
+        raise NotImplementedError
+
+    def parse_html(self, data, html_text, subject, email_year, msg_id):
+        """Camino rápido opcional: completa `data` leyendo el HTML directamente.
+
+        Retorna True si encontró todo; si retorna False, el HTML se convierte con
+        html2text y se usa parse(). Por defecto no hay camino rápido."""
+        return False
+
+BANK_PARSERS_BY_DOMAIN = {}
+
+def register_bank_parser(parser):
+    """Registra un parser para todos los dominios que declara."""
+    for domain in parser.domains:
+        BANK_PARSERS_BY_DOMAIN[domain.lower()] = parser
+    return parser
+
+def find_bank_parser(sender):
+    """Devuelve el parser del banco para el remitente (header From), o None."""
+    address = email.utils.parseaddr(sender)[1].lower()
+    domain = address.rpartition('@')[2]
+    # Se prueba el dominio y sus dominios padre: avisos.bbva.com.ar -> bbva.com.ar -> com.ar
+    while domain:
+        parser = BANK_PARSERS_BY_DOMAIN.get(domain)
+        if parser:
+            return parser
+        domain = domain.partition('.')[2]
+    return None
+
+def _is_enabled_bank(parser, banks):
+    """Indica si el parser es de uno de los bancos habilitados (banks None = todos)."""
+    return parser is not None and (banks is None or parser.name in banks)
+
+def parse_amount(importe_str):
+    """Convierte un importe en formato argentino ('17.000,50') a float."""
+    return float(importe_str.replace('.', '').replace(',', '.'))
+
+class _FieldsFound(Exception):
+    """Corta el parseo del HTML cuando ya se encontraron todos los campos."""
+
+class HTMLTableFieldExtractor(html.parser.HTMLParser):
+    """Lee pares etiqueta/valor de las tablas de un HTML sin convertirlo entero.
+
+    Busca celdas cuyo texto termina en una de las etiquetas (ej: 'Fecha') y toma como
+    valor el primer texto en negrita de la celda siguiente; es lo mismo que matchean
+    las regex sobre la salida de html2text ('Fecha | **valor**'). Deja de leer en cuanto
+    encontró todas las etiquetas."""
+
+    CHUNK_SIZE = 4096 # El HTML se lee de a bloques para poder cortar temprano
+    BOLD_TAGS = ('b', 'strong')
+
+    def __init__(self, labels):
+        super().__init__(convert_charrefs=True)
+        self.labels = [label.lower() for label in labels]
+        self.fields = {}
+        self._cells = [] # Pila de celdas abiertas (las tablas pueden estar anidadas)
+        self._pending_label = None # Etiqueta cuyo valor está en la próxima celda
+        self._bold_depth = 0
+
+    def extract(self, html_text):
+        """Devuelve {etiqueta: valor} con las etiquetas encontradas."""
+        try:
+            for start in range(0, len(html_text), self.CHUNK_SIZE):
+                self.feed(html_text[start:start + self.CHUNK_SIZE])
+            self.close()
+        except _FieldsFound:
+            pass
+        return self.fields
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('td', 'th'):
+            # [texto de la celda, primer texto en negrita, negrita terminada]
+            self._cells.append([[], [], False])
+        elif tag in self.BOLD_TAGS:
+            self._bold_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.BOLD_TAGS:
+            self._bold_depth = max(0, self._bold_depth - 1)
+            if self._cells and self._cells[-1][1]:
+                self._cells[-1][2] = True
+        elif tag in ('td', 'th') and self._cells:
+            self._close_cell(*self._cells.pop())
+
+    def handle_data(self, data):
+        if not self._cells:
+            return
+        cell = self._cells[-1]
+        cell[0].append(data)
+        if self._bold_depth and not cell[2]:
+            cell[1].append(data)
+
+    def _close_cell(self, text_parts, bold_parts, _bold_done):
+        if self._pending_label:
+            value = ' '.join(''.join(bold_parts).split())
+            if value:
+                self.fields[self._pending_label] = value
+            self._pending_label = None
+            if len(self.fields) == len(self.labels):
+                raise _FieldsFound()
+            return
+        text = ' '.join(''.join(text_parts).split()).lower()
+        for label in self.labels:
+            if label not in self.fields and text.endswith(label):
+                self._pending_label = label
+                return
+
+class NaranjaXParser(BankParser):
+    name = 'Naranja X'
+    domains = ('naranjax.com', 'naranjax.com.ar')
+    body_part = 'plain'
+    tag = 'NX'
+
+    # Importe: Busca $ seguido de números con . y ,
+    IMPORTE_RE = re.compile(r"\$(\d[\d.,]+)")
+    # Comercio: Busca el importe, captura cualquier caracter (no goloso) hasta encontrar "Titular -"
+    COMERCIO_RE = re.compile(
+        r"\$[\d.,]+"       # Encuentra el importe $17.000,00
+        r"\s*"             # Cero o más espacios/saltos de línea después
+        r"(.*?)"           # Grupo 1: Captura el nombre del comercio (no goloso)
+        r"\s+Titular\s+-"  # Detente cuando encuentres espacio(s), "Titular", espacio(s) y "-"
+        , re.DOTALL) # re.DOTALL permite a '.' incluir saltos de línea si los hubiera
+    # Fallback: entre el importe y "Tarjeta VISA"
+    COMERCIO_ALT_RE = re.compile(r"\$[\d.,]+\s*(.*?)\s+Tarjeta\s+VISA", re.DOTALL)
+    # Tarjeta: Busca "Tarjeta" seguido de VISA o MASTERCARD
+    TARJETA_RE = re.compile(r"Tarjeta\s+(VISA|MASTERCARD)", re.IGNORECASE)
+    # Fecha: Busca el patrón Día/MesAbbr
+    FECHA_RE = re.compile(r"(\d{1,2})/([A-Z]{3})", re.IGNORECASE)
+
+    def parse(self, data, body_text, subject, email_year, msg_id):
+        # Regex para Naranja X (aplicadas a body_text, que debería ser el text/plain)
+        importe_match = self.IMPORTE_RE.search(body_text)
+        comercio_match = self.COMERCIO_RE.search(body_text)
+
+        if comercio_match:
+            data['comercio'] = comercio_match.group(1).strip() # Captura Grupo 1 y limpia espacios
+            logging.debug("Mensaje %s [NX] - Comercio encontrado: %s", msg_id, data['comercio'])
+        else:
+            # Si aún falla, podríamos intentar buscar entre el importe y "Tarjeta VISA" como último recurso
+            comercio_match_alt = self.COMERCIO_ALT_RE.search(body_text)
+            if comercio_match_alt:
+                 data['comercio'] = comercio_match_alt.group(1).strip()
+                 logging.debug("Mensaje %s [NX] - Comercio encontrado (fallback Tarjeta): %s", msg_id, data['comercio'])
+            else:
+                logging.warning("Mensaje %s [NX] - No se encontró el comercio (ni primario ni fallback).", msg_id)
+
+        tarjeta_match = self.TARJETA_RE.search(body_text)
+        fecha_dia_mes_match = self.FECHA_RE.search(body_text)
+
+        if importe_match:
+            importe_str = importe_match.group(1)
+            logging.debug("Mensaje %s [NX] - Importe encontrado (str): %s", msg_id, importe_str)
+            data['importe'] = parse_amount(importe_str)
+            # Asumir ARS si ve "PESOS" o si no especifica USD explícitamente
+            body_upper = body_text.upper()
+            if "PESOS" in body_upper or "USD" not in body_upper:
+                 data['moneda'] = 'ARS'
+            else: # O buscar U$S?
+                data['moneda'] = 'USD'
+            logging.debug("Mensaje %s [NX] - Importe (float): %s, Moneda: %s", msg_id, data['importe'], data['moneda'])
+        else:
+            logging.warning("Mensaje %s [NX] - No se encontró el importe.", msg_id)
+
+        if tarjeta_match:
+            data['tarjeta'] = tarjeta_match.group(1).upper()
+            logging.debug("Mensaje %s [NX] - Tarjeta encontrada: %s", msg_id, data['tarjeta'])
+        else:
+            logging.warning("Mensaje %s [NX] - No se encontró el tipo de tarjeta.", msg_id)
+
+        if fecha_dia_mes_match:
+             dia = fecha_dia_mes_match.group(1).zfill(2)
+             mes_abbr = fecha_dia_mes_match.group(2).upper()
+             mes_num = MESES_MAP.get(mes_abbr)
+             if mes_num:
+                 data['fecha'] = f"{dia}/{mes_num}/{email_year}" # Usar año del header
+                 logging.debug("Mensaje %s [NX] - Fecha encontrada: %s", msg_id, data['fecha'])
+             else:
+                 logging.warning("Mensaje %s [NX] - Abreviatura de mes no reconocida: %s", msg_id, mes_abbr)
+        else:
+             logging.warning("Mensaje %s [NX] - No se encontró la fecha (Día/Mes).", msg_id)
+
+class BBVAParser(BankParser):
+    name = 'BBVA'
+    domains = ('bbva.com', 'bbva.com.ar')
+    body_part = 'html' # Las regex esperan la tabla del HTML convertida con html2text
+    tag = 'BBVA'
+
+    FECHA_RE = re.compile(r"Fecha\s+\|\s*\*\*(.*?)\*\*", re.IGNORECASE | re.DOTALL)
+    COMERCIO_RE = re.compile(r"Comercio\s+\|\s*\*\*(.*?)\*\*", re.IGNORECASE | re.DOTALL)
+    IMPORTE_RE = re.compile(r"Importe\s+\|\s*\*\*(ARS|USD)\s*([\d.,]+)\*\*", re.IGNORECASE | re.DOTALL)
+    # Valor de la celda Importe leído directo del HTML (ej: 'ARS 2.500,50')
+    IMPORTE_VALUE_RE = re.compile(r"(ARS|USD)\s*([\d.,]+)", re.IGNORECASE)
+
+    def parse(self, data, body_text, subject, email_year, msg_id):
+        # Regex para BBVA (aplicadas a body_text, que debería ser el resultado de html2text)
+        fecha_match = self.FECHA_RE.search(body_text)
+        comercio_match = self.COMERCIO_RE.search(body_text)
+        importe_match = self.IMPORTE_RE.search(body_text)
+
+        if fecha_match:
+            data['fecha'] = fecha_match.group(1).strip()
+            logging.debug("Mensaje %s [BBVA] - Fecha encontrada: %s", msg_id, data['fecha'])
+        else: logging.warning("Mensaje %s [BBVA] - No se encontró la fecha.", msg_id)
+
+        if comercio_match:
+            data['comercio'] = comercio_match.group(1).strip()
+            logging.debug("Mensaje %s [BBVA] - Comercio encontrado: %s", msg_id, data['comercio'])
+        else: logging.warning("Mensaje %s [BBVA] - No se encontró el comercio.", msg_id)
+
+        if importe_match:
+            data['moneda'] = importe_match.group(1).upper()
+            importe_str = importe_match.group(2).strip()
+            logging.debug("Mensaje %s [BBVA] - Importe encontrado (str): %s, Moneda: %s", msg_id, importe_str, data['moneda'])
+            data['importe'] = parse_amount(importe_str)
+            logging.debug("Mensaje %s [BBVA] - Importe (float): %s", msg_id, data['importe'])
+        else: logging.warning("Mensaje %s [BBVA] - No se encontró el importe.", msg_id)
+
+        self._parse_card_from_subject(data, subject, msg_id)
+
+    def parse_html(self, data, html_text, subject, email_year, msg_id):
+        # Lee solo las celdas Fecha/Comercio/Importe de la tabla, sin pasar por html2text
+        fields = HTMLTableFieldExtractor(('Fecha', 'Comercio', 'Importe')).extract(html_text)
+        importe_match = self.IMPORTE_VALUE_RE.fullmatch(fields.get('importe', ''))
+        if 'fecha' not in fields or 'comercio' not in fields or not importe_match:
+            logging.info("Mensaje %s [BBVA] - Lectura directa del HTML incompleta (%s). Se usará html2text.", msg_id, sorted(fields))
+            return False
+
+        data['fecha'] = fields['fecha']
+        data['comercio'] = fields['comercio']
+        data['moneda'] = importe_match.group(1).upper()
+        data['importe'] = parse_amount(importe_match.group(2))
+        logging.debug("Mensaje %s [BBVA] - Leído del HTML: fecha %s, comercio %s, importe %s %s",
+                      msg_id, data['fecha'], data['comercio'], data['importe'], data['moneda'])
+        self._parse_card_from_subject(data, subject, msg_id)
+        return True
+
+    def _parse_card_from_subject(self, data, subject, msg_id):
+        # Tarjeta para BBVA (asumimos del asunto)
+        subject_lower = subject.lower()
+        if 'visa' in subject_lower: data['tarjeta'] = 'VISA'
+        elif 'mastercard' in subject_lower: data['tarjeta'] = 'MASTERCARD'
+        if data['tarjeta']: logging.debug("Mensaje %s [BBVA] - Tarjeta encontrada (asunto): %s", msg_id, data['tarjeta'])
+        else: logging.warning("Mensaje %s [BBVA] - No se encontró tarjeta en asunto.", msg_id)
+
+register_bank_parser(NaranjaXParser())
+register_bank_parser(BBVAParser())
+
+YEAR_RE = re.compile(r'(\d{4})')
+
+@METRICS.timed('html_to_text')
+def html_to_text(html_text):
+    """Convierte HTML a texto plano (Markdown) con html2text."""
+    h = html2text.HTML2Text()
+    h.ignore_links = True # Ignorar enlaces puede limpiar el output
+    h.ignore_images = True # Ignorar imágenes
+    return h.handle(html_text)
+
+def _parse_html_fast(bank_parser, data, html_text, subject, email_year, msg_id):
+    """Intenta el camino rápido del parser sobre el HTML; cualquier error cae a html2text."""
+    try:
+        if bank_parser.parse_html(data, html_text, subject, email_year, msg_id):
+            logging.info("Mensaje %s - Datos leídos directo del HTML (sin html2text) para %s.", msg_id, bank_parser.name)
+            return True
+    except Exception as e:
+        logging.warning("Mensaje %s - Error en la lectura directa del HTML: %s. Se usará html2text.", msg_id, e)
+    return False
+
+# Partes del cuerpo que sabe leer extract_data_from_email, por mimeType
+BODY_PART_KINDS = {'text/plain': 'plain', 'text/html': 'html'}
+
+def iter_body_parts(payload):
+    """Recorre las partes hoja del payload a lo ancho, en orden; genera (tipo, parte).
+
+    tipo es 'plain', 'html' o None (adjuntos y otras partes). Es un generador con una
+    deque: quien lo usa corta el recorrido apenas encuentra la parte que necesita, y
+    las partes que quedan sin visitar ni siquiera se miran."""
+    pending = collections.deque(payload.get('parts') or ())
+    while pending:
+        part = pending.popleft()
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type.startswith('multipart/'):
+            pending.extend(part.get('parts') or ())
+            continue
+        yield BODY_PART_KINDS.get(mime_type), part
+
+def select_body_part(payload, preferred, msg_id):
+    """Elige y decodifica la parte del cuerpo que lee el parser del banco.
+
+    Devuelve (tipo, texto): la primera parte `preferred` ('plain' o 'html') que se pueda
+    usar, o si no hay ninguna, la primera de la otra. Se decodifica solo la parte elegida
+    (un text/plain que no se puede decodificar no cuenta y se sigue buscando). Si el
+    correo no tiene partes de texto devuelve (None, None)."""
+    others = [] # Datos crudos de las partes del otro tipo, por si no aparece la preferida
+    for kind, part in iter_body_parts(payload):
+        if kind is None:
+            continue
+        body_data = part.get('body', {}).get('data')
+        if not body_data:
+            logging.warning("Mensaje %s - Parte text/%s no tiene 'data' en 'body'.", msg_id, kind)
+        elif kind != preferred:
+            others.append(body_data)
+        else:
+            text = _decode_body_part(kind, body_data, msg_id)
+            if text or kind == 'html':
+                return kind, text
+
+    other = 'html' if preferred == 'plain' else 'plain'
+    for body_data in others:
+        text = _decode_body_part(other, body_data, msg_id)
+        if text or other == 'html':
+            return other, text
+    return None, None
+
+def _decode_body_part(kind, body_data, msg_id):
+    logging.debug("Mensaje %s - Decodificando text/%s.", msg_id, kind)
+    text = parse_email_body(body_data)
+    if not text and kind == 'plain':
+        logging.warning("Mensaje %s - Falló la decodificación del text/plain.", msg_id)
+    return text
+
+@METRICS.timed('extract_data_from_email')
 def extract_data_from_email(message):
     """Extrae la información relevante del objeto mensaje de Gmail."""
     msg_id = message.get('id', 'N/A') # Obtener ID para logs
-    logging.info(f"Procesando mensaje ID: {msg_id}")
+    logging.info("Procesando mensaje ID: %s", msg_id)
 
     data = {'fecha': None, 'banco': None, 'comercio': None, 'tarjeta': None, 'importe': None, 'moneda': None}
     subject = ''
     sender = ''
     body_text = ''
     email_year = None # Para guardar el año extraído del header
+    bank_parser = None
+    parsed_from_html = False # True si el parser leyó los datos directo del HTML
 
     payload = message.get('payload', {})
     if not payload:
-        logging.error(f"Mensaje {msg_id} no tiene payload.")
+        logging.error("Mensaje %s no tiene payload.", msg_id)
         return None
 
     headers = payload.get('headers', [])
-    logging.debug(f"Mensaje {msg_id} - Payload MimeType: {payload.get('mimeType')}")
+    logging.debug("Mensaje %s - Payload MimeType: %s", msg_id, payload.get('mimeType'))
 
     # --- Extracción de Headers Clave (Remitente, Asunto, Fecha) ---
     for header in headers:
@@ -235,253 +1550,111 @@ def extract_data_from_email(message):
         value = header.get('value', '')
         if name == 'subject':
             subject = value
-            logging.debug(f"Mensaje {msg_id} - Asunto: {subject}")
+            logging.debug("Mensaje %s - Asunto: %s", msg_id, subject)
         elif name == 'from':
             sender = value
-            logging.debug(f"Mensaje {msg_id} - Remitente: {sender}")
-            # --- Identificación del Banco ---
-            if 'bbva.com' in sender.lower():
-                data['banco'] = 'BBVA'
-            elif 'naranjax.com' in sender.lower(): # NUEVO
-                data['banco'] = 'Naranja X'      # NUEVO
+            logging.debug("Mensaje %s - Remitente: %s", msg_id, sender)
+            # --- Identificación del Banco (por dominio del remitente) ---
+            bank_parser = find_bank_parser(sender)
+            if bank_parser:
+                data['banco'] = bank_parser.name
             else:
-                 logging.warning(f"Mensaje {msg_id} - Banco no reconocido para remitente: {sender}")
+                 logging.warning("Mensaje %s - Banco no reconocido para remitente: %s", msg_id, sender)
                  data['banco'] = 'Desconocido'
         elif name == 'date':
              # Extraer año del header Date
              date_str = value
-             year_match = re.search(r'(\d{4})', date_str)
+             year_match = YEAR_RE.search(date_str)
              if year_match:
                  email_year = year_match.group(1)
-                 logging.debug(f"Mensaje {msg_id} - Año extraído del header 'Date': {email_year}")
+                 logging.debug("Mensaje %s - Año extraído del header 'Date': %s", msg_id, email_year)
+
+    if not bank_parser: # Banco desconocido o no configurado: no vale la pena decodificar el cuerpo
+        logging.error("Mensaje %s - No hay reglas de extracción definidas para el banco: %s", msg_id, data['banco'])
+        return None
 
     # Si no se pudo extraer el año, usar el actual como fallback
     if not email_year:
-        logging.warning(f"Mensaje {msg_id} - No se pudo extraer el año del header 'Date'. Usando año actual como fallback.")
+        logging.warning("Mensaje %s - No se pudo extraer el año del header 'Date'. Usando año actual como fallback.", msg_id)
         email_year = str(datetime.datetime.now().year)
 
-    # --- Lógica MEJORADA para extraer Cuerpo del Texto (Prioriza text/plain) ---
-    parts = payload.get('parts', [])
-    plain_body_text = None
-    html_body_data = None # Guardará los datos crudos del HTML si se encuentra
-    found_plain_successfully = False
-
-    if parts:
-        logging.debug(f"Mensaje {msg_id} - Analizando {len(parts)} partes...")
-        part_stack = list(parts)
-
-        while part_stack:
-            part = part_stack.pop(0)
-            part_mime_type = part.get('mimeType', '').lower()
-            logging.debug(f"  - Analizando parte con MimeType: {part_mime_type}")
-
-            if 'multipart/' in part_mime_type:
-                sub_parts = part.get('parts', [])
-                if sub_parts:
-                    logging.debug(f"    -> Encontrado multipart, añadiendo {len(sub_parts)} sub-partes.")
-                    part_stack.extend(sub_parts)
-                continue
-
-            # Prioridad 1: text/plain
-            if part_mime_type == 'text/plain' and not found_plain_successfully: # Solo procesa el primero útil
-                body = part.get('body', {})
-                body_data = body.get('data')
-                if body_data:
-                    logging.info(f"Mensaje {msg_id} - Encontrado text/plain. Intentando decodificar.")
-                    decoded_plain = parse_email_body(body_data)
-                    if decoded_plain:
-                        plain_body_text = decoded_plain # Guardar texto plano decodificado
-                        found_plain_successfully = True
-                        logging.info(f"Mensaje {msg_id} - Decodificación text/plain EXITOSA.")
-                        # No rompemos el bucle, por si hay un HTML mejor formateado (poco probable, pero por completitud)
-                    else:
-                        logging.warning(f"Mensaje {msg_id} - Falló la decodificación del text/plain.")
-                else:
-                     logging.warning(f"Mensaje {msg_id} - Parte text/plain no tiene 'data' en 'body'.")
-
-            # Prioridad 2: text/html (guardar datos para fallback)
-            elif part_mime_type == 'text/html':
-                 body = part.get('body', {})
-                 html_body_data_candidate = body.get('data')
-                 if html_body_data_candidate:
-                     html_body_data = html_body_data_candidate # Guardar datos crudos del HTML
-                     logging.debug(f"Mensaje {msg_id} - Encontrado text/html (para posible fallback).")
-                 else:
-                    logging.warning(f"Mensaje {msg_id} - Parte text/html no tiene 'data' en 'body'.")
+    # --- Lógica para extraer Cuerpo del Texto (según la parte que prefiere el banco) ---
+    # Solo se decodifica la parte que usa el parser; el recorrido termina al encontrarla
+    body_kind, decoded_body = select_body_part(payload, bank_parser.body_part, msg_id)
 
     # --- Decidir qué cuerpo usar ---
-    if found_plain_successfully:
-        logging.info(f"Mensaje {msg_id} - Usando contenido text/plain.")
-        body_text = plain_body_text
-        logging.debug(f"--- INICIO TEXTO PLANO ({msg_id}) ---")
-        logging.debug(body_text[:1000] + "...")
-        logging.debug(f"--- FIN TEXTO PLANO ({msg_id}) ---")
-    elif html_body_data:
-        logging.info(f"Mensaje {msg_id} - No se encontró/decodificó text/plain útil. Usando fallback text/html.")
-        body_text_html = parse_email_body(html_body_data)
-        if body_text_html:
+    if body_kind == 'plain':
+        logging.info("Mensaje %s - Usando contenido text/plain.", msg_id)
+        body_text = decoded_body
+        logging.debug("--- INICIO TEXTO PLANO (%s) ---\n%.1000s...\n--- FIN TEXTO PLANO (%s) ---", msg_id, body_text, msg_id)
+    elif body_kind == 'html':
+        if bank_parser.body_part == 'html':
+            logging.info("Mensaje %s - Usando text/html (parte preferida para %s).", msg_id, bank_parser.name)
+        else:
+            logging.info("Mensaje %s - No se encontró/decodificó text/plain útil. Usando fallback text/html.", msg_id)
+        body_text_html = decoded_body
+        if body_text_html and _parse_html_fast(bank_parser, data, body_text_html, subject, email_year, msg_id):
+            parsed_from_html = True
+        elif body_text_html:
             try:
-                logging.debug(f"Mensaje {msg_id} - Iniciando conversión de HTML a texto plano.")
-                h = html2text.HTML2Text()
-                h.ignore_links = True # Ignorar enlaces puede limpiar el output
-                h.ignore_images = True # Ignorar imágenes
-                body_text = h.handle(body_text_html)
-                logging.info(f"Mensaje {msg_id} - Conversión HTML a texto plano EXITOSA.")
-                logging.debug(f"--- INICIO TEXTO PLANO CONVERTIDO ({msg_id}) ---")
-                logging.debug(body_text[:1000] + "...")
-                logging.debug(f"--- FIN TEXTO PLANO CONVERTIDO ({msg_id}) ---")
+                logging.debug("Mensaje %s - Iniciando conversión de HTML a texto plano.", msg_id)
+                body_text = html_to_text(body_text_html)
+                logging.info("Mensaje %s - Conversión HTML a texto plano EXITOSA.", msg_id)
+                logging.debug("--- INICIO TEXTO PLANO CONVERTIDO (%s) ---\n%.1000s...\n--- FIN TEXTO PLANO CONVERTIDO (%s) ---",
+                              msg_id, body_text, msg_id)
             except Exception as e_conv:
-                 logging.error(f"Mensaje {msg_id} - Error durante la conversión de HTML a texto: {e_conv}")
+                 logging.error("Mensaje %s - Error durante la conversión de HTML a texto: %s", msg_id, e_conv)
                  body_text = None
         else:
-             logging.error(f"Mensaje {msg_id} - Falló la decodificación del text/html fallback.")
+             logging.error("Mensaje %s - Falló la decodificación del text/html fallback.", msg_id)
              body_text = None
     elif payload.get('body', {}).get('data'): # Correos simples (poco probable para estos bancos)
-        # ... (lógica similar para procesar body simple, intentar convertir a texto) ...
-        logging.warning(f"Mensaje {msg_id} - Procesando como correo simple (no multipart).")
+        logging.warning("Mensaje %s - Procesando como correo simple (no multipart).", msg_id)
         raw_body_text = parse_email_body(payload.get('body', {}).get('data'))
-        if raw_body_text:
+        if raw_body_text and _parse_html_fast(bank_parser, data, raw_body_text, subject, email_year, msg_id):
+            parsed_from_html = True
+        elif raw_body_text:
             try:
-                h = html2text.HTML2Text()
-                h.ignore_links = True
-                h.ignore_images = True
-                body_text = h.handle(raw_body_text) # Intentar convertir por si es HTML
+                body_text = html_to_text(raw_body_text) # Intentar convertir por si es HTML
             except Exception as e_conv_simple:
-                logging.error(f"Mensaje {msg_id} - Error procesando body simple: {e_conv_simple}")
+                logging.error("Mensaje %s - Error procesando body simple: %s", msg_id, e_conv_simple)
                 body_text = None
         else: body_text = None
 
 
     # --- Fin Lógica de extracción de cuerpo ---
 
-    if not body_text:
-        logging.error(f"Mensaje {msg_id} - No se pudo extraer/convertir NINGÚN cuerpo de texto útil. Asunto: {subject}")
-        logging.debug(f"Estructura del payload para {msg_id}: {payload}")
-        return None # No se pudo procesar
+    if not parsed_from_html: # Si el parser leyó los datos directo del HTML no hace falta el texto
+        if not body_text:
+            logging.error("Mensaje %s - No se pudo extraer/convertir NINGÚN cuerpo de texto útil. Asunto: %s", msg_id, subject)
+            logging.debug("Estructura del payload para %s: %s", msg_id, payload)
+            return None # No se pudo procesar
 
-    # --- EXTRACCIÓN CON EXPRESIONES REGULARES (CONDICIONAL POR BANCO) ---
-    try:
-        if data['banco'] == 'Naranja X':
-            logging.info(f"Mensaje {msg_id} - Aplicando reglas de extracción para Naranja X.")
-            # Regex para Naranja X (aplicadas a body_text, que debería ser el text/plain)
-
-            # Importe: Busca $ seguido de números con . y ,
-            importe_match = re.search(r"\$(\d[\d.,]+)", body_text)
-            # Comercio: Busca el importe, captura cualquier caracter (no goloso) hasta encontrar "Titular -"
-            comercio_match = re.search(
-                r"\$[\d.,]+"       # Encuentra el importe $17.000,00
-                r"\s*"             # Cero o más espacios/saltos de línea después
-                r"(.*?)"           # Grupo 1: Captura el nombre del comercio (no goloso)
-                r"\s+Titular\s+-"  # Detente cuando encuentres espacio(s), "Titular", espacio(s) y "-"
-                , body_text, re.DOTALL) # re.DOTALL permite a '.' incluir saltos de línea si los hubiera
-
-            if comercio_match:
-                data['comercio'] = comercio_match.group(1).strip() # Captura Grupo 1 y limpia espacios
-                logging.debug(f"Mensaje {msg_id} [NX] - Comercio encontrado: {data['comercio']}")
-            else:
-                # Si aún falla, podríamos intentar buscar entre el importe y "Tarjeta VISA" como último recurso
-                comercio_match_alt = re.search(r"\$[\d.,]+\s*(.*?)\s+Tarjeta\s+VISA", body_text, re.DOTALL)
-                if comercio_match_alt:
-                     data['comercio'] = comercio_match_alt.group(1).strip()
-                     logging.debug(f"Mensaje {msg_id} [NX] - Comercio encontrado (fallback Tarjeta): {data['comercio']}")
-                else:
-                    logging.warning(f"Mensaje {msg_id} [NX] - No se encontró el comercio (ni primario ni fallback).")
-
-            # Tarjeta: Busca "Tarjeta" seguido de VISA o MASTERCARD
-            tarjeta_match = re.search(r"Tarjeta\s+(VISA|MASTERCARD)", body_text, re.IGNORECASE)
-            # Fecha: Busca el patrón Día/MesAbbr
-            fecha_dia_mes_match = re.search(r"(\d{1,2})/([A-Z]{3})", body_text, re.IGNORECASE)
-
-            if importe_match:
-                importe_str = importe_match.group(1)
-                logging.debug(f"Mensaje {msg_id} [NX] - Importe encontrado (str): {importe_str}")
-                importe_str_limpio = importe_str.replace('.', '').replace(',', '.')
-                data['importe'] = float(importe_str_limpio)
-                # Asumir ARS si ve "PESOS" o si no especifica USD explícitamente
-                if "PESOS" in body_text.upper() or "USD" not in body_text.upper():
-                     data['moneda'] = 'ARS'
-                elif "USD" in body_text.upper(): # O buscar U$S?
-                    data['moneda'] = 'USD'
-                logging.debug(f"Mensaje {msg_id} [NX] - Importe (float): {data['importe']}, Moneda: {data['moneda']}")
-            else:
-                logging.warning(f"Mensaje {msg_id} [NX] - No se encontró el importe.")
-
-            if tarjeta_match:
-                data['tarjeta'] = tarjeta_match.group(1).upper()
-                logging.debug(f"Mensaje {msg_id} [NX] - Tarjeta encontrada: {data['tarjeta']}")
-            else:
-                logging.warning(f"Mensaje {msg_id} [NX] - No se encontró el tipo de tarjeta.")
-
-            if fecha_dia_mes_match:
-                 dia = fecha_dia_mes_match.group(1).zfill(2)
-                 mes_abbr = fecha_dia_mes_match.group(2).upper()
-                 mes_num = MESES_MAP.get(mes_abbr)
-                 if mes_num:
-                     data['fecha'] = f"{dia}/{mes_num}/{email_year}" # Usar año del header
-                     logging.debug(f"Mensaje {msg_id} [NX] - Fecha encontrada: {data['fecha']}")
-                 else:
-                     logging.warning(f"Mensaje {msg_id} [NX] - Abreviatura de mes no reconocida: {mes_abbr}")
-            else:
-                 logging.warning(f"Mensaje {msg_id} [NX] - No se encontró la fecha (Día/Mes).")
-
-
-        elif data['banco'] == 'BBVA':
-            logging.info(f"Mensaje {msg_id} - Aplicando reglas de extracción para BBVA.")
-            # Regex para BBVA (aplicadas a body_text, que debería ser el resultado de html2text)
-            # (Usar las regex que ya funcionaban para BBVA)
-            fecha_match = re.search(r"Fecha\s+\|\s*\*\*(.*?)\*\*", body_text, re.IGNORECASE | re.DOTALL) # Ajustada ligeramente
-            comercio_match = re.search(r"Comercio\s+\|\s*\*\*(.*?)\*\*", body_text, re.IGNORECASE | re.DOTALL) # Ajustada ligeramente
-            importe_match = re.search(r"Importe\s+\|\s*\*\*(ARS|USD)\s*([\d.,]+)\*\*", body_text, re.IGNORECASE | re.DOTALL) # Ajustada ligeramente
-
-            if fecha_match:
-                data['fecha'] = fecha_match.group(1).strip()
-                logging.debug(f"Mensaje {msg_id} [BBVA] - Fecha encontrada: {data['fecha']}")
-            else: logging.warning(f"Mensaje {msg_id} [BBVA] - No se encontró la fecha.")
-
-            if comercio_match:
-                data['comercio'] = comercio_match.group(1).strip()
-                logging.debug(f"Mensaje {msg_id} [BBVA] - Comercio encontrado: {data['comercio']}")
-            else: logging.warning(f"Mensaje {msg_id} [BBVA] - No se encontró el comercio.")
-
-            if importe_match:
-                data['moneda'] = importe_match.group(1).upper()
-                importe_str = importe_match.group(2).strip()
-                logging.debug(f"Mensaje {msg_id} [BBVA] - Importe encontrado (str): {importe_str}, Moneda: {data['moneda']}")
-                importe_str_limpio = importe_str.replace('.', '').replace(',', '.')
-                data['importe'] = float(importe_str_limpio)
-                logging.debug(f"Mensaje {msg_id} [BBVA] - Importe (float): {data['importe']}")
-            else: logging.warning(f"Mensaje {msg_id} [BBVA] - No se encontró el importe.")
-
-            # Tarjeta para BBVA (asumimos del asunto)
-            if 'visa' in subject.lower(): data['tarjeta'] = 'VISA'
-            elif 'mastercard' in subject.lower(): data['tarjeta'] = 'MASTERCARD'
-            if data['tarjeta']: logging.debug(f"Mensaje {msg_id} [BBVA] - Tarjeta encontrada (asunto): {data['tarjeta']}")
-            else: logging.warning(f"Mensaje {msg_id} [BBVA] - No se encontró tarjeta en asunto.")
-
-
-        else: # Banco desconocido o no configurado
-            logging.error(f"Mensaje {msg_id} - No hay reglas de extracción definidas para el banco: {data['banco']}")
-            return None
-
-    except Exception as e_regex:
-         logging.error(f"Mensaje {msg_id} - Error durante la aplicación de regex para banco {data['banco']}: {e_regex}", exc_info=True)
-         return None
+        # --- EXTRACCIÓN CON EXPRESIONES REGULARES (SEGÚN EL PARSER DEL BANCO) ---
+        try:
+            logging.info("Mensaje %s - Aplicando reglas de extracción para %s.", msg_id, bank_parser.name)
+            with METRICS.timer('consumos_stage_duration_seconds', stage='regex'):
+                bank_parser.parse(data, body_text, subject, email_year, msg_id)
+        except Exception as e_regex:
+             logging.error("Mensaje %s - Error durante la aplicación de regex para banco %s: %s", msg_id, data['banco'], e_regex, exc_info=True)
+             return None
 
     # --- Verificación final de datos ---
     datos_faltantes = [k for k, v in data.items() if v is None and k != 'moneda'] # Moneda es opcional si no se guarda
     if datos_faltantes:
-        logging.error(f"Mensaje {msg_id} - Faltan datos OBLIGATORIOS al procesar correo: {datos_faltantes}. Banco: {data['banco']}, Asunto: {subject}. Datos extraídos: {data}")
+        logging.error("Mensaje %s - Faltan datos OBLIGATORIOS al procesar correo: %s. Banco: %s, Asunto: %s. Datos extraídos: %s", msg_id, datos_faltantes, data['banco'], subject, data)
         return None # Indica que el parseo falló
 
-    logging.info(f"Mensaje {msg_id} - Datos extraídos OK: {data}")
+    logging.info("Mensaje %s - Datos extraídos OK: %s", msg_id, data)
     return data
 
 
-def append_to_sheet(service, spreadsheet_id, range_name, values):
-    """Añade una fila de datos a la hoja de cálculo."""
+@METRICS.timed('append_to_sheet')
+def append_to_sheet(service, spreadsheet_id, range_name, rows):
+    """Añade varias filas de datos a la hoja de cálculo en una sola llamada."""
     try:
         body = {
-            'values': [values] # values debe ser una lista de listas
+            'values': rows # rows debe ser una lista de listas (una por fila)
         }
         result = service.spreadsheets().values().append(
             spreadsheetId=spreadsheet_id,
@@ -490,97 +1663,1837 @@ def append_to_sheet(service, spreadsheet_id, range_name, values):
             insertDataOption='INSERT_ROWS',
             body=body
         ).execute()
-        logging.info(f"{result.get('updates').get('updatedCells')} celdas añadidas.")
+        updates = result.get('updates', {})
+        logging.info(f"{updates.get('updatedRows', len(rows))} filas ({updates.get('updatedCells')} celdas) añadidas.")
         return True
     except HttpError as error:
-        logging.error(f'Ocurrió un error al añadir datos a Sheets: {error}')
+        logging.error(f'Ocurrió un error al añadir {len(rows)} filas a Sheets: {error}')
         return False
 
-def mark_email_processed(service, user_id, msg_id, processed_label_id):
-    """Marca un correo como leído y le añade la etiqueta 'Procesado'."""
-    try:
-        body = {
-            'removeLabelIds': ['UNREAD'],
-            'addLabelIds': [processed_label_id]
-        }
-        service.users().messages().modify(userId=user_id, id=msg_id, body=body).execute()
-        logging.info(f"Correo {msg_id} marcado como leído y etiquetado como '{PROCESSED_LABEL_NAME}'.")
+@METRICS.timed('mark_emails_processed')
+def mark_emails_processed(service, user_id, msg_ids, processed_label_id):
+    """Marca varios correos como leídos y les añade la etiqueta 'Procesado'.
+
+    Usa messages.batchModify (hasta GMAIL_BATCH_MODIFY_MAX IDs por llamada) y devuelve
+    la lista de IDs que fallaron."""
+    msg_ids = list(msg_ids)
+    failed_ids = []
+    for start in range(0, len(msg_ids), GMAIL_BATCH_MODIFY_MAX):
+        chunk = msg_ids[start:start + GMAIL_BATCH_MODIFY_MAX]
+        try:
+            body = {
+                'ids': chunk,
+                'removeLabelIds': ['UNREAD'],
+                'addLabelIds': [processed_label_id]
+            }
+            service.users().messages().batchModify(userId=user_id, body=body).execute()
+            logging.info(f"{len(chunk)} correos marcados como leídos y etiquetados como '{PROCESSED_LABEL_NAME}'.")
+        except HttpError as error:
+            logging.error(f'Ocurrió un error al modificar {len(chunk)} correos: {error}')
+            failed_ids.extend(chunk)
+    return failed_ids
+
+# --- ALMACENAMIENTO LOCAL ---
+
+class _LocalDatabase:
+    """Conexión SQLite compartida entre los hilos del pipeline (protegida con un lock)."""
+
+    SCHEMA = ()
+
+    def __init__(self, db_file=LOCAL_DB_FILE):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class RawMessageStore(_LocalDatabase):
+    """Guarda en SQLite los correos obtenidos de Gmail y el resultado de su parseo.
+
+    Cada correo se guarda por su ID de Gmail con el JSON completo comprimido (zlib),
+    el estado ('ok', 'fallo' o 'reparseado') y la PARSER_VERSION con la que se parseó. Así:
+      - un correo que ya falló con esta versión del parser no se vuelve a bajar ni a
+        parsear en cada ejecución (sigue sin procesar en Gmail),
+      - si cambia PARSER_VERSION, o si --reparse lo arregló ('reparseado'), se usa la
+        copia local en lugar de pedirlo otra vez a Gmail.
+    Los 'ok' ya se registraron: si vuelven a aparecer (p. ej. falló el marcado) se piden
+    de nuevo a Gmail para ver sus etiquetas actuales.
+    Es seguro usarlo desde varios hilos."""
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS mensajes_crudos (
+            msg_id TEXT PRIMARY KEY,
+            payload BLOB NOT NULL,
+            estado TEXT NOT NULL,
+            parser_version INTEGER NOT NULL,
+            actualizado TEXT NOT NULL
+        )""",
+    )
+
+    @staticmethod
+    def _pack(message):
+        return zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+
+    @staticmethod
+    def _unpack(blob):
+        return json.loads(zlib.decompress(blob))
+
+    def lookup(self, msg_ids):
+        """Devuelve {msg_id: (estado, parser_version, payload comprimido)} de los IDs guardados."""
+        msg_ids = list(msg_ids)
+        if not msg_ids:
+            return {}
+        placeholders = ','.join('?' * len(msg_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT msg_id, estado, parser_version, payload FROM mensajes_crudos WHERE msg_id IN ({placeholders})',
+                msg_ids).fetchall()
+        return {msg_id: (estado, version, payload) for msg_id, estado, version, payload in rows}
+
+    def known_failures(self, msg_ids, chunk_size=500):
+        """IDs de msg_ids cuyo parseo ya falló con la PARSER_VERSION actual."""
+        msg_ids = list(msg_ids)
+        failed = set()
+        with self._lock:
+            for start in range(0, len(msg_ids), chunk_size):
+                chunk = msg_ids[start:start + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                failed.update(row[0] for row in self._conn.execute(
+                    f"SELECT msg_id FROM mensajes_crudos WHERE estado = 'fallo' AND parser_version = ? "
+                    f"AND msg_id IN ({placeholders})", (PARSER_VERSION, *chunk)))
+        return failed
+
+    def load_message(self, packed_payload):
+        """Descomprime un payload devuelto por lookup()."""
+        return self._unpack(packed_payload)
+
+    def save_outcomes(self, outcomes):
+        """Guarda el resultado del parseo de varios correos en una sola transacción.
+
+        outcomes es una lista de (msg_id, message, estado). message puede ser None si
+        el correo ya estaba guardado (solo se actualiza el estado)."""
+        if not outcomes:
+            return
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self._lock, self._conn:
+            for msg_id, message, estado in outcomes:
+                if message is None:
+                    self._conn.execute(
+                        'UPDATE mensajes_crudos SET estado = ?, parser_version = ?, actualizado = ? WHERE msg_id = ?',
+                        (estado, PARSER_VERSION, now, msg_id))
+                else:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO mensajes_crudos (msg_id, payload, estado, parser_version, actualizado) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (msg_id, self._pack(message), estado, PARSER_VERSION, now))
+
+    def iter_failed(self, page_size=500):
+        """Genera (msg_id, message) de los correos guardados cuyo parseo falló, de a páginas."""
+        last_id = ''
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT msg_id, payload FROM mensajes_crudos WHERE estado = 'fallo' AND msg_id > ? "
+                    "ORDER BY msg_id LIMIT ?", (last_id, page_size)).fetchall()
+            if not rows:
+                return
+            for msg_id, payload in rows:
+                yield msg_id, self._unpack(payload)
+            last_id = rows[-1][0]
+
+class TransactionLedger(_LocalDatabase):
+    """Registro local de movimientos: la fuente de verdad de lo ya registrado.
+
+    Cada movimiento se guarda una sola vez por ID de correo (si un correo vuelve a
+    aparecer, por ejemplo porque falló el marcado en Gmail, no se duplica) y una sola
+    vez por Message-ID (el header RFC 822): el mismo correo leído de un --import
+    (ID takeout-...) y de la API de Gmail no se registra dos veces. Se guarda además una
+    huella (fecha, comercio, importe, tarjeta) indexada para detectar el mismo consumo
+    avisado en dos correos distintos. La columna sincronizado indica qué filas ya se
+    escribieron en Sheets.
+
+    En la misma transacción que cada movimiento nuevo se actualizan los totales por
+    (mes, categoría, moneda) y por (semana, categoría, moneda), así el resumen y las
+    alertas de presupuesto nunca recorren el historial completo. alertas_enviadas
+    recuerda qué alertas ya salieron para no repetirlas."""
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS movimientos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            msg_id TEXT NOT NULL UNIQUE,
+            huella TEXT NOT NULL,
+            fecha TEXT NOT NULL,
+            banco TEXT NOT NULL,
+            comercio TEXT NOT NULL,
+            tarjeta TEXT NOT NULL,
+            importe REAL NOT NULL,
+            sincronizado INTEGER NOT NULL DEFAULT 0,
+            registrado TEXT NOT NULL,
+            categoria TEXT,
+            moneda TEXT,
+            message_id TEXT
+        )""",
+        'CREATE INDEX IF NOT EXISTS movimientos_huella ON movimientos (huella)',
+        'CREATE INDEX IF NOT EXISTS movimientos_sin_sincronizar ON movimientos (id) WHERE sincronizado = 0',
+        """CREATE TABLE IF NOT EXISTS totales_mensuales (
+            mes TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            moneda TEXT NOT NULL,
+            total REAL NOT NULL,
+            cantidad INTEGER NOT NULL,
+            PRIMARY KEY (mes, categoria, moneda)
+        )""",
+        """CREATE TABLE IF NOT EXISTS totales_semanales (
+            semana TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            moneda TEXT NOT NULL,
+            total REAL NOT NULL,
+            cantidad INTEGER NOT NULL,
+            PRIMARY KEY (semana, categoria, moneda)
+        )""",
+        """CREATE TABLE IF NOT EXISTS alertas_enviadas (
+            mes TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            umbral INTEGER NOT NULL,
+            enviada TEXT NOT NULL,
+            PRIMARY KEY (mes, categoria, umbral)
+        )""",
+    )
+
+    def __init__(self, db_file=LOCAL_DB_FILE):
+        super().__init__(db_file)
+        columns = {column[1] for column in self._conn.execute('PRAGMA table_info(movimientos)')}
+        with self._conn:
+            # Bases creadas antes de la categorización local, de guardar la moneda y el Message-ID
+            for column in ('categoria', 'moneda', 'message_id'):
+                if column not in columns:
+                    self._conn.execute(f'ALTER TABLE movimientos ADD COLUMN {column} TEXT')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS movimientos_message_id ON movimientos (message_id) '
+                               'WHERE message_id IS NOT NULL')
+            # Bases creadas antes de los totales: se calculan una sola vez desde el registro
+            if (not self._conn.execute('SELECT 1 FROM totales_mensuales LIMIT 1').fetchone()
+                    and self._conn.execute('SELECT 1 FROM movimientos LIMIT 1').fetchone()):
+                logging.info("Calculando los totales por mes y por semana del registro existente...")
+                for row in self._conn.execute(
+                        'SELECT fecha, banco, comercio, tarjeta, importe, categoria, moneda FROM movimientos').fetchall():
+                    self._add_to_totals(row)
+
+    @staticmethod
+    def periods(fecha):
+        """('AAAA-MM', 'AAAA-Wss') de una fecha DD/MM/AAAA: el mes y la semana ISO."""
+        day = datetime.datetime.strptime(fecha, '%d/%m/%Y').date()
+        year, week, _ = day.isocalendar()
+        return f'{day:%Y-%m}', f'{year}-W{week:02d}'
+
+    def _add_to_totals(self, row):
+        """Suma una fila a los totales (dentro de la transacción de quien llama)."""
+        fecha, importe, categoria, moneda = row[0], row[4], row[5], row[6]
+        try:
+            mes, semana = self.periods(fecha)
+        except ValueError:
+            logging.warning(f"Fecha inválida '{fecha}': el movimiento no se suma a los totales.")
+            return
+        for table, column, period in (('totales_mensuales', 'mes', mes), ('totales_semanales', 'semana', semana)):
+            self._conn.execute(
+                f'INSERT INTO {table} ({column}, categoria, moneda, total, cantidad) VALUES (?, ?, ?, ?, 1) '
+                f'ON CONFLICT ({column}, categoria, moneda) DO UPDATE SET '
+                'total = total + excluded.total, cantidad = cantidad + 1',
+                (period, categoria or '', moneda or '', importe))
+
+    @staticmethod
+    def fingerprint(row):
+        """Huella de una fila [fecha, banco, comercio, tarjeta, importe, categoria, moneda] de build_movement_row."""
+        fecha, _, comercio, tarjeta, importe = row[:5]
+        return f"{fecha}|{' '.join(comercio.upper().split())}|{importe:.2f}|{tarjeta}"
+
+    def _same_email(self, msg_id, message_id, huella):
+        """ID del correo ya registrado que es el mismo que msg_id (otra copia), o None.
+
+        Si se lo reconoce por la huella y el registrado no tenía Message-ID, se le guarda
+        el de este correo: así cada movimiento viejo empareja con un solo correo."""
+        if message_id:
+            row = self._conn.execute('SELECT msg_id FROM movimientos WHERE message_id = ? AND msg_id <> ? LIMIT 1',
+                                     (message_id, msg_id)).fetchone()
+            if row:
+                return row[0]
+        # Movimientos registrados antes de guardar el Message-ID: si uno vino de --import y
+        # el otro de la API, la misma huella es el mismo correo
+        for other_id, other_message_id in self._conn.execute(
+                'SELECT msg_id, message_id FROM movimientos WHERE huella = ? AND msg_id <> ?', (huella, msg_id)):
+            if ((not message_id or not other_message_id)
+                    and msg_id.startswith('takeout-') != other_id.startswith('takeout-')):
+                if message_id and not other_message_id:
+                    self._conn.execute('UPDATE movimientos SET message_id = ? WHERE msg_id = ?', (message_id, other_id))
+                return other_id
+        return None
+
+    def record(self, entries):
+        """Registra varias filas (msg_id, row, message_id) en una sola transacción.
+
+        message_id es el header Message-ID del correo (o None si no lo tiene). Devuelve
+        cuántas eran nuevas: las de correos ya registrados (por ID de correo o por
+        Message-ID) se ignoran."""
+        if not entries:
+            return 0
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        new_rows = 0
+        with self._lock, self._conn:
+            for msg_id, row, message_id in entries:
+                huella = self.fingerprint(row)
+                same_email = self._same_email(msg_id, message_id, huella)
+                if same_email:
+                    logging.info(f"El correo {msg_id} es el mismo que el correo {same_email}, ya registrado. No se duplica.")
+                    continue
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO movimientos (msg_id, huella, fecha, banco, comercio, tarjeta, importe, categoria, moneda, '
+                    'message_id, registrado) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (msg_id, huella, *row, message_id, now))
+                if not cursor.rowcount:
+                    logging.info(f"El movimiento del correo {msg_id} ya estaba registrado. No se duplica.")
+                    continue
+                new_rows += 1
+                self._add_to_totals(row)
+                duplicate = self._conn.execute(
+                    'SELECT msg_id FROM movimientos WHERE huella = ? AND msg_id <> ? LIMIT 1', (huella, msg_id)).fetchone()
+                if duplicate:
+                    logging.warning(f"El movimiento del correo {msg_id} coincide con el del correo {duplicate[0]} "
+                                    f"({huella}). Se registra igual: revisa si es un aviso repetido.")
+        return new_rows
+
+    def unsynced(self, limit):
+        """Devuelve hasta limit movimientos sin escribir en Sheets, en orden de registro: [(id, row)].
+
+        row tiene las columnas de build_sheet_row (la moneda queda solo en el registro)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, fecha, banco, comercio, tarjeta, importe, COALESCE(categoria, '') FROM movimientos "
+                'WHERE sincronizado = 0 ORDER BY id LIMIT ?', (limit,)).fetchall()
+        return [(row[0], list(row[1:])) for row in rows]
+
+    def mark_synced(self, ids):
+        with self._lock, self._conn:
+            self._conn.executemany('UPDATE movimientos SET sincronizado = 1 WHERE id = ?', [(i,) for i in ids])
+
+    def iter_movements(self, batch_size):
+        """Recorre todos los movimientos en orden de registro, de a batch_size por lista:
+        [(msg_id, fecha, banco, comercio, tarjeta, importe, categoria, moneda)]."""
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, msg_id, fecha, banco, comercio, tarjeta, importe, COALESCE(categoria, ''), "
+                    "COALESCE(moneda, '') FROM movimientos WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+    def count_unsynced(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM movimientos WHERE sincronizado = 0').fetchone()[0]
+
+    def monthly_totals(self):
+        """[(mes, categoria, moneda, total, cantidad)], del mes más reciente al más viejo."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT mes, categoria, moneda, total, cantidad FROM totales_mensuales '
+                'ORDER BY mes DESC, categoria, moneda').fetchall()
+
+    def weekly_totals(self, weeks):
+        """[(semana, categoria, moneda, total, cantidad)] de las `weeks` semanas más recientes."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT semana, categoria, moneda, total, cantidad FROM totales_semanales '
+                'WHERE semana IN (SELECT DISTINCT semana FROM totales_semanales ORDER BY semana DESC LIMIT ?) '
+                'ORDER BY semana DESC, categoria, moneda', (weeks,)).fetchall()
+
+    def due_budget_alerts(self, budgets, mes, thresholds=BUDGET_ALERT_THRESHOLDS, currency=BUDGET_CURRENCY):
+        """Alertas de presupuesto del mes que corresponde enviar y todavía no se enviaron.
+
+        Devuelve [(categoria, umbral, total, presupuesto, umbrales)]: por categoría, el
+        porcentaje más alto superado; umbrales son todos los superados que falta marcar
+        (si un consumo pasa del 50% al 80% de una vez se manda una sola alerta)."""
+        with self._lock:
+            totals = self._conn.execute('SELECT categoria, total FROM totales_mensuales WHERE mes = ? AND moneda = ?',
+                                        (mes, currency)).fetchall()
+            sent = set(self._conn.execute('SELECT categoria, umbral FROM alertas_enviadas WHERE mes = ?', (mes,)))
+        due = []
+        for categoria, total in totals:
+            presupuesto = budgets.get(categoria)
+            if not presupuesto:
+                continue
+            crossed = [umbral for umbral in sorted(thresholds)
+                       if total >= presupuesto * umbral / 100 and (categoria, umbral) not in sent]
+            if crossed:
+                due.append((categoria, crossed[-1], total, presupuesto, crossed))
+        return due
+
+    def mark_alerts_sent(self, mes, categoria, thresholds):
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO alertas_enviadas (mes, categoria, umbral, enviada) VALUES (?, ?, ?, ?)',
+                                   [(mes, categoria, umbral, now) for umbral in thresholds])
+
+def sync_ledger_to_sheet(service, ledger, spreadsheet_id, range_name, max_rows=SHEETS_FLUSH_ROWS):
+    """Escribe en Sheets, en bloques de max_rows, los movimientos que aún no se sincronizaron.
+
+    Si una escritura falla se detiene: esas filas quedan pendientes para la próxima
+    sincronización. Devuelve la cantidad de filas escritas."""
+    synced = 0
+    while True:
+        pending = ledger.unsynced(max_rows)
+        if not pending:
+            return synced
+        logging.info(f"Escribiendo {len(pending)} filas en Sheets.")
+        try:
+            written = append_to_sheet(service, spreadsheet_id, range_name, [row for _, row in pending])
+        except Exception as e: # Ej: errores de red, que no llegan como HttpError
+            logging.error(f'Ocurrió un error inesperado al añadir {len(pending)} filas a Sheets: {e}', exc_info=True)
+            written = False
+        if not written:
+            logging.error(f"No se pudieron añadir a Sheets {len(pending)} filas. Se reintentarán en la próxima sincronización.")
+            return synced
+        ledger.mark_synced([row_id for row_id, _ in pending])
+        synced += len(pending)
+
+class KnownParseFailure(Exception):
+    """El correo ya falló al parsearse con la PARSER_VERSION actual (según el almacenamiento local)."""
+
+def reparse_stored_messages(store):
+    """Modo --reparse: vuelve a extraer los datos de los correos guardados que fallaron.
+
+    No usa la API de Gmail. Los que ahora se parsean bien quedan en estado 'ok' y la
+    próxima ejecución normal los registra usando la copia local."""
+    total = fixed = 0
+    batch = []
+    for msg_id, message in store.iter_failed():
+        total += 1
+        ok = extract_data_from_email(message) is not None
+        fixed += ok
+        batch.append((msg_id, None, 'reparseado' if ok else 'fallo'))
+        if len(batch) >= 500:
+            store.save_outcomes(batch)
+            batch = []
+    store.save_outcomes(batch)
+    logging.info(f"Reparse: {total} correos con fallos revisados, {fixed} ahora se extraen bien "
+                 f"(se registrarán en la próxima ejecución).")
+    return total, fixed
+
+# --- CATEGORIZACIÓN DE COMERCIOS ---
+# La categoría de cada consumo se asigna acá, con la hoja MapeoComercios (Comercio,
+# CategoriaAsignada) cargada en memoria, en lugar de con fórmulas de búsqueda en la
+# planilla que se recalculan sobre todas las filas. Para cada comercio se prueba, en
+# orden: coincidencia exacta, un comercio del mapeo que aparezca en el nombre al
+# comienzo de una palabra ("YPF" para "YPF SERVICENTRO 1234") y, por último, el más
+# parecido. Los nombres se comparan normalizados (mayúsculas, sin acentos ni signos).
+
+_MERCHANT_SEPARATORS_RE = re.compile(r'[^A-Z0-9]+')
+
+def normalize_merchant(name):
+    """'Café del Ángel*2' -> 'CAFE DEL ANGEL 2'."""
+    text = unicodedata.normalize('NFKD', name.upper())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _MERCHANT_SEPARATORS_RE.sub(' ', text).strip()
+
+class MerchantPatternMatcher:
+    """Autómata de Aho-Corasick: busca todos los patrones en un texto en una sola pasada.
+
+    longest_match devuelve el índice del patrón más largo encontrado (entre dos del
+    mismo largo, el que está antes en la lista) o None."""
+
+    def __init__(self, patterns):
+        self._lengths = [len(pattern) for pattern in patterns]
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None] # Patrón más largo que termina en cada nodo
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                node = child
+            if self._output[node] is None:
+                self._output[node] = index
+        # Enlaces de falla por niveles (BFS): el sufijo más largo que también es prefijo
+        pending = collections.deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self._goto[node].items():
+                pending.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0) if node else 0
+                if self._output[child] is None:
+                    self._output[child] = self._output[self._fail[child]]
+
+    def longest_match(self, text):
+        node = 0
+        best = None
+        for char in text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            found = self._output[node]
+            if found is not None and (best is None or self._lengths[found] > self._lengths[best]
+                                      or (self._lengths[found] == self._lengths[best] and found < best)):
+                best = found
+        return best
+
+class MerchantIndex:
+    """Índice en memoria de las filas de MapeoComercios, con caché de resultados."""
+
+    def __init__(self, rows, huella=None):
+        self.huella = huella
+        self._exact = {}
+        for row in rows:
+            if len(row) >= 2 and str(row[0]).strip() and str(row[1]).strip():
+                self._exact.setdefault(normalize_merchant(str(row[0])), str(row[1]).strip())
+        self._exact.pop('', None)
+        self._names = list(self._exact)
+        # Con un espacio adelante, los patrones solo coinciden al comienzo de una palabra
+        self._matcher = MerchantPatternMatcher([' ' + name for name in self._names])
+        self.categorize = functools.lru_cache(maxsize=CATEGORIA_CACHE_SIZE)(self._categorize)
+
+    def __len__(self):
+        return len(self._names)
+
+    def _categorize(self, comercio):
+        """Categoría del comercio, o '' si no se parece a ninguno del mapeo."""
+        name = normalize_merchant(comercio or '')
+        if not name or not self._names:
+            return ''
+        category = self._exact.get(name)
+        if category is not None:
+            return category
+        found = self._matcher.longest_match(' ' + name)
+        if found is not None:
+            return self._exact[self._names[found]]
+        close = difflib.get_close_matches(name, self._names, n=1, cutoff=CATEGORIA_FUZZY_MIN_RATIO)
+        return self._exact[close[0]] if close else ''
+
+class MerchantCategories:
+    """Categorías de comercios según MapeoComercios, leído de Sheets o de la copia local.
+
+    refresh() lee la hoja y reconstruye el índice solo si el contenido cambió (así en
+    --daemon se conserva la caché de resultados entre pasadas). Si la lectura falla se
+    usa la última copia guardada en cache_file."""
+
+    def __init__(self, cache_file=MAPEO_COMERCIOS_CACHE_FILE):
+        self.cache_file = cache_file
+        self._index = MerchantIndex([])
+
+    def categorize(self, comercio):
+        return self._index.categorize(comercio)
+
+    def refresh(self, service_sheets, spreadsheet_id=SPREADSHEET_ID, range_name=MAPEO_COMERCIOS_RANGE):
+        try:
+            result = service_sheets.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id, range=range_name).execute()
+        except Exception as e: # HttpError o errores de red: se sigue con lo que haya
+            logging.warning(f"No se pudo leer {range_name} ({e}). Se usa la copia local de las categorías.")
+            if not self._index.huella:
+                self.load_cached()
+            return
+        rows = result.get('values', [])
+        if self._use(rows):
+            try:
+                _write_atomically(self.cache_file, json.dumps({'huella': self._index.huella, 'filas': rows}, ensure_ascii=False))
+            except OSError as e:
+                logging.warning(f"No se pudo guardar la copia local de las categorías en {self.cache_file}: {e}")
+
+    def load_cached(self):
+        """Usa la copia local de MapeoComercios (por ejemplo en --import, sin conexión)."""
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                rows = json.load(f).get('filas', [])
+        except (OSError, ValueError) as e:
+            logging.warning(f"No hay copia local de las categorías ({self.cache_file}: {e}). Los consumos quedan sin categoría.")
+            return
+        self._use(rows)
+
+    def _use(self, rows):
+        """Reemplaza el índice si las filas cambiaron; devuelve True si lo reemplazó."""
+        huella = hashlib.sha1(json.dumps(rows, ensure_ascii=False).encode('utf-8')).hexdigest()
+        if huella == self._index.huella:
+            return False
+        self._index = MerchantIndex(rows, huella)
+        logging.info(f"Categorías de comercios cargadas: {len(self._index)} comercios en el mapeo.")
         return True
-    except HttpError as error:
-        logging.error(f'Ocurrió un error al modificar el correo {msg_id}: {error}')
-        return False
+
+MERCHANT_CATEGORIES = MerchantCategories()
+
+# --- RESUMEN Y ALERTAS DE PRESUPUESTO ---
+# Los totales por mes y por semana los mantiene el registro local a medida que entran
+# movimientos (ver TransactionLedger). Con ellos se escribe la hoja de resumen y se
+# revisa el presupuesto del mes en cuanto se registra cada bloque, en lugar de que el
+# Dashboard y el Apps Script de alertas recorran todas las filas de la planilla.
+
+def load_budgets(service_sheets, spreadsheet_id=SPREADSHEET_ID, range_name=PRESUPUESTO_RANGE):
+    """Lee el presupuesto mensual por categoría: {categoria: monto}. Devuelve {} si falla."""
+    try:
+        result = service_sheets.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id, range=range_name, valueRenderOption='UNFORMATTED_VALUE').execute()
+    except Exception as e:
+        logging.warning(f"No se pudo leer el presupuesto de {range_name} ({e}). No se revisarán alertas en esta pasada.")
+        return {}
+    budgets = {}
+    for row in result.get('values', []):
+        if len(row) < 2 or not str(row[0]).strip():
+            continue
+        try:
+            budgets[str(row[0]).strip()] = float(row[1])
+        except (TypeError, ValueError):
+            logging.warning(f"Presupuesto inválido para '{row[0]}': {row[1]!r}. Se ignora.")
+    return budgets
+
+def send_budget_alert(service_gmail, user_id, to_address, mes, categoria, umbral, total, presupuesto):
+    """Manda por Gmail la alerta de que una categoría superó `umbral`% del presupuesto del mes."""
+    alert = email.message.EmailMessage()
+    alert['To'] = to_address
+    alert['Subject'] = f"Alerta de presupuesto: {categoria} superó el {umbral}% en {mes}"
+    alert.set_content(
+        f"Los consumos de la categoría '{categoria}' en {mes} suman {total:,.2f} {BUDGET_CURRENCY}, "
+        f"el {100 * total / presupuesto:.0f}% del presupuesto mensual ({presupuesto:,.2f} {BUDGET_CURRENCY}).\n")
+    raw = base64.urlsafe_b64encode(alert.as_bytes()).decode('ascii')
+    service_gmail.users().messages().send(userId=user_id, body={'raw': raw}).execute()
+    logging.info(f"Alerta enviada a {to_address}: {categoria} superó el {umbral}% del presupuesto de {mes}.")
+
+def send_due_budget_alerts(service_gmail, user_id, ledger, budgets, recipient=None, today=None):
+    """Manda las alertas del mes actual que correspondan y las marca como enviadas.
+
+    recipient es un dict compartido entre llamadas con la dirección a la que se mandan
+    ('address'); si no la trae, se usa la de la cuenta (se pide una sola vez)."""
+    if not budgets:
+        return 0
+    mes = f'{today or datetime.date.today():%Y-%m}'
+    recipient = recipient if recipient is not None else {}
+    sent = 0
+    for categoria, umbral, total, presupuesto, thresholds in ledger.due_budget_alerts(budgets, mes):
+        try:
+            if 'address' not in recipient:
+                recipient['address'] = service_gmail.users().getProfile(userId=user_id).execute()['emailAddress']
+            send_budget_alert(service_gmail, user_id, recipient['address'], mes, categoria, umbral, total, presupuesto)
+        except Exception as e: # Queda sin marcar: se reintenta en la próxima revisión
+            logging.error(f"No se pudo enviar la alerta de presupuesto de {categoria} ({umbral}%): {e}")
+            continue
+        ledger.mark_alerts_sent(mes, categoria, thresholds)
+        sent += 1
+    return sent
+
+def write_summary_sheet(service_sheets, ledger, budgets, spreadsheet_id=SPREADSHEET_ID, sheet_name=RESUMEN_SHEET_NAME):
+    """Reescribe la hoja de resumen: totales por mes (A:G) y de las últimas semanas (I:M)."""
+    monthly = [['Mes', 'Categoria', 'Moneda', 'Total', 'Cantidad', 'Presupuesto', '% Presupuesto']]
+    for mes, categoria, moneda, total, cantidad in ledger.monthly_totals():
+        presupuesto = budgets.get(categoria) if moneda == BUDGET_CURRENCY else None
+        monthly.append([mes, categoria or 'Sin categoría', moneda, round(total, 2), cantidad,
+                        presupuesto or '', round(100 * total / presupuesto, 1) if presupuesto else ''])
+    weekly = [['Semana', 'Categoria', 'Moneda', 'Total', 'Cantidad']]
+    weekly += [[semana, categoria or 'Sin categoría', moneda, round(total, 2), cantidad]
+               for semana, categoria, moneda, total, cantidad in ledger.weekly_totals(RESUMEN_SEMANAS)]
+    values = service_sheets.spreadsheets().values()
+    # Se borra antes de escribir: las semanas que salen del resumen no deben quedar abajo
+    values.batchClear(spreadsheetId=spreadsheet_id, body={'ranges': [f'{sheet_name}!A:M']}).execute()
+    values.batchUpdate(spreadsheetId=spreadsheet_id, body={
+        'valueInputOption': 'RAW',
+        'data': [{'range': f'{sheet_name}!A1', 'values': monthly}, {'range': f'{sheet_name}!I1', 'values': weekly}],
+    }).execute()
+    logging.info(f"Hoja '{sheet_name}' actualizada: {len(monthly) - 1} totales mensuales, {len(weekly) - 1} semanales.")
+
+# --- IMPORTACIÓN DE ARCHIVOS (TAKEOUT) ---
+# El modo --import lee un .mbox de Google Takeout (o una carpeta de .eml) sin usar la
+# API de Gmail. Cada correo se convierte a la misma estructura que devuelve
+# messages.get, así extract_data_from_email y los parsers de bancos no cambian, y los
+# movimientos van al registro local como en una ejecución normal: la próxima
+# ejecución los escribe en Sheets.
+
+def _decode_header(value):
+    """Decodifica un header con palabras codificadas (=?UTF-8?B?...?=), como hace Gmail."""
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (email.errors.HeaderParseError, LookupError, UnicodeDecodeError):
+        return str(value)
+
+class EmailPartPayload:
+    """Parte de un correo de la librería email vista como un dict 'payload'/'parts' de Gmail.
+
+    extract_data_from_email solo usa get() sobre el payload y sus partes: se responden
+    'mimeType', 'headers', 'parts' y 'body' (con 'data' en base64url, como la API). El
+    contenido de una parte recién se decodifica cuando se pide, así los correos que
+    no llegan a leer el cuerpo no pagan ese costo."""
+
+    __slots__ = ('_part',)
+
+    def __init__(self, part):
+        self._part = part
+
+    def get(self, key, default=None):
+        part = self._part
+        if key == 'mimeType':
+            return part.get_content_type()
+        if key == 'headers':
+            return [{'name': name, 'value': _decode_header(value)} for name, value in part.items()]
+        if key == 'parts':
+            return [EmailPartPayload(sub_part) for sub_part in part.get_payload()] if part.is_multipart() else default
+        if key == 'body':
+            if part.is_multipart():
+                return {'size': 0}
+            content = part.get_payload(decode=True) or b''
+            body = {'size': len(content)}
+            if content:
+                body['data'] = base64.urlsafe_b64encode(content).decode('ascii')
+            return body
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __repr__(self):
+        return f"EmailPartPayload({self._part.get_content_type()})"
+
+def message_from_bytes(raw):
+    """Arma un mensaje con el formato de Gmail a partir de un correo crudo (RFC 822).
+
+    Primero se leen solo los headers: si el remitente no es un banco conocido devuelve
+    None sin parsear el resto (en un Takeout la mayoría de los correos no son avisos)."""
+    headers = email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(raw)
+    if not find_bank_parser(_decode_header(headers.get('From', ''))):
+        return None
+    # Un ID estable (por Message-ID) hace que importar dos veces el mismo archivo no duplique movimientos;
+    # el registro además reconoce por Message-ID los correos que también llegan por la API
+    message_id = headers.get('Message-ID', '').strip()
+    digest = hashlib.sha1(message_id.encode('utf-8', 'replace') if message_id else raw).hexdigest()
+    parsed = email.parser.BytesParser(policy=email.policy.compat32).parsebytes(raw)
+    return {'id': f'takeout-{digest[:16]}', 'labelIds': [], 'sizeEstimate': len(raw),
+            'payload': EmailPartPayload(parsed)}
+
+_MBOXRD_QUOTED_FROM_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+def iter_mbox_messages(path):
+    """Genera los correos (bytes) de un archivo mbox, uno por vez.
+
+    El archivo se mapea en memoria y se buscan los separadores "From " al comienzo de
+    línea: solo se copia el correo actual, y cada MBOX_RELEASE_BYTES se le indica al
+    sistema que las páginas ya recorridas se pueden liberar, así la memoria no crece
+    con el tamaño del archivo."""
+    with open(path, 'rb') as mbox_file:
+        if not os.fstat(mbox_file.fileno()).st_size:
+            return
+        with mmap.mmap(mbox_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:5] != b'From ':
+                raise ValueError(f"{path} no es un archivo mbox (no empieza con 'From ').")
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            released = 0
+            start = 0
+            size = len(mapped)
+            while start < size:
+                content_start = mapped.find(b'\n', start) + 1 # Saltea la línea "From ..."
+                if not content_start:
+                    return
+                end = mapped.find(b'\nFrom ', content_start)
+                end = size if end == -1 else end + 1
+                raw = mapped[content_start:end]
+                if b'>From ' in raw: # mboxrd: las líneas "From " del cuerpo vienen escapadas con ">"
+                    raw = _MBOXRD_QUOTED_FROM_RE.sub(rb'\1', raw)
+                yield raw
+                start = end
+                if hasattr(mapped, 'madvise') and start - released >= MBOX_RELEASE_BYTES:
+                    release_to = start - start % mmap.PAGESIZE
+                    mapped.madvise(mmap.MADV_DONTNEED, released, release_to - released)
+                    released = release_to
+
+def iter_eml_messages(directory):
+    """Genera los correos (bytes) de los archivos .eml de una carpeta (y sus subcarpetas), en orden."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.eml'):
+                with open(os.path.join(root, name), 'rb') as eml_file:
+                    yield eml_file.read()
+
+def iter_archive_messages(path):
+    """Correos crudos de un mbox, un .eml suelto o una carpeta de .eml."""
+    if os.path.isdir(path):
+        return iter_eml_messages(path)
+    if path.lower().endswith('.eml'):
+        with open(path, 'rb') as eml_file:
+            return iter([eml_file.read()])
+    return iter_mbox_messages(path)
+
+def import_archive(path, ledger, bulk_size=IMPORT_BULK_ROWS):
+    """Modo --import: extrae los consumos de un archivo mbox o de .eml y los registra.
+
+    Los movimientos se guardan en el registro local de a bulk_size por transacción; la
+    próxima ejecución normal los escribe en Sheets. Devuelve (correos leídos, de bancos,
+    movimientos nuevos)."""
+    total = from_banks = new_rows = 0
+    entries = []
+    with METRICS.timer('consumos_stage_duration_seconds', stage='importacion'):
+        for raw in iter_archive_messages(path):
+            total += 1
+            if total % 10000 == 0:
+                logging.info(f"Importación: {total} correos leídos, {from_banks} de bancos conocidos.")
+            message = message_from_bytes(raw)
+            if message is None:
+                continue
+            from_banks += 1
+            data = extract_data_from_email(message)
+            METRICS.inc('consumos_parse_total', banco=find_bank_parser(message_header(message, 'From')).name,
+                        resultado='ok' if data else 'fallo')
+            if data:
+                entries.append((message['id'], build_movement_row(data), message_rfc822_id(message)))
+            if len(entries) >= bulk_size:
+                new_rows += ledger.record(entries)
+                entries = []
+        new_rows += ledger.record(entries)
+    METRICS.inc('consumos_messages_reviewed_total', total)
+    logging.info(f"Importación de {path}: {total} correos leídos, {from_banks} de bancos conocidos, "
+                 f"{new_rows} movimientos nuevos (se escribirán en Sheets en la próxima ejecución).")
+    return total, from_banks, new_rows
+
+# --- EXPORTACIÓN PARA ANÁLISIS ---
+# --export escribe los movimientos del registro local en Parquet (o Arrow IPC), una
+# carpeta por mes (mes=AAAA-MM, el particionado "hive" que entienden pyarrow, pandas,
+# DuckDB o Spark). Para los informes se leen esos archivos en lugar de bajar la hoja
+# entera de Sheets; load_export() y rollup() cubren los totales habituales:
+#
+#     tabla = load_export('export/', months=['2024-01', '2024-02'])
+#     rollup(tabla, ('mes', 'categoria'), currency='ARS')
+#     -> [('2024-01', 'Supermercado', 152300.5, 41), ...]
+#
+# pyarrow y numpy son opcionales (pip install pyarrow numpy): solo se importan acá.
+
+def _export_schema(pa):
+    return pa.schema([('msg_id', pa.string()), ('fecha', pa.date32()), ('banco', pa.string()),
+                      ('comercio', pa.string()), ('tarjeta', pa.string()), ('importe', pa.float64()),
+                      ('categoria', pa.string()), ('moneda', pa.string()), ('mes', pa.string())])
+
+def _month_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([('mes', pa.string())]), flavor='hive')
+
+def export_ledger(ledger, out_dir, fmt='parquet', batch_rows=EXPORT_BATCH_ROWS):
+    """Modo --export: escribe todos los movimientos del registro local en out_dir.
+
+    Los meses exportados se reemplazan enteros (volver a exportar no duplica filas) y
+    los demás archivos de out_dir no se tocan. Devuelve (movimientos, meses)."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    schema = _export_schema(pa)
+    exported, months = 0, set()
+
+    def batches():
+        nonlocal exported
+        for chunk in ledger.iter_movements(batch_rows):
+            columns = [pa.array(values, type=field.type if field.name != 'fecha' else pa.string())
+                       for values, field in zip(zip(*chunk), schema)]
+            # Las fechas se convierten en bloque (DD/MM/AAAA -> date32) en lugar de fila por fila
+            fechas = pc.strptime(columns[1], format='%d/%m/%Y', unit='s', error_is_null=True).cast(pa.date32())
+            valid = pc.is_valid(fechas)
+            if not pc.all(valid).as_py():
+                for msg_id, fecha in zip(columns[0].filter(pc.invert(valid)).to_pylist(),
+                                         columns[1].filter(pc.invert(valid)).to_pylist()):
+                    logging.warning(f"Fecha inválida '{fecha}' en el movimiento del correo {msg_id}: no se exporta.")
+            columns[1] = fechas
+            batch = pa.RecordBatch.from_arrays(columns + [pc.strftime(fechas, format='%Y-%m')], schema=schema).filter(valid)
+            exported += batch.num_rows
+            months.update(pc.unique(batch.column('mes')).to_pylist())
+            yield batch
+
+    with METRICS.timer('consumos_stage_duration_seconds', stage='exportacion'):
+        ds.write_dataset(batches(), out_dir, schema=schema, format=EXPORT_FORMATS[fmt],
+                         partitioning=_month_partitioning(), existing_data_behavior='delete_matching',
+                         basename_template=f'movimientos-{{i}}.{fmt}')
+    logging.info(f"Exportación a {out_dir} ({fmt}): {exported} movimientos de {len(months)} meses.")
+    return exported, len(months)
+
+def load_export(path, fmt='parquet', months=None, columns=None):
+    """Lee una exportación de --export como tabla de pyarrow.
+
+    Con months (lista de 'AAAA-MM') solo se abren las carpetas de esos meses, y con
+    columns solo se leen esas columnas (para rollup alcanza con las de by e 'importe',
+    más 'moneda' si se filtra por moneda)."""
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format=EXPORT_FORMATS[fmt], partitioning=_month_partitioning())
+    month_filter = ds.field('mes').isin(list(months)) if months else None
+    return dataset.to_table(columns=columns, filter=month_filter)
+
+def rollup(table, by=('mes', 'categoria'), currency=None):
+    """Suma los importes de una tabla de load_export agrupando por las columnas `by`.
+
+    Devuelve [(*valores de by, total, cantidad)] ordenado por los valores de by. Con
+    currency solo se suman los movimientos en esa moneda (sumar ARS y USD no tiene
+    sentido: sin currency conviene incluir 'moneda' en by). Cada columna se convierte
+    en códigos enteros con dictionary_encode, se combinan en una sola clave y numpy
+    hace la suma por grupo (bincount), sin recorrer las filas en Python."""
+    import numpy as np
+    import pyarrow.compute as pc
+    unknown = set(by) - set(ROLLUP_COLUMNS)
+    if unknown:
+        raise ValueError(f"No se puede agrupar por {sorted(unknown)}; columnas posibles: {', '.join(ROLLUP_COLUMNS)}.")
+    if currency:
+        table = table.filter(pc.equal(table['moneda'], currency))
+    if not table.num_rows:
+        return []
+    codes, labels = [], []
+    for column in by:
+        encoded = pc.fill_null(table[column], '').combine_chunks().dictionary_encode()
+        codes.append(encoded.indices.to_numpy(zero_copy_only=False))
+        labels.append(encoded.dictionary.to_pylist())
+    shape = [len(values) for values in labels]
+    group = np.ravel_multi_index(codes, shape) if codes else np.zeros(table.num_rows, dtype=np.int64)
+    importes = table['importe'].to_numpy()
+    combinations = math.prod(shape)
+    if combinations <= 4 * table.num_rows:
+        # Pocas combinaciones posibles (lo normal): se suma directo por clave, sin ordenar
+        counts = np.bincount(group, minlength=combinations)
+        totals = np.bincount(group, weights=importes, minlength=combinations)
+        keys = np.flatnonzero(counts)
+        counts, totals = counts[keys], totals[keys]
+    else:
+        keys, inverse = np.unique(group, return_inverse=True)
+        totals = np.bincount(inverse, weights=importes, minlength=len(keys))
+        counts = np.bincount(inverse, minlength=len(keys))
+    key_codes = np.unravel_index(keys, shape) if codes else ()
+    rows = [(*(values[code[i]] for values, code in zip(labels, key_codes)), float(totals[i]), int(counts[i]))
+            for i in range(len(keys))]
+    rows.sort(key=lambda row: row[:len(by)])
+    return rows
+
+# --- CUENTAS ---
+# Sin --accounts se procesa una sola cuenta, configurada con las constantes de arriba.
+# Con --accounts ARCHIVO se procesan varias (integrantes de la casa, empresas) en el
+# mismo proceso, cada una con su token, etiqueta, planilla, bancos, base local y cuota
+# de las APIs. El archivo es una lista JSON, por ejemplo:
+#
+#     [{"nombre": "ana", "planilla": "1AbC...", "bancos": ["BBVA"]},
+#      {"nombre": "empresa", "planilla": "9XyZ...", "etiqueta": "empresa-tarjetas", "hoja": "Gastos",
+#       "cuota_gmail": 5000, "email_alertas": "admin@empresa.com"}]
+#
+# Los archivos que no se indican salen de los de una sola cuenta con el nombre agregado
+# (token_ana.json, consumos_local_ana.db, history_checkpoint_ana.json, mapeo_comercios_ana.json).
+
+def _account_file(path, name):
+    root, ext = os.path.splitext(path)
+    return f'{root}_{name}{ext}'
+
+class Account:
+    """Una cuenta a procesar: de dónde se leen sus correos, adónde van sus movimientos y
+    con qué cuota. banks (nombres de BankParser) limita los bancos que se procesan."""
+
+    # Claves del archivo de --accounts y el atributo que configuran
+    CONFIG_KEYS = {'nombre': 'name', 'planilla': 'spreadsheet_id', 'token': 'token_file', 'etiqueta': 'label',
+                   'hoja': 'sheet_range', 'bancos': 'banks', 'base_local': 'local_db', 'cuota_gmail': 'gmail_quota',
+                   'cuota_sheets': 'sheets_quota', 'email_alertas': 'alert_email'}
+
+    def __init__(self, name, spreadsheet_id=SPREADSHEET_ID, token_file=TOKEN_FILE, label=GMAIL_LABEL_TO_SEARCH,
+                 sheet_range=SHEET_RANGE_NAME, banks=None, local_db=LOCAL_DB_FILE,
+                 checkpoint_file=HISTORY_CHECKPOINT_FILE, categories=MERCHANT_CATEGORIES,
+                 gmail_quota=GMAIL_QUOTA_UNITS_PER_MINUTE, sheets_quota=SHEETS_REQUESTS_PER_MINUTE,
+                 alert_email=BUDGET_ALERT_EMAIL, metric_labels=None):
+        self.name = name
+        self.spreadsheet_id = spreadsheet_id
+        self.token_file = token_file
+        self.label = label
+        self.sheet_range = sheet_range
+        self.banks = frozenset(banks) if banks is not None else None
+        self.local_db = local_db
+        self.checkpoint_file = checkpoint_file
+        self.categories = categories
+        self.gmail_quota = gmail_quota
+        self.sheets_quota = sheets_quota
+        self.alert_email = alert_email
+        # Etiquetas de las métricas de la pasada (vacías con una sola cuenta)
+        self.metric_labels = metric_labels or {}
+
+    @classmethod
+    def from_args(cls, args):
+        """La cuenta de una ejecución sin --accounts."""
+        return cls('principal', local_db=args.local_db, gmail_quota=args.gmail_quota, sheets_quota=args.sheets_quota)
+
+    @classmethod
+    def from_config(cls, entry, args):
+        """Arma una cuenta a partir de una entrada del archivo de --accounts (ValueError si es inválida).
+
+        Las cuotas que no se indican son las de --gmail-quota y --sheets-quota."""
+        if not isinstance(entry, dict):
+            raise ValueError(f'cada cuenta debe ser un objeto JSON, no {entry!r}')
+        unknown = set(entry) - set(cls.CONFIG_KEYS)
+        if unknown:
+            raise ValueError(f"claves desconocidas {sorted(unknown)} (se aceptan: {', '.join(cls.CONFIG_KEYS)})")
+        name = entry.get('nombre')
+        if not isinstance(name, str) or not re.fullmatch(r'[\w.-]+', name):
+            raise ValueError(f"'nombre' es obligatorio y solo puede tener letras, números, '.', '-' y '_' ({name!r})")
+        if not isinstance(entry.get('planilla'), str) or not entry['planilla']:
+            raise ValueError(f"la cuenta '{name}' no tiene 'planilla' (el ID de su hoja de cálculo)")
+        config = {cls.CONFIG_KEYS[key]: value for key, value in entry.items()}
+        banks = config.get('banks')
+        if banks is not None:
+            known = {parser.name for parser in BANK_PARSERS_BY_DOMAIN.values()}
+            if not isinstance(banks, list) or not set(banks) <= known:
+                raise ValueError(f"'bancos' de la cuenta '{name}' debe ser una lista con algunos de: {', '.join(sorted(known))}")
+        for key in ('cuota_gmail', 'cuota_sheets'):
+            if key in entry and (not isinstance(entry[key], int) or entry[key] < 0):
+                raise ValueError(f"'{key}' de la cuenta '{name}' debe ser un entero no negativo")
+        config.setdefault('token_file', _account_file(TOKEN_FILE, name))
+        config.setdefault('local_db', _account_file(LOCAL_DB_FILE, name))
+        config.setdefault('gmail_quota', args.gmail_quota)
+        config.setdefault('sheets_quota', args.sheets_quota)
+        config.setdefault('alert_email', None)
+        return cls(**config, checkpoint_file=_account_file(HISTORY_CHECKPOINT_FILE, name),
+                   categories=MerchantCategories(_account_file(MAPEO_COMERCIOS_CACHE_FILE, name)),
+                   metric_labels={'cuenta': name})
+
+def load_accounts(path, args):
+    """Lee el archivo de --accounts; devuelve la lista de Account (ValueError si es inválido)."""
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('debe ser una lista JSON con al menos una cuenta')
+    accounts = [Account.from_config(entry, args) for entry in entries]
+    for attribute, description in (('name', 'nombre'), ('token_file', 'token'), ('local_db', 'base_local')):
+        values = [getattr(account, attribute) for account in accounts]
+        repeated = sorted({value for value in values if values.count(value) > 1})
+        if repeated:
+            raise ValueError(f"dos cuentas no pueden compartir '{description}': {', '.join(repeated)}")
+    return accounts
 
 # --- FUNCIÓN PRINCIPAL ---
-def main():
-    logging.info("Iniciando proceso de lectura de consumos...")
-    service_gmail, service_sheets = authenticate_google_apis()
+def _parse_date_arg(value):
+    """Convierte un argumento AAAA-MM-DD en fecha (para argparse)."""
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Fecha inválida '{value}', se espera AAAA-MM-DD.")
+
+def parse_args(argv=None):
+    """Lee las opciones de línea de comandos."""
+    parser = argparse.ArgumentParser(description='Lee los consumos de tarjeta desde Gmail y los registra en Google Sheets.')
+    parser.add_argument('--batch-size', type=int, default=GMAIL_BATCH_SIZE,
+                        help=f'Correos a pedir por llamada batch a Gmail (1-{GMAIL_BATCH_MAX}, por defecto {GMAIL_BATCH_SIZE}).')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'Usa la API de historial de Gmail para pedir solo los correos nuevos desde la última ejecución (checkpoint en {HISTORY_CHECKPOINT_FILE}).')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Importa el historial completo de la etiqueta (incluye correos ya leídos) entre --since y --until.')
+    parser.add_argument('--since', type=_parse_date_arg,
+                        help='Fecha inicial del backfill (AAAA-MM-DD, inclusive).')
+    parser.add_argument('--until', type=_parse_date_arg, default=datetime.date.today(),
+                        help='Fecha final del backfill (AAAA-MM-DD, inclusive; por defecto hoy).')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Queda corriendo y revisa el correo periódicamente, autenticando una sola vez (en lugar de usar cron).')
+    parser.add_argument('--interval', type=int, default=DAEMON_INTERVAL,
+                        help=f'Segundos entre revisiones en modo --daemon (por defecto {DAEMON_INTERVAL}).')
+    parser.add_argument('--jitter', type=int, default=DAEMON_JITTER,
+                        help=f'Variación aleatoria máxima, en segundos, del intervalo de --daemon (por defecto {DAEMON_JITTER}).')
+    parser.add_argument('--fetch-workers', type=int, default=PIPELINE_FETCH_WORKERS,
+                        help=f'Hilos que piden correos a Gmail en paralelo (por defecto {PIPELINE_FETCH_WORKERS}).')
+    parser.add_argument('--parse-threads', type=int, default=PIPELINE_PARSE_THREADS,
+                        help=f'Hilos que extraen los datos de los correos (por defecto {PIPELINE_PARSE_THREADS}).')
+    parser.add_argument('--queue-size', type=int, default=PIPELINE_QUEUE_SIZE,
+                        help=f'Bloques de correos que pueden esperar entre una etapa y la siguiente (por defecto {PIPELINE_QUEUE_SIZE}).')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='Procesos que extraen los datos en paralelo (para backfills grandes; por defecto 0 = en el mismo proceso).')
+    parser.add_argument('--local-db', default=LOCAL_DB_FILE,
+                        help=f'Base SQLite donde se guardan los correos obtenidos y el resultado de su parseo (por defecto {LOCAL_DB_FILE}).')
+    parser.add_argument('--metrics-file',
+                        help='Archivo donde escribir las métricas en formato Prometheus al final de cada pasada (para el textfile collector de node_exporter, extensión .prom).')
+    parser.add_argument('--summary-file',
+                        help='Archivo donde escribir un resumen JSON de la ejecución (tiempos por etapa, bytes, parseos por banco).')
+    parser.add_argument('--reparse', action='store_true',
+                        help='Vuelve a parsear, sin conectarse a Gmail, los correos guardados localmente cuyo parseo falló.')
+    parser.add_argument('--import', dest='import_path', metavar='RUTA',
+                        help='Importa, sin usar la API de Gmail, los consumos de un archivo .mbox de Google Takeout, '
+                             'un .eml o una carpeta de archivos .eml.')
+    parser.add_argument('--export', dest='export_dir', metavar='CARPETA',
+                        help='Exporta, sin conectarse a Google, los movimientos del registro local a CARPETA '
+                             '(una subcarpeta por mes) para analizarlos con pyarrow, pandas o DuckDB. Requiere pyarrow.')
+    parser.add_argument('--export-format', choices=sorted(EXPORT_FORMATS), default='parquet',
+                        help='Formato de --export: parquet o arrow (Arrow IPC; por defecto parquet).')
+    parser.add_argument('--accounts', dest='accounts_file', metavar='ARCHIVO',
+                        help='Procesa varias cuentas de Gmail en un solo proceso, según el archivo JSON ARCHIVO '
+                             '(token, etiqueta, planilla, bancos, base local y cuota de cada una).')
+    parser.add_argument('--account-workers', type=int, default=ACCOUNT_WORKERS,
+                        help=f'Cuentas de --accounts que se procesan a la vez (por defecto {ACCOUNT_WORKERS}).')
+    parser.add_argument('--api-base-url',
+                        help='URL de un servidor que imita las APIs de Gmail y Sheets (por ejemplo http://127.0.0.1:8765/ '
+                             'con benchmarks/fake_google_server.py), para pruebas de carga sin tocar la cuenta real.')
+    parser.add_argument('--gmail-quota', type=int, default=GMAIL_QUOTA_UNITS_PER_MINUTE,
+                        help=f'Unidades de cuota de Gmail por minuto que respeta el script (por defecto {GMAIL_QUOTA_UNITS_PER_MINUTE}; 0 = sin límite).')
+    parser.add_argument('--sheets-quota', type=int, default=SHEETS_REQUESTS_PER_MINUTE,
+                        help=f'Requests a Sheets por minuto que respeta el script (por defecto {SHEETS_REQUESTS_PER_MINUTE}; 0 = sin límite).')
+    args = parser.parse_args(argv)
+    if min(args.fetch_workers, args.parse_threads, args.queue_size) < 1:
+        parser.error('--fetch-workers, --parse-threads y --queue-size deben ser al menos 1.')
+    if args.parse_workers < 0:
+        parser.error('--parse-workers no puede ser negativo.')
+    if args.gmail_quota < 0 or args.sheets_quota < 0:
+        parser.error('--gmail-quota y --sheets-quota no pueden ser negativos.')
+    if not 1 <= args.batch_size <= GMAIL_BATCH_MAX:
+        parser.error(f'--batch-size debe estar entre 1 y {GMAIL_BATCH_MAX}.')
+    if args.backfill and args.incremental:
+        parser.error('--backfill y --incremental no se pueden usar juntos.')
+    if args.backfill and args.daemon:
+        parser.error('--backfill y --daemon no se pueden usar juntos.')
+    if args.reparse and (args.backfill or args.incremental or args.daemon):
+        parser.error('--reparse no se puede combinar con --backfill, --incremental ni --daemon.')
+    if args.import_path and (args.reparse or args.backfill or args.incremental or args.daemon):
+        parser.error('--import no se puede combinar con --reparse, --backfill, --incremental ni --daemon.')
+    if args.import_path and not os.path.exists(args.import_path):
+        parser.error(f'No existe {args.import_path}.')
+    if args.export_dir and (args.import_path or args.reparse or args.backfill or args.incremental or args.daemon):
+        parser.error('--export no se puede combinar con --import, --reparse, --backfill, --incremental ni --daemon.')
+    if args.export_dir and importlib.util.find_spec('pyarrow') is None:
+        parser.error('--export necesita pyarrow (pip install pyarrow numpy).')
+    if args.accounts_file and (args.import_path or args.export_dir or args.reparse):
+        parser.error('--accounts no se puede combinar con --import, --export ni --reparse.')
+    if args.account_workers < 1:
+        parser.error('--account-workers debe ser al menos 1.')
+    args.accounts = None
+    if args.accounts_file:
+        try:
+            args.accounts = load_accounts(args.accounts_file, args)
+        except (OSError, ValueError) as e:
+            parser.error(f'Archivo de cuentas {args.accounts_file} inválido: {e}')
+    if args.interval < 1 or args.jitter < 0:
+        parser.error('--interval debe ser positivo y --jitter no puede ser negativo.')
+    if args.backfill and not args.since:
+        parser.error('--backfill requiere --since.')
+    if args.backfill and args.since > args.until:
+        parser.error('--since no puede ser posterior a --until.')
+    return args
+
+# --- PIPELINE DE PROCESAMIENTO ---
+# Cada pasada se arma como una cadena de etapas conectadas por colas acotadas:
+#   listar IDs -> obtener correos -> extraer datos -> registrar movimientos -> marcar en Gmail
+#                                                            \-> sincronizar con Sheets
+# Las etapas corren en hilos separados, así mientras se espera la red se sigue
+# parseando y viceversa. Como las colas tienen tamaño máximo, una etapa lenta frena a
+# las anteriores (backpressure) y la memoria queda acotada. El trabajo viaja en bloques
+# de --batch-size correos numerados, y la etapa de registro los reordena, así las filas
+# llegan a Sheets en el mismo orden que en una ejecución secuencial. Un correo se marca
+# en cuanto su movimiento queda en el registro local; la sincronización con Sheets corre
+# aparte, así una escritura lenta o fallida en Sheets no frena la lectura del correo.
+
+_STAGE_DONE = object() # Marca de fin de datos en las colas del pipeline
+
+def build_sheet_row(extracted_data, categories=MERCHANT_CATEGORIES):
+    """Arma la fila para Google Sheets a partir de los datos extraídos."""
+    # Columnas: Fecha / Banco /Comercio / Tarjeta (VISA o MASTERCARD) / Importe / Categoría
+    # Nota: La moneda (ARS/USD) no está en las columnas pedidas, solo el importe numérico.
+    # La categoría sale de MapeoComercios ('' si el comercio no está mapeado: se asigna a mano)
+    return [
+        extracted_data['fecha'],
+        extracted_data['banco'],
+        extracted_data['comercio'],
+        extracted_data['tarjeta'],
+        extracted_data['importe'], # Ya es un float
+        categories.categorize(extracted_data['comercio'])
+    ]
+
+def build_movement_row(extracted_data, categories=MERCHANT_CATEGORIES):
+    """Fila del registro local: la de Sheets más la moneda, que solo usan los totales y el resumen."""
+    return build_sheet_row(extracted_data, categories) + [extracted_data.get('moneda') or 'ARS']
+
+def _is_disabled_bank(message, banks):
+    """Indica si el correo es de un banco conocido que no está entre los habilitados."""
+    if banks is None:
+        return False
+    parser = find_bank_parser(message_header(message, 'From'))
+    return parser is not None and parser.name not in banks
+
+def needs_extraction(message, fetch_error, processed_label_id, banks=None):
+    """Indica si process_fetched_message va a llamar al extractor para este correo."""
+    return (fetch_error is None and processed_label_id not in message.get('labelIds', [])
+            and not _is_disabled_bank(message, banks))
+
+def process_fetched_message(msg_id, message, fetch_error, processed_label_id, extractor=None,
+                            categories=MERCHANT_CATEGORIES, banks=None):
+    """Decide qué hacer con un correo ya obtenido de Gmail.
+
+    extractor reemplaza a extract_data_from_email (lo usa --parse-workers para entregar
+    resultados calculados en otro proceso). categories y banks son los de la cuenta
+    (ver Account): los correos de bancos que no están en banks no se procesan.
+    Retorna (row, pending): la fila para el registro local (de build_movement_row, o None
+    si no hay nada que escribir) y si el correo debe quedar pendiente para reintentarlo
+    en otra ejecución."""
+    extractor = extractor or extract_data_from_email
+    try:
+        if isinstance(fetch_error, KnownParseFailure):
+            logging.info(f"El correo {msg_id} ya falló con esta versión del parser (v{PARSER_VERSION}). Se omite.")
+            return None, True
+        if fetch_error is not None:
+            # El error de este correo no afecta al resto del batch
+            if isinstance(fetch_error, HttpError):
+                logging.error(f'Ocurrió un error al obtener el correo {msg_id}: {fetch_error}')
+                # Si el correo ya no existe (404) no tiene sentido reintentarlo
+                return None, fetch_error.resp.status != 404
+            logging.error(f'Ocurrió un error inesperado al obtener el correo {msg_id}: {fetch_error}')
+            return None, True
+
+        if processed_label_id in message.get('labelIds', []):
+            # Puede pasar con pendientes del modo incremental procesados por otra ejecución
+            logging.info(f"El correo {msg_id} ya tiene la etiqueta '{PROCESSED_LABEL_NAME}'. Se omite.")
+            return None, False
+
+        if _is_disabled_bank(message, banks):
+            # No es un error: no se marca ni queda pendiente (no es para esta cuenta)
+            logging.info(f"El correo {msg_id} es de un banco no habilitado para esta cuenta. Se omite.")
+            return None, False
+
+        # Extraer los datos
+        extracted_data = extractor(message)
+        if extracted_data:
+            return build_movement_row(extracted_data, categories), False
+
+        # El parseo falló, se loggeó dentro de extract_data_from_email
+        # Considera enviar notificación aquí o dentro de la función de parseo
+        logging.warning(f"No se procesó el correo {msg_id} debido a errores de extracción.")
+        # Podrías decidir marcarlo como procesado igualmente para no reintentar, o dejarlo sin procesar.
+        # Por seguridad, no lo marcamos si falló el parseo.
+        return None, True
+    except Exception as e:
+        logging.error(f'Ocurrió un error inesperado al procesar el correo {msg_id}: {e}', exc_info=True)
+        return None, True
+
+class _LogRecordCollector(logging.Handler):
+    """Guarda los registros de log en vez de imprimirlos (en los procesos de --parse-workers)."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Dejar el registro listo para viajar al proceso principal (pickle)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+_worker_log_collector = None
+
+def _init_parse_worker(log_level):
+    """Inicializa un proceso de --parse-workers: sus logs se juntan para el proceso principal."""
+    global _worker_log_collector
+    _worker_log_collector = _LogRecordCollector()
+    root = logging.getLogger()
+    root.handlers = [_worker_log_collector]
+    root.setLevel(log_level)
+
+def _extract_block_in_worker(messages):
+    """Corre extract_data_from_email sobre un bloque de correos dentro de un proceso del pool.
+
+    Devuelve una tupla (data, error, log_records) por correo: los datos extraídos (o None),
+    la excepción si el extractor falló y los logs que generó ese correo; junto con las
+    métricas del bloque (para sumarlas a las del proceso principal)."""
+    results = []
+    for message in messages:
+        _worker_log_collector.records = []
+        data, error = None, None
+        try:
+            data = extract_data_from_email(message)
+        except Exception as e:
+            error = e
+        results.append((data, error, _worker_log_collector.records))
+    return results, METRICS.drain()
+
+def _replaying_extractor(worker_result):
+    """Arma un extractor que reemite los logs del proceso del pool y devuelve su resultado,
+    así el correo sigue exactamente el mismo camino (y deja los mismos logs) que en serie."""
+    data, error, records = worker_result
+
+    def _extractor(message):
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+        if error is not None:
+            raise error
+        return data
+    return _extractor
+
+class ProcessingPipeline:
+    """Una pasada de procesamiento armada como etapas concurrentes (ver arriba).
+
+    run() devuelve cuando todas las etapas terminaron. Después, total_messages tiene
+    la cantidad de correos revisados, pending_ids los que quedaron sin procesar,
+    search_completed indica si el listado de IDs llegó hasta el final y rows_synced
+    cuántas filas se escribieron en Sheets."""
+
+    def __init__(self, clients, store, ledger, user_id, processed_label_id, args, sync_state, account):
+        self.clients = clients
+        self.store = store
+        self.ledger = ledger
+        self.user_id = user_id
+        self.processed_label_id = processed_label_id
+        self.args = args
+        self.sync_state = sync_state
+        self.account = account
+        # Colas acotadas entre etapas: cada elemento es un bloque (seq, datos)
+        self.fetch_queue = queue.Queue(maxsize=args.queue_size)
+        self.parse_queue = queue.Queue(maxsize=args.queue_size)
+        self.write_queue = queue.Queue(maxsize=args.queue_size)
+        self.label_queue = queue.Queue(maxsize=args.queue_size)
+        # Sin límite: solo lleva avisos de filas nuevas y nunca debe frenar al registro
+        self.sync_queue = queue.Queue()
+        self.total_messages = 0
+        self.rows_recorded = 0
+        self.rows_synced = 0
+        self.pending_ids = []
+        self.search_completed = False
+        self._lock = threading.Lock()
+        self.parse_pool = None
+        self.parse_threads = args.parse_threads
+        if args.parse_workers:
+            # Un hilo por proceso del pool como mínimo, para que todos tengan un bloque en curso
+            self.parse_threads = max(args.parse_threads, args.parse_workers)
+
+    def _add_pending(self, msg_ids):
+        with self._lock:
+            self.pending_ids.extend(msg_ids)
+
+    def _start(self, target, count, name):
+        threads = [threading.Thread(target=target, name=f'{self.account.name}:{name}-{i + 1}', daemon=True)
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    @staticmethod
+    def _drain(input_queue, on_item):
+        """Consume una cola hasta _STAGE_DONE llamando a on_item con cada elemento.
+
+        La usa una etapa que no puede trabajar (p. ej. no pudo obtener los servicios):
+        las etapas anteriores no quedan bloqueadas en put() y cada bloque sigue su camino."""
+        while True:
+            item = input_queue.get()
+            if item is _STAGE_DONE:
+                return
+            on_item(item)
+
+    @staticmethod
+    def _failed_outcomes(results):
+        """Resultado de un bloque que no se pudo procesar: todos sus correos quedan pendientes."""
+        return [(msg_id, None, True, None) for msg_id, _, _ in results]
+
+    def _finish_stage(self, threads, next_queue, next_workers):
+        """Espera a que termine una etapa y avisa el fin de datos a cada hilo de la siguiente."""
+        for thread in threads:
+            thread.join()
+        for _ in range(next_workers):
+            next_queue.put(_STAGE_DONE)
+
+    def run(self):
+        args = self.args
+        if args.parse_workers:
+            # 'spawn' y no 'fork': el pool se crea con hilos ya corriendo en este proceso
+            self.parse_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.parse_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_parse_worker,
+                initargs=(logging.getLogger().getEffectiveLevel(),))
+        try:
+            listers = self._start(self._list_stage, 1, 'listar')
+            fetchers = self._start(self._fetch_stage, args.fetch_workers, 'obtener')
+            parsers = self._start(self._parse_stage, self.parse_threads, 'extraer')
+            writers = self._start(self._write_stage, 1, 'escribir')
+            labelers = self._start(self._label_stage, 1, 'etiquetar')
+            syncers = self._start(self._sync_stage, 1, 'sincronizar')
+
+            self._finish_stage(listers, self.fetch_queue, args.fetch_workers)
+            self._finish_stage(fetchers, self.parse_queue, self.parse_threads)
+            self._finish_stage(parsers, self.write_queue, 1)
+            for thread in writers:
+                thread.join()
+            self.label_queue.put(_STAGE_DONE)
+            self.sync_queue.put(_STAGE_DONE)
+            for thread in labelers + syncers:
+                thread.join()
+        finally:
+            if self.parse_pool:
+                self.parse_pool.shutdown()
+
+    def _list_stage(self):
+        """Lista los IDs pendientes y los agrupa en bloques numerados."""
+        try:
+            with self.clients.acquire() as (service_gmail, _):
+                # Los IDs se listan de forma perezosa: se procesa cada página a medida que llega
+                msg_ids = iter_pending_message_ids(service_gmail, self.user_id, self.args, self.sync_state,
+                                                   self.account.label, self.account.checkpoint_file)
+                for seq in itertools.count():
+                    chunk = list(itertools.islice(msg_ids, self.args.batch_size))
+                    if not chunk:
+                        break
+                    self.fetch_queue.put((seq, chunk))
+            self.search_completed = True
+        except HttpError as error:
+            logging.error(f'Ocurrió un error al buscar correos: {error}')
+        except Exception as e:
+            logging.error(f'Ocurrió un error inesperado en la búsqueda de correos: {e}', exc_info=True)
 
-    if not service_gmail or not service_sheets:
-        logging.error("No se pudieron obtener los servicios de Google. Saliendo.")
-        return
+    def _fetch_stage(self):
+        """Obtiene cada bloque de correos con una llamada batch."""
+        try:
+            with self.clients.acquire() as (service_gmail, _):
+                while True:
+                    item = self.fetch_queue.get()
+                    if item is _STAGE_DONE:
+                        return
+                    seq, chunk = item
+                    try:
+                        results, stored_ids = self._fetch_block(service_gmail, chunk)
+                    except Exception as e:
+                        logging.error(f'Ocurrió un error inesperado al obtener {len(chunk)} correos: {e}', exc_info=True)
+                        results, stored_ids = [(msg_id, None, e) for msg_id in chunk], set()
+                    self.parse_queue.put((seq, results, stored_ids))
+        except Exception as e:
+            # Ej: no se pudieron armar los servicios o refrescar el token. Los bloques que
+            # falten siguen hasta el registro como errores al obtenerlos (quedan pendientes)
+            logging.error(f'Ocurrió un error inesperado en la etapa de obtención de correos: {e}', exc_info=True)
+            self._drain(self.fetch_queue, lambda item: self.parse_queue.put(
+                (item[0], [(msg_id, None, e) for msg_id in item[1]], set())))
+
+    def _fetch_block(self, service_gmail, chunk):
+        """Obtiene un bloque: primero del almacenamiento local y el resto de Gmail.
+
+        Devuelve los resultados (msg_id, message, error) en el orden del bloque y el
+        conjunto de IDs que salieron de la copia local."""
+        local_results = {}
+        for msg_id, (estado, version, payload) in self.store.lookup(chunk).items():
+            if estado == 'fallo' and version == PARSER_VERSION:
+                local_results[msg_id] = (msg_id, None, KnownParseFailure())
+                continue
+            message = self.store.load_message(payload) if estado != 'ok' else None
+            # Si solo se guardaron los headers (remitente desconocido) hay que volver a pedirlo
+            if message and has_body(message):
+                local_results[msg_id] = (msg_id, message, None)
+        to_fetch = [msg_id for msg_id in chunk if msg_id not in local_results]
+        if local_results:
+            logging.info(f"{len(local_results)} de {len(chunk)} correos del bloque salen del almacenamiento local.")
+        fetched = {}
+        if to_fetch:
+            fetched = {result[0]: result for result in fetch_messages_batch(
+                service_gmail, self.user_id, to_fetch, len(to_fetch), banks=self.account.banks)}
+        results = [local_results.get(msg_id) or fetched[msg_id] for msg_id in chunk]
+        return results, set(local_results)
+
+    def _parse_stage(self):
+        """Extrae los datos de cada correo del bloque."""
+        while True:
+            item = self.parse_queue.get()
+            if item is _STAGE_DONE:
+                return
+            seq, results, stored_ids = item
+            try:
+                if self.parse_pool:
+                    # El trabajo pesado se hace en el pool; el resto (reemitir los logs y armar las
+                    # filas) lo hace la etapa de escritura, que recorre los bloques en orden, así
+                    # los logs salen en el mismo orden que en una ejecución sin --parse-workers
+                    extractors = self._extract_in_pool(results)
+                    outcomes = functools.partial(self._process_block_safely, results, stored_ids, extractors)
+                else:
+                    outcomes = self._process_block_safely(results, stored_ids)
+            except Exception as e:
+                logging.error(f'Ocurrió un error inesperado al extraer {len(results)} correos: {e}', exc_info=True)
+                outcomes = self._failed_outcomes(results)
+            # Cada bloque llega a la etapa de escritura, aunque haya fallado: si no, esta
+            # esperaría para siempre el número de bloque que falta
+            self.write_queue.put((seq, outcomes))
+
+    def _process_block_safely(self, results, stored_ids, extractors=None):
+        """_process_block, pero si falla todo el bloque queda pendiente en lugar de cortar la etapa."""
+        try:
+            return self._process_block(results, stored_ids, extractors)
+        except Exception as e:
+            logging.error(f'Ocurrió un error inesperado al procesar {len(results)} correos: {e}', exc_info=True)
+            return self._failed_outcomes(results)
+
+    def _process_block(self, results, stored_ids, extractors=None):
+        """Procesa un bloque de correos obtenidos; devuelve (msg_id, row, pending, message_id) por correo.
+
+        Además guarda en el almacenamiento local el resultado de cada extracción (y el
+        correo, si no estaba guardado)."""
+        extractors = extractors or {}
+        outcomes = []
+        store_outcomes = []
+        for msg_id, message, fetch_error in results:
+            extracted = needs_extraction(message, fetch_error, self.processed_label_id, self.account.banks)
+            row, pending = process_fetched_message(msg_id, message, fetch_error, self.processed_label_id,
+                                                   extractors.get(msg_id), self.account.categories, self.account.banks)
+            outcomes.append((msg_id, row, pending, message_rfc822_id(message) if row else None))
+            if extracted:
+                bank_parser = find_bank_parser(message_header(message, 'From'))
+                METRICS.inc('consumos_parse_total', banco=bank_parser.name if bank_parser else 'Desconocido',
+                            resultado='ok' if row else 'fallo')
+                store_outcomes.append((msg_id, None if msg_id in stored_ids else message, 'ok' if row else 'fallo'))
+        try:
+            self.store.save_outcomes(store_outcomes)
+        except Exception as e:
+            logging.error(f'No se pudo guardar el resultado de {len(store_outcomes)} correos en {self.store.db_file}: {e}')
+        return outcomes
+
+    def _extract_in_pool(self, results):
+        """Manda a extraer un bloque al pool de procesos; devuelve un extractor por msg_id."""
+        to_extract = [(msg_id, message) for msg_id, message, fetch_error in results
+                      if needs_extraction(message, fetch_error, self.processed_label_id, self.account.banks)]
+        if not to_extract:
+            return {}
+        try:
+            worker_results, worker_metrics = self.parse_pool.submit(
+                _extract_block_in_worker, [message for _, message in to_extract]).result()
+            METRICS.merge(worker_metrics)
+        except Exception as e:
+            # Falló el pool (no un correo): se reporta como error de cada correo del bloque
+            worker_results = [(None, e, [])] * len(to_extract)
+        return {msg_id: _replaying_extractor(worker_result)
+                for (msg_id, _), worker_result in zip(to_extract, worker_results)}
+
+    def _write_stage(self):
+        """Registra los movimientos en el registro local en el orden original de los bloques."""
+        waiting = {} # Bloques que llegaron antes de su turno
+        next_seq = 0
+        while True:
+            item = self.write_queue.get()
+            if item is _STAGE_DONE:
+                return
+            seq, outcomes = item
+            waiting[seq] = outcomes
+            while next_seq in waiting:
+                outcomes = waiting.pop(next_seq)
+                if callable(outcomes): # Bloque extraído en el pool de --parse-workers
+                    outcomes = outcomes()
+                try:
+                    self._record_block(outcomes)
+                except Exception as e:
+                    logging.error(f'Ocurrió un error inesperado al registrar {len(outcomes)} correos: {e}', exc_info=True)
+                    self._add_pending([msg_id for msg_id, *_ in outcomes])
+                next_seq += 1
+
+    def _record_block(self, outcomes):
+        entries = []
+        for msg_id, row, pending, message_id in outcomes:
+            self.total_messages += 1
+            if pending:
+                self._add_pending([msg_id])
+            elif row is not None:
+                entries.append((msg_id, row, message_id))
+        if not entries:
+            return
+        recorded_ids = [msg_id for msg_id, _, _ in entries]
+        try:
+            new_rows = self.ledger.record(entries)
+        except Exception as e:
+            logging.error(f'No se pudieron registrar {len(entries)} movimientos en {self.ledger.db_file}: {e}. '
+                          f'Sus correos no se marcarán como procesados.', exc_info=True)
+            self._add_pending(recorded_ids)
+            return
+        # Ya quedaron en el registro local: se pueden marcar aunque Sheets todavía no los tenga
+        self.label_queue.put(recorded_ids)
+        if new_rows:
+            self.sync_queue.put(new_rows)
 
-    user_id = 'me'
-    processed_label_id = get_or_create_label(service_gmail, user_id, PROCESSED_LABEL_NAME)
-    if not processed_label_id:
-        logging.error("No se pudo obtener o crear la etiqueta 'Procesado'. Saliendo.")
-        return
+    def _sync_stage(self):
+        """Escribe en Sheets los movimientos sin sincronizar, en bloques de SHEETS_FLUSH_ROWS filas.
 
-    # Buscar correos no leídos en la etiqueta específica, que NO tengan la etiqueta 'Procesado'
-    query = f'label:"{GMAIL_LABEL_TO_SEARCH}" is:unread -label:"{PROCESSED_LABEL_NAME}"'
+        Al terminar la pasada sincroniza todo lo que quede, incluso filas de pasadas
+        anteriores cuya escritura había fallado, y actualiza la hoja de resumen. Cada
+        vez que se registran movimientos revisa las alertas de presupuesto del mes."""
+        try:
+            self._sync_with_services()
+        except Exception as e:
+            # Las filas quedan en el registro local sin sincronizar: se escriben en la próxima
+            # pasada (sync_queue no tiene límite, así que el registro no se bloquea)
+            logging.error(f'Ocurrió un error inesperado en la sincronización con Sheets: {e}', exc_info=True)
+
+    def _sync_with_services(self):
+        with self.clients.acquire() as (service_gmail, service_sheets):
+            budgets = load_budgets(service_sheets, self.account.spreadsheet_id)
+            recipient = {'address': self.account.alert_email} if self.account.alert_email else {}
+            self._check_budget(service_gmail, budgets, recipient) # Por si quedaron de un --import
+            new_rows = 0
+            while True:
+                item = self.sync_queue.get()
+                if item is not _STAGE_DONE:
+                    new_rows += item
+                    self.rows_recorded += item
+                    self._check_budget(service_gmail, budgets, recipient)
+                    if new_rows < SHEETS_FLUSH_ROWS:
+                        continue
+                new_rows = 0
+                try:
+                    self.rows_synced += sync_ledger_to_sheet(service_sheets, self.ledger, self.account.spreadsheet_id,
+                                                             self.account.sheet_range)
+                except Exception as e:
+                    logging.error(f'Ocurrió un error inesperado al sincronizar con Sheets: {e}', exc_info=True)
+                if item is _STAGE_DONE:
+                    break
+            if self.rows_recorded or self.rows_synced:
+                try:
+                    write_summary_sheet(service_sheets, self.ledger, budgets, self.account.spreadsheet_id)
+                except Exception as e:
+                    logging.error(f"No se pudo actualizar la hoja '{RESUMEN_SHEET_NAME}' (¿existe en la planilla?): {e}")
+
+    def _check_budget(self, service_gmail, budgets, recipient):
+        try:
+            send_due_budget_alerts(service_gmail, self.user_id, self.ledger, budgets, recipient)
+        except Exception as e:
+            logging.error(f'Ocurrió un error inesperado al revisar el presupuesto: {e}', exc_info=True)
+
+    def _label_stage(self):
+        """Marca como procesados los correos cuyos movimientos ya se registraron.
+
+        Junta los IDs de varios bloques y llama a batchModify recién cuando hay
+        GMAIL_BATCH_MODIFY_MAX (o al terminar la pasada), en vez de una vez por bloque."""
+        buffered_ids = []
+        try:
+            with self.clients.acquire() as (service_gmail, _):
+                while True:
+                    recorded_ids = self.label_queue.get()
+                    if recorded_ids is not _STAGE_DONE:
+                        buffered_ids.extend(recorded_ids)
+                        if len(buffered_ids) < GMAIL_BATCH_MODIFY_MAX:
+                            continue
+                    if buffered_ids:
+                        self._mark_processed(service_gmail, buffered_ids)
+                        buffered_ids = []
+                    if recorded_ids is _STAGE_DONE:
+                        return
+        except Exception as e:
+            # Los movimientos ya están en el registro: sus correos quedan pendientes de marcar
+            logging.error(f'Ocurrió un error inesperado en la etapa de marcado de correos: {e}', exc_info=True)
+            self._add_pending(buffered_ids)
+            self._drain(self.label_queue, self._add_pending)
+
+    def _mark_processed(self, service_gmail, msg_ids):
+        try:
+            self._add_pending(mark_emails_processed(service_gmail, self.user_id, msg_ids, self.processed_label_id))
+        except Exception as e:
+            logging.error(f'Ocurrió un error inesperado al marcar {len(msg_ids)} correos: {e}', exc_info=True)
+            self._add_pending(msg_ids)
+
+def process_new_emails(clients, store, ledger, user_id, processed_label_id, args, account):
+    """Una pasada completa de una cuenta: busca los correos pendientes, los registra, los marca y sincroniza Sheets."""
+    sync_state = {} # El modo incremental deja acá el checkpoint a guardar
+    with clients.acquire() as (_, service_sheets):
+        account.categories.refresh(service_sheets, account.spreadsheet_id)
+    pipeline = ProcessingPipeline(clients, store, ledger, user_id, processed_label_id, args, sync_state, account)
+    labels = account.metric_labels
+    with METRICS.timer('consumos_stage_duration_seconds', stage='pasada', **labels):
+        pipeline.run()
+    METRICS.inc('consumos_messages_reviewed_total', pipeline.total_messages, **labels)
+    METRICS.inc('consumos_rows_synced_total', pipeline.rows_synced, **labels)
+    METRICS.set('consumos_pending_messages', len(pipeline.pending_ids), **labels)
+    METRICS.set('consumos_last_pass_timestamp_seconds', round(time.time()), **labels)
+
+    if not pipeline.total_messages:
+        logging.info("No se encontraron correos nuevos para procesar.")
+    else:
+        logging.info(f"Se revisaron {pipeline.total_messages} correos, {len(pipeline.pending_ids)} quedaron sin procesar.")
+    unsynced = ledger.count_unsynced()
+    if unsynced:
+        logging.warning(f"{unsynced} movimientos registrados todavía no están en Sheets. Se reintentará en la próxima pasada.")
+
+    if pipeline.search_completed and args.incremental and sync_state.get('checkpoint'):
+        checkpoint = sync_state['checkpoint']
+        # Correos vistos que quedaron sin procesar por un error pasajero (al obtenerlos, al
+        # registrarlos o al marcarlos): se reintentan en la próxima pasada incremental. Los
+        # que ya fallaron al parsearse con esta PARSER_VERSION (publicidad, remitentes
+        # desconocidos) no: volverían a fallar y el checkpoint crecería en cada pasada
+        try:
+            known_failures = store.known_failures(pipeline.pending_ids)
+        except Exception as e:
+            logging.error(f'No se pudieron consultar los correos fallidos en {store.db_file}: {e}')
+            known_failures = set()
+        checkpoint['pending'] = [msg_id for msg_id in dict.fromkeys(pipeline.pending_ids) if msg_id not in known_failures]
+        if known_failures:
+            logging.info(f"{len(known_failures)} correos que ya fallaron con esta versión del parser no se reintentarán.")
+        save_history_checkpoint(checkpoint, account.checkpoint_file)
+
+def run_daemon(run_pass, args):
+    """Modo --daemon: repite run_pass() cada args.interval (+/- args.jitter) segundos.
+
+    run_pass procesa las cuentas (ver AccountSession.run_pass), así se reutilizan las
+    mismas credenciales y servicios (y sus conexiones HTTP) en todas las pasadas,
+    refrescando el token antes de que venza. Termina con SIGTERM o Ctrl+C."""
+    stop_event = threading.Event()
+
+    def _stop(signum, frame):
+        logging.info(f"Señal {signum} recibida, terminando después de la pasada actual...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    logging.info(f"Modo daemon: revisando el correo cada {args.interval}s (+/- {args.jitter}s).")
+    while not stop_event.is_set():
+        try:
+            run_pass()
+        except Exception as e:
+            # Un error en una pasada no debe tirar abajo el daemon
+            logging.error(f'Ocurrió un error inesperado en la pasada: {e}', exc_info=True)
+        export_metrics(args.metrics_file, args.summary_file)
+
+        wait = max(0, args.interval + random.uniform(-args.jitter, args.jitter))
+        logging.info(f"Próxima revisión en {wait:.0f}s.")
+        stop_event.wait(wait)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.accounts:
+        run_accounts(args)
+        return
+    store = RawMessageStore(args.local_db)
+    ledger = TransactionLedger(args.local_db)
     try:
-        results = service_gmail.users().messages().list(userId=user_id, q=query).execute()
-        messages = results.get('messages', [])
+        if args.reparse:
+            reparse_stored_messages(store)
+        elif args.import_path:
+            MERCHANT_CATEGORIES.load_cached()
+            import_archive(args.import_path, ledger)
+            export_metrics(args.metrics_file, args.summary_file)
+        elif args.export_dir:
+            export_ledger(ledger, args.export_dir, args.export_format)
+            export_metrics(args.metrics_file, args.summary_file)
+        else:
+            run_with_google(store, ledger, args)
+    finally:
+        store.close()
+        ledger.close()
+
+class AccountSession:
+    """Una cuenta lista para procesar: sus servicios de Google (con su propia cuota), su
+    base local y el ID de su etiqueta 'Procesado'."""
+
+    def __init__(self, account, clients, store, ledger, processed_label_id, user_id='me'):
+        self.account = account
+        self.clients = clients
+        self.store = store
+        self.ledger = ledger
+        self.processed_label_id = processed_label_id
+        self.user_id = user_id
+
+    @classmethod
+    def open(cls, account, args, store, ledger, user_id='me'):
+        """Autentica la cuenta y obtiene (o crea) la etiqueta 'Procesado'; devuelve None si falla."""
+        clients = authenticate_google_apis(args.api_base_url, account.gmail_quota, account.sheets_quota,
+                                           account.token_file)
+        if not clients:
+            logging.error("No se pudieron obtener los servicios de Google.")
+            return None
+        with clients.acquire() as (service_gmail, _):
+            processed_label_id = get_or_create_label(service_gmail, user_id, PROCESSED_LABEL_NAME)
+        if not processed_label_id:
+            logging.error("No se pudo obtener o crear la etiqueta 'Procesado'.")
+            return None
+        return cls(account, clients, store, ledger, processed_label_id, user_id)
 
-        if not messages:
-            logging.info("No se encontraron correos nuevos para procesar.")
+    def run_pass(self, args):
+        """Una pasada de process_new_emails, refrescando antes el token si está por vencer."""
+        if not refresh_credentials_if_needed(self.clients.creds, token_file=self.account.token_file):
+            logging.error("No se pudo refrescar el token. Se reintentará en la próxima pasada.")
             return
+        process_new_emails(self.clients, self.store, self.ledger, self.user_id, self.processed_label_id,
+                           args, self.account)
 
-        logging.info(f"Se encontraron {len(messages)} correos para procesar.")
+def run_with_google(store, ledger, args):
+    """Autentica y procesa los correos (una pasada o en modo --daemon)."""
+    logging.info("Iniciando proceso de lectura de consumos...")
+    session = AccountSession.open(Account.from_args(args), args, store, ledger)
+    if not session:
+        logging.error("Saliendo.")
+        return
 
-        for message_info in messages:
-            msg_id = message_info['id']
-            try:
-                # Obtener el contenido completo del correo
-                message = service_gmail.users().messages().get(userId=user_id, id=msg_id, format='full').execute() # format='full' para headers y body
-
-                # Extraer los datos
-                extracted_data = extract_data_from_email(message)
-
-                if extracted_data:
-                    # Preparar fila para Google Sheets
-                    # Columnas: Fecha / Banco /Comercio / Tarjeta (VISA o MASTERCARD) / Importe
-                    # Nota: La moneda (ARS/USD) no está en las columnas pedidas, solo el importe numérico.
-                    row_values = [
-                        extracted_data['fecha'],
-                        extracted_data['banco'],
-                        extracted_data['comercio'],
-                        extracted_data['tarjeta'],
-                        extracted_data['importe'] # Ya es un float
-                    ]
-
-                    # Añadir a Google Sheets
-                    if append_to_sheet(service_sheets, SPREADSHEET_ID, SHEET_RANGE_NAME, row_values):
-                        # Marcar correo como procesado (leído + etiqueta)
-                        mark_email_processed(service_gmail, user_id, msg_id, processed_label_id)
-                    else:
-                        logging.error(f"No se pudo añadir a Sheets el correo {msg_id}. No se marcará como procesado.")
-                else:
-                    # El parseo falló, se loggeó dentro de extract_data_from_email
-                    # Considera enviar notificación aquí o dentro de la función de parseo
-                    logging.warning(f"No se procesó el correo {msg_id} debido a errores de extracción.")
-                    # Podrías decidir marcarlo como procesado igualmente para no reintentar, o dejarlo sin procesar.
-                    # Por seguridad, no lo marcamos si falló el parseo.
+    if args.daemon:
+        run_daemon(functools.partial(session.run_pass, args), args)
+    else:
+        session.run_pass(args)
+        export_metrics(args.metrics_file, args.summary_file)
 
-            except HttpError as error:
-                logging.error(f'Ocurrió un error al procesar el correo {msg_id}: {error}')
-            except Exception as e:
-                 logging.error(f'Ocurrió un error inesperado al procesar el correo {msg_id}: {e}', exc_info=True)
+    logging.info("Proceso de lectura de consumos finalizado.")
 
+def _run_account_pass(session, args):
+    # El hilo lleva el nombre de la cuenta, que aparece en cada línea del log
+    threading.current_thread().name = session.account.name
+    session.run_pass(args)
 
-    except HttpError as error:
-        logging.error(f'Ocurrió un error al buscar correos: {error}')
-    except Exception as e:
-        logging.error(f'Ocurrió un error inesperado en la búsqueda de correos: {e}', exc_info=True)
+def process_accounts(pool, sessions, args):
+    """Una pasada de todas las cuentas, repartidas entre los hilos de pool.
+
+    Cada cuenta es independiente: si una falla se registra el error y las demás siguen."""
+    futures = {pool.submit(_run_account_pass, session, args): session.account.name for session in sessions}
+    failed = []
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            failed.append(futures[future])
+            logging.error(f"Falló la pasada de la cuenta '{futures[future]}': {e}", exc_info=True)
+    logging.info(f"Pasada terminada: {len(sessions) - len(failed)} de {len(sessions)} cuentas sin errores"
+                 + (f" (fallaron: {', '.join(sorted(failed))})." if failed else "."))
+
+def run_accounts(args):
+    """Modo --accounts: procesa las cuentas del archivo en un solo proceso, hasta
+    --account-workers a la vez (una pasada o en modo --daemon).
+
+    Las cuentas se autentican de a una al arrancar (el flujo por consola puede pedir
+    datos al usuario). Cada una usa sus propios servicios, cuota y base local, así una
+    cuenta lenta o con errores no frena a las otras; una cuenta que no se puede
+    autenticar queda afuera de esta ejecución."""
+    logging.info(f"Iniciando proceso de lectura de consumos de {len(args.accounts)} cuentas...")
+    # Con varias cuentas a la vez, cada línea del log dice de qué cuenta es (por el nombre del hilo)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - [%(threadName)s] [%(funcName)s] - %(message)s'))
+    main_thread = threading.current_thread()
+    databases, sessions = [], []
+    try:
+        for account in args.accounts:
+            main_thread.name = account.name
+            try:
+                databases.append(RawMessageStore(account.local_db))
+                databases.append(TransactionLedger(account.local_db))
+                session = AccountSession.open(account, args, *databases[-2:])
+            except Exception as e:
+                logging.error(f'Error inesperado al preparar la cuenta: {e}', exc_info=True)
+                session = None
+            if session:
+                sessions.append(session)
+            else:
+                logging.error(f"La cuenta '{account.name}' no se procesará en esta ejecución.")
+        main_thread.name = 'MainThread'
+        if not sessions:
+            logging.error("No hay ninguna cuenta lista para procesar. Saliendo.")
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.account_workers, thread_name_prefix='cuenta') as pool:
+            run_pass = functools.partial(process_accounts, pool, sessions, args)
+            if args.daemon:
+                run_daemon(run_pass, args)
+            else:
+                run_pass()
+                export_metrics(args.metrics_file, args.summary_file)
+    finally:
+        main_thread.name = 'MainThread'
+        for database in databases:
+            database.close()
 
     logging.info("Proceso de lectura de consumos finalizado.")
 